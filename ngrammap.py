@@ -43,6 +43,8 @@ Here is a diagram illustrating how this data structure is stored, where "O" is a
                O   O     O
                |   |     |
                a   a     a
+
+Optionally the prefix tree can be kept path compressed (a radix tree), where a chain of nodes which neither end an n-gram nor branch is stored as a single node holding the run of elements along the chain.
 """
 
 __author__ = "Marc Tanti"
@@ -53,282 +55,2962 @@ __version__ = "0.3.0"
 __maintainer__ = "Marc Tanti"
 __status__ = "Prototype"
 
-class NGramMap():
-    """ Map n-grams to values. N-grams must consist of hashable elements and the container must be ordered and its length defined. The container used is irrelevant as it is not used internally. """
-    
-    def __init__(self, init_mapping=dict()):
-        """ Create a new n-gram map. 'init_mapping' is a dictionary which maps n-grams to values as an initialization to this mapping. """
-        self.root = _NGramMapNode()
-        self.size_freqs = dict() #A dictionary recording the frequencies of each n-gram size.
-        self.ele_freqs = dict() #A dictionary recording the frequencies of all elements in all n-grams.
+import array
+import asyncio
+import bisect
+import collections
+import gc
+import heapq
+import itertools
+import mmap as mmap_module
+import multiprocessing
+import multiprocessing.shared_memory
+import numbers
+import operator
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import threading
+import types
+
+class NGramMap():
+    """ Map n-grams to values. N-grams must consist of hashable elements and the container must be ordered and its length defined. The container used is irrelevant as it is not used internally. """
+    
+    def __init__(self, init_mapping=dict(), ele_index=False, position_index=False, suffix_tree=False, subtree_aggregates=False, ele_summary_bits=0, compact=False, radix=False, query_cache_entries=0, query_cache_bytes=0, size_index=False):
+        """ Create a new n-gram map. 'init_mapping' is a dictionary which maps n-grams to values as an initialization to this mapping. If 'ele_index' is True then an index from elements to the n-grams which contain them is kept in order to find n-grams by element without searching the whole prefix tree, at the cost of extra memory. If 'position_index' is True then an index from n-gram sizes, positions and elements to the n-grams which have the element at that position is kept in order to find n-grams by template without searching the whole prefix tree, also at the cost of extra memory. If 'suffix_tree' is True then a second prefix tree of the reversed n-grams is kept in order to find n-grams by suffix without searching the whole prefix tree. If 'size_index' is True then every node of the prefix tree also keeps the number of n-grams of each size under it in order to skip subtrees without n-grams of the required size when finding n-grams by size or template and to count n-grams by prefix or template without enumerating them, at the cost of slower additions and removals. If 'subtree_aggregates' is True then every node of the prefix tree also keeps the sum of the numeric values of the n-grams under it in order to sum values by prefix without enumerating them, which implies 'size_index'. If 'ele_summary_bits' is more than 0 then every node keeps a Bloom filter of that many bits of the elements below it in order to skip subtrees when finding n-grams by element without an element index, where more bits use more memory but skip more subtrees. If 'compact' is True then elements are interned into integer IDs which are used in their place inside the map in order to save memory, at the cost of translating n-grams into IDs and back on every call. If 'radix' is True then the prefix tree is kept path compressed, where a chain of nodes which neither end an n-gram nor branch is stored as a single node, in order to use fewer nodes for long n-grams, at the cost of slower additions and removals. If 'query_cache_entries' or 'query_cache_bytes' is more than 0 then the results of searches by element, template, prefix or suffix are kept in a least recently used cache of at most that many results or bytes (or both), where a cached result is discarded only when an n-gram which belongs in it is added or removed, at the cost of extra memory and slower additions and removals. """
+        self.radix = radix #Flag marking whether the prefix tree (and the suffix tree if there is one) is path compressed.
+        self.size_index = size_index or subtree_aggregates #Flag marking whether every node of the prefix tree (and the suffix tree if there is one) keeps the number of n-grams of each size under it.
+        self.root = _node_class(radix, self.size_index, subtree_aggregates, ele_summary_bits > 0)() #The root of the prefix tree, whose nodes only have the optional fields used by the map (see _node_class()).
+        self.vocab = _Vocabulary() if compact else None #An optional vocabulary of interned elements, in which case the prefix tree and everything else inside the map refers to elements by their ID.
+        self.size_freqs = dict() #A dictionary recording the frequencies of each n-gram size.
+        self.ele_freqs = dict() #A dictionary recording the frequencies of all elements (or their IDs if they are interned) in all n-grams.
+        self.ele_index = _EleIndex() if ele_index else None #An optional index of the n-grams containing each element.
+        self.position_index = _PositionIndex() if position_index else None #An optional index of the n-grams containing each element at each position.
+        self.suffix_root = _node_class(radix, self.size_index)() if suffix_tree else None #An optional prefix tree of the reversed n-grams, that is, a suffix tree of the n-grams. Its nodes' values are not used.
+        self.value_sums = subtree_aggregates #Flag marking whether every node of the prefix tree keeps the sum of the values of the n-grams under it.
+        self.ele_summary = _EleSummary(ele_summary_bits) if ele_summary_bits > 0 else None #An optional summary of the elements below every node of the prefix tree.
+        self.query_cache = _QueryCache(query_cache_entries, query_cache_bytes) if query_cache_entries > 0 or query_cache_bytes > 0 else None #An optional cache of the results of searches.
+        self.followed = self.suffix_root is not None or self.ele_summary is not None or self.query_cache is not None or self.ele_index is not None or self.position_index is not None #Flag marking whether any optional structure follows the n-grams added to and removed from the map, so that a map without any only checks this flag for every n-gram.
+        self.plain_tree = self.vocab is None and not self.radix and not self.size_index #Flag marking whether the prefix tree's nodes are keyed by the elements themselves and keep no optional fields along the way, so that new n-grams are added by walking it without keeping the path.
+
+        for ngram in init_mapping:
+            self[ngram] = init_mapping[ngram]
+
+    def __setitem__(self, ngram, value):
+        """ Assign a value to an n-gram, overwriting the existing value if the n-gram exists. 'ngram' must be hashable and in an ordered container whose length is defined. """
+        #The prefix tree is walked only once, both to find out if the n-gram is new and to assign its value.
+        if self.plain_tree:
+            node = self.root.make_node(ngram)
+            if not node.end_of_ngram:
+                self._record_ngram(ngram)
+                node.end_of_ngram = True
+            node.value = value
+            return
+        key = self._new_key(ngram)
+        nodes = list() if self.value_sums else None
+        node = self.root.make_node(key, self.vocab is not None, self.radix, nodes)
+        if not node.end_of_ngram:
+            self._record_ngram(key)
+            node.end_of_ngram = True
+        if nodes is not None:
+            _add_value_sum(nodes, node.value, value)
+        node.value = value
+
+    def increment(self, ngram, by=1):
+        """ Add 'by' to the value of an n-gram, where an n-gram which does not exist is taken to map to 0, and return the new value. 'ngram' must be hashable and in an ordered container whose length is defined. """
+        if self.plain_tree:
+            node = self.root.make_node(ngram)
+            if node.end_of_ngram:
+                node.value += by
+            else:
+                self._record_ngram(ngram)
+                node.end_of_ngram = True
+                node.value = by
+            return node.value
+        key = self._new_key(ngram)
+        nodes = list() if self.value_sums else None
+        node = self.root.make_node(key, self.vocab is not None, self.radix, nodes)
+        if node.end_of_ngram:
+            value = node.value + by
+        else:
+            self._record_ngram(key)
+            node.end_of_ngram = True
+            value = by
+        if nodes is not None:
+            _add_value_sum(nodes, node.value, value)
+        node.value = value
+        return value
+
+    def count_ngrams(self, ngrams):
+        """ Count the n-grams in an iterable of n-grams by incrementing the value of each n-gram by 1 every time it is encountered, where an n-gram which does not exist is taken to map to 0. """
+        #The options are checked once for all the n-grams. A plain prefix tree is walked directly for every n-gram (as in _NGramMapNode.make_node()) in order to avoid the overhead of a method call per n-gram.
+        if not self.plain_tree:
+            for ngram in ngrams:
+                self.increment(ngram)
+            return
+        root = self.root
+        node_class = type(root)
+        record_ngram = self._record_ngram
+        for ngram in ngrams:
+            node = root
+            for ele in ngram:
+                children = node.children
+                child = children.get(ele)
+                if child is None:
+                    child = node_class()
+                    if children is _NO_CHILDREN:
+                        node.children = { ele: child }
+                    else:
+                        children[ele] = child
+                node = child
+            if node.end_of_ngram:
+                node.value += 1
+            else:
+                record_ngram(ngram)
+                node.end_of_ngram = True
+                node.value = 1
+
+    def add_sequence(self, tokens, min_n, max_n, count=True, value_fn=None):
+        """ Add every n-gram of size 'min_n' to 'max_n' (inclusive, with 1 <= min_n <= max_n) which is found in a sequence of tokens. If 'count' is True then the value of each n-gram is incremented by 1 for every time it is found, where an n-gram which does not exist is taken to map to 0. Otherwise each n-gram is assigned the value 'value_fn(ngram)', or None if 'value_fn' is not given. 'tokens' must be an ordered container of hashable elements whose length is defined. """
+        self._add_sequence_at(tokens, range(len(tokens) - min_n + 1), min_n, max_n, count, value_fn)
+
+    def _add_sequence_at(self, tokens, starts, min_n, max_n, count=True, value_fn=None):
+        """ Add the n-grams found in a sequence of tokens which start at the given positions, as described in add_sequence(). """
+        #In a radix tree, the nodes of n-grams which start at the same position are made and split as each n-gram is added so the n-grams are added one by one.
+        if self.radix:
+            for start in starts:
+                for end in range(start + min_n, min(start + max_n, len(tokens)) + 1):
+                    if count:
+                        self.increment(tokens[start:end])
+                    elif value_fn is None:
+                        self[tokens[start:end]] = None
+                    else:
+                        self[tokens[start:end]] = value_fn(tuple(tokens[start:end]))
+            return
+
+        #All n-grams which start at the same position share a path in the prefix tree so the path is walked only once per position, treating every node along the way which is deep enough as the terminating node of an n-gram.
+        #With a size index, every node along the way counts each new n-gram ending at a terminating node below it, so the path is only kept if there is a size index (which value sums imply).
+        root = self.root
+        node_class = type(root)
+        size_index = self.size_index
+        compact = self.vocab is not None
+        keys = self._new_key(tokens)
+        num_tokens = len(keys)
+        path = None
+        for start in starts:
+            end = min(start + max_n, num_tokens)
+            node = root
+            if size_index:
+                path = [ node ]
+            size = 0
+            for i in range(start, end):
+                ele = keys[i]
+                child = node.children.get(ele)
+                if child is None:
+                    child = _add_child(node, ele, node_class(), compact)
+                node = child
+                if size_index:
+                    path.append(node)
+                size += 1
+
+                if size >= min_n:
+                    if count:
+                        value = node.value + 1 if node.end_of_ngram else 1
+                    elif value_fn is None:
+                        value = None
+                    else:
+                        value = value_fn(tuple(tokens[start:i+1]))
+
+                    if not node.end_of_ngram:
+                        if size_index:
+                            depth = size + 1
+                            for path_node in path:
+                                depth -= 1
+                                if path_node.depth_counts is None and not path_node.depths >> depth & 1:
+                                    path_node.depths |= 1 << depth
+                                else:
+                                    _add_depth(path_node, depth)
+                        self._record_ngram(keys[start:i+1])
+                        node.end_of_ngram = True
+                    if self.value_sums:
+                        _add_value_sum(path, node.value, value)
+                    node.value = value
+
+    def _key(self, ngram):
+        """ Get the key of an n-gram inside the map, which is the n-gram itself unless elements are interned, in which case it is the tuple of the elements' IDs (where elements which were never interned are given the ID -1). """
+        if self.vocab is None:
+            return ngram
+        return self.vocab.encode(ngram)
+
+    def _new_key(self, ngram):
+        """ Get the key of an n-gram inside the map, as described in _key(), interning any new elements. """
+        if self.vocab is None:
+            return ngram
+        return self.vocab.encode_new(ngram)
+
+    def _ele_key(self, ele):
+        """ Get the key of an element inside the map, which is the element itself unless elements are interned, in which case it is the element's ID (or -1 if it was never interned). """
+        if self.vocab is None:
+            return ele
+        return self.vocab.ids.get(ele, -1)
+
+    def _decoded(self, keys):
+        """ Get an iterator over the n-grams of an iterator over n-gram keys, as described in _key(). """
+        if self.vocab is None:
+            return keys
+        return self.vocab.decode_all(keys)
+
+    def _record_ngram(self, ngram):
+        """ Record the size and elements of an n-gram (given by its key) which has just been added to the mapping, also adding it to the optional structures which follow the n-grams in the mapping. """
+        #Record size of n-gram.
+        ngram_size = len(ngram)
+        if ngram_size not in self.size_freqs:
+            self.size_freqs[ngram_size] = 0
+        self.size_freqs[ngram_size] += 1
+
+        #Record elements of n-gram.
+        for ele in ngram:
+            if ele not in self.ele_freqs:
+                self.ele_freqs[ele] = 0
+            self.ele_freqs[ele] += 1
+
+        if not self.followed:
+            return
+
+        if self.suffix_root is not None:
+            self.suffix_root.make_node(tuple(reversed(ngram)), self.vocab is not None, self.radix).end_of_ngram = True
+
+        if self.ele_summary is not None:
+            self.ele_summary.add(self.root, ngram)
+
+        if self.query_cache is not None:
+            self.query_cache.changed(ngram)
+
+        if self.ele_index is not None or self.position_index is not None:
+            ngram = tuple(ngram)
+            if self.ele_index is not None:
+                self.ele_index.add(ngram)
+            if self.position_index is not None:
+                self.position_index.add(ngram)
+
+    def _dismiss_ngram(self, ngram):
+        """ Dismiss the size and elements of an n-gram (given by its key) which has just been removed from the mapping, also removing it from the optional structures which follow the n-grams in the mapping. """
+        #Dismiss size of n-gram.
+        ngram_size = len(ngram)
+        self.size_freqs[ngram_size] -= 1
+        if self.size_freqs[ngram_size] == 0:
+            self.size_freqs.pop(ngram_size)
+
+        #Dismiss elements of n-gram.
+        for ele in ngram:
+            self.ele_freqs[ele] -= 1
+            if self.ele_freqs[ele] == 0:
+                self.ele_freqs.pop(ele)
+
+        if not self.followed:
+            return
+
+        if self.suffix_root is not None:
+            self.suffix_root.pop(tuple(reversed(ngram)), self.radix)
+
+        if self.ele_summary is not None:
+            self.ele_summary.discard(self.root, ngram)
+
+        if self.query_cache is not None:
+            self.query_cache.changed(ngram)
+
+        if self.ele_index is not None or self.position_index is not None:
+            ngram = tuple(ngram)
+            if self.ele_index is not None:
+                self.ele_index.discard(ngram)
+            if self.position_index is not None:
+                self.position_index.discard(ngram)
+
+    def pop(self, ngram):
+        """ Remove an n-gram and associated value, returning the value. 'ngram' must be hashable and in an ordered container whose length is defined. """
+        key = self._key(ngram)
+        try:
+            value = self.root.pop(key, self.radix, self.value_sums)
+        except KeyError:
+            raise KeyError(ngram)
+        self._dismiss_ngram(key)
+        return value
+
+    def __getitem__(self, ngram):
+        """ Get the value associated with an n-gram. 'ngram' must be an ordered container whose length is defined and whose elements are hashable. """
+        node = self.root.find_node(self._key(ngram))
+
+        #If n-gram does not exist then raise an error.
+        if node is None or not node.end_of_ngram:
+            raise KeyError(ngram)
+        return node.value
+
+    def __contains__(self, ngram):
+        """ Check if an n-gram exists in the mapping. 'ngram' must be an ordered container whose length is defined and whose elements are hashable. """
+        return self._key(ngram) in self.root
+
+    def get_many(self, ngrams, default=None, ids=False):
+        """ Get the values associated with a batch of n-grams as a list, with 'default' in place of the value of every n-gram which does not exist. 'ngrams' must be an iterable of n-grams. If 'ids' is True then each n-gram is given as an ordered container of the IDs of its elements instead (see ngram_ids()), such as a row of an array, which requires a compact map. """
+        #The prefix tree is walked directly for every n-gram in order to avoid the overhead of a method call per n-gram.
+        find_node = self.root.find_node
+        values = list()
+        for key in self.__batch_keys(ngrams, ids):
+            node = find_node(key)
+            values.append(node.value if node is not None and node.end_of_ngram else default)
+        return values
+
+    def contains_many(self, ngrams, ids=False):
+        """ Check if each n-gram in a batch of n-grams exists in the mapping, returning a list of booleans. 'ngrams' must be an iterable of n-grams. If 'ids' is True then each n-gram is given as an ordered container of the IDs of its elements instead (see ngram_ids()), such as a row of an array, which requires a compact map. """
+        find_node = self.root.find_node
+        found = list()
+        for key in self.__batch_keys(ngrams, ids):
+            node = find_node(key)
+            found.append(node is not None and node.end_of_ngram)
+        return found
+    def __batch_keys(self, ngrams, ids):
+        """ Helper method to get_many() and contains_many() which gets an iterator over the keys of a batch of n-grams. """
+        if ids:
+            if self.vocab is None:
+                raise ValueError("n-grams can only be given as element IDs in a compact n-gram map")
+            return ngrams
+        if self.vocab is None:
+            return ngrams
+        return ( self.vocab.encode(ngram) for ngram in ngrams )
+
+    def ngram_ids(self, ngram):
+        """ Get the tuple of the IDs of the elements of an n-gram, where elements which were never added are given the ID -1. This requires a compact map. """
+        if self.vocab is None:
+            raise ValueError("only a compact n-gram map has element IDs")
+        return self.vocab.encode(ngram)
+
+    def ngrams(self):
+        """ Get an iterator over all the n-grams in the mapping. Returned n-grams are tuples. """
+        return self._decoded(self.root.ngrams())
+
+    def sized_ngrams(self, size):
+        """ Get an iterator over all the n-grams of a particular size in the mapping. Returned n-grams are tuples. """
+        return self._decoded(self.root.sized_ngrams(size))
+
+    def ngrams_with_prefix(self, prefix, size=None):
+        """ Get an iterator over all the n-grams which start with the given prefix, optionally only those of a particular size. 'prefix' must be an ordered container of elements whose length is defined. Returned n-grams are tuples. """
+        prefix = tuple(self._key(prefix))
+        return self.__cached(('prefix', prefix, size), lambda:self.root.ngrams_with_prefix(prefix, size))
+
+    def ngrams_with_suffix(self, suffix, size=None):
+        """ Get an iterator over all the n-grams which end with the given suffix, optionally only those of a particular size. 'suffix' must be an ordered container of elements whose length is defined. Returned n-grams are tuples. """
+        suffix = tuple(self._key(suffix))
+        if self.suffix_root is not None:
+            return self.__cached(('suffix', suffix, size), lambda:self.__ngrams_with_suffix(suffix, size))
+        return self.__cached(('suffix', suffix, size), lambda:self.root.ngrams_with_suffix(suffix, size))
+    def __ngrams_with_suffix(self, suffix, size):
+        """ Helper method to ngrams_with_suffix() which uses the suffix tree. """
+        #The n-grams in the suffix tree are reversed so they start with the reversed suffix and need to be reversed back.
+        for reversed_ngram in self.suffix_root.ngrams_with_prefix(reversed(suffix), size):
+            yield reversed_ngram[::-1]
+
+    def ngrams_with_ele(self, target):
+        """ Get an iterator over all the n-grams which contain the given target element. 'target' must be an element. Returned n-grams are tuples. """
+        target = self._ele_key(target)
+        if self.ele_index is not None:
+            return self.__cached(('ele', (target,), None), lambda:self.ele_index.ngrams_with_ele(target))
+        return self.__cached(('ele', (target,), None), lambda:self.root.ngrams_with_ele(target, self.ele_summary))
+
+    def sized_ngrams_with_ele(self, target, size):
+        """ Get an iterator over all the n-grams of a particular size which contain the given target element. 'target' must be an element. Returned n-grams are tuples. """
+        target = self._ele_key(target)
+        if self.ele_index is not None:
+            return self.__cached(('ele', (target,), size), lambda:self.ele_index.sized_ngrams_with_ele(target, size))
+        return self.__cached(('ele', (target,), size), lambda:self.root.sized_ngrams_with_ele(target, size, self.ele_summary))
+
+    def ngrams_with_all_eles(self, targets):
+        """ Get an iterator over all the n-grams which contain all the given target elements in any order. 'targets' must be a set of elements. Returned n-grams are tuples. """
+        if self.vocab is not None:
+            targets = { self._ele_key(target) for target in targets }
+        if self.ele_index is not None and len(targets) > 0:
+            return self.__cached(('all_eles', frozenset(targets), None), lambda:self.ele_index.ngrams_with_all_eles(self.__rarest_first(targets)))
+        return self.__cached(('all_eles', frozenset(targets), None), lambda:self.root.ngrams_with_all_eles(targets, self.ele_summary))
+
+    def sized_ngrams_with_all_eles(self, targets, size):
+        """ Get an iterator over all the n-grams of a particular size which contain all the given target elements in any order. 'targets' must be a set of elements. Returned n-grams are tuples. """
+        if self.vocab is not None:
+            targets = { self._ele_key(target) for target in targets }
+        if self.ele_index is not None and len(targets) > 0:
+            return self.__cached(('all_eles', frozenset(targets), size), lambda:self.ele_index.sized_ngrams_with_all_eles(self.__rarest_first(targets), size))
+        return self.__cached(('all_eles', frozenset(targets), size), lambda:self.root.sized_ngrams_with_all_eles(targets, size, self.ele_summary))
+
+    def __rarest_first(self, targets):
+        """ Sort a set of target elements from the least frequent to the most frequent. """
+        return sorted(targets, key=lambda ele:self.ele_freqs.get(ele, 0))
+
+    def ngrams_by_template(self, ngram_template, placeholder_indices):
+        """ Get an iterator over all the n-grams which match an n-gram template consisting of elements, some of which will be ignored as place holders. Place holders are elements that can be substituted by any element. The indices of the place holders must be specified. Returned n-grams are tuples. """
+        ngram_template = self._key(ngram_template)
+        query = ('template', tuple(_PLACEHOLDER if i in placeholder_indices else ele for (i, ele) in enumerate(ngram_template)), None)
+        if self.position_index is not None and len(placeholder_indices) < len(ngram_template):
+            return self.__cached(query, lambda:self.position_index.ngrams_by_template(ngram_template, placeholder_indices))
+        return self.__cached(query, lambda:self.root.ngrams_by_template(ngram_template, placeholder_indices))
+
+    def __cached(self, query, search):
+        """ Get an iterator over the n-grams found by a search, where 'search' is called to get an iterator over their keys and 'query' identifies the search as described in _QueryCache. The n-grams are taken from the query cache if there is one. """
+        #A search for an element which was never interned is not cached since the element would be given a different ID if it is added later.
+        if self.query_cache is None or (self.vocab is not None and -1 in query[1]):
+            return self._decoded(search())
+        return iter(self.query_cache.results(query, lambda:self._decoded(search())))
+
+    def query_cache_stats(self):
+        """ Get a dictionary of the number of cache hits, misses, evictions (results discarded to keep within the cache's limits) and invalidations (results discarded because of changes to the map) of the query cache, together with the number of cached results ('entries') and their estimated size in bytes ('bytes'). This requires a map with a query cache. """
+        if self.query_cache is None:
+            raise ValueError("only an n-gram map with a query cache has query cache statistics")
+        cache = self.query_cache
+        return { 'hits': cache.hits, 'misses': cache.misses, 'evictions': cache.evictions, 'invalidations': cache.invalidations, 'entries': len(cache.entries), 'bytes': cache.num_bytes }
+
+    def count_with_prefix(self, prefix, size=None):
+        """ Get the number of n-grams which start with the given prefix, optionally only those of a particular size. 'prefix' must be an ordered container of elements whose length is defined. """
+        prefix = self._key(prefix)
+        if self.size_index:
+            return self.root.count_with_prefix(prefix, size)
+        return sum(1 for _ in self.root.ngrams_with_prefix(prefix, size))
+
+    def count_by_template(self, ngram_template, placeholder_indices):
+        """ Get the number of n-grams which match an n-gram template, as described in ngrams_by_template(). """
+        if self.size_index:
+            return self.root.count_by_template(self._key(ngram_template), placeholder_indices)
+        return sum(1 for _ in self.ngrams_by_template(ngram_template, placeholder_indices))
+
+    def value_sum_with_prefix(self, prefix):
+        """ Get the sum of the numeric values of the n-grams which start with the given prefix. Values which are not numbers are ignored. 'prefix' must be an ordered container of elements whose length is defined. """
+        (node, _) = self.root.find_prefix_node(self._key(prefix))
+        if node is None:
+            return 0
+        if self.value_sums:
+            return node.value_sum
+        return sum(_numeric(value) for value in node.values())
+
+    def context_neighbours(self, ele, size=None):
+        """ Get the elements which share a context with a given element, optionally only in n-grams of a particular size. A context is an n-gram with one of its elements left out, so two elements share a context if replacing one with the other in an n-gram gives another n-gram in the mapping. Returns a dictionary mapping each neighbouring element to the number of contexts it shares with the given element. """
+        #Each occurrence of the element in an n-gram is a context whose other fillers are found by using the n-gram as a template with a place holder in place of the element.
+        neighbours = dict()
+        ngrams = self.ngrams_with_ele(ele) if size is None else self.sized_ngrams_with_ele(ele, size)
+        for ngram in list(ngrams):
+            for i in range(len(ngram)):
+                if ngram[i] == ele:
+                    for ngram_ in self.ngrams_by_template(ngram, { i }):
+                        neighbour = ngram_[i]
+                        if neighbour != ele:
+                            if neighbour not in neighbours:
+                                neighbours[neighbour] = 0
+                            neighbours[neighbour] += 1
+        return neighbours
+
+    def context_neighbour_table(self, size=None):
+        """ Get the elements which share a context with every element, optionally only in n-grams of a particular size, as described in context_neighbours(). Returns a dictionary mapping every element to the result of context_neighbours() on that element. """
+        #Group the elements of all the n-grams by the context they occur in, which is the n-gram with the element left out (split into what comes before and after it), in one pass over the n-grams.
+        fillers = dict()
+        ngrams = self.ngrams() if size is None else self.sized_ngrams(size)
+        for ngram in ngrams:
+            for i in range(len(ngram)):
+                context = (ngram[:i], ngram[i+1:])
+                if context not in fillers:
+                    fillers[context] = []
+                fillers[context].append(ngram[i])
+
+        #Every pair of elements which fill the same context are neighbours.
+        table = dict()
+        for context_fillers in fillers.values():
+            for ele in context_fillers:
+                if ele not in table:
+                    table[ele] = dict()
+                if len(context_fillers) > 1:
+                    neighbours = table[ele]
+                    for neighbour in context_fillers:
+                        if neighbour != ele:
+                            if neighbour not in neighbours:
+                                neighbours[neighbour] = 0
+                            neighbours[neighbour] += 1
+        return table
+
+    def values(self):
+        """ Get an iterator over all the values in the mapping. """
+        return self.root.values()
+
+    def items(self):
+        """ Get an iterator over all (n-gram, value) pairs in the mapping. """
+        if self.vocab is None:
+            return self.root.items()
+        return self.vocab.decode_all_items(self.root.items())
+
+    def __iter__(self):
+        """ Iterate over all the n-grams in the mapping. Returned n-grams are tuples. """
+        return self.ngrams()
+
+    def update(self, other, combine=None):
+        """ Add all n-grams from an n-gram map into this n-gram map. An n-gram which is already in this map is given the other map's value, or 'combine(this map's value, other map's value)' if 'combine' is given. Unlike merge(), the other map is left as it is. """
+        for (ngram, value) in other.items():
+            self.__merge_item(ngram, value, combine)
+
+    def __merge_item(self, ngram, value, combine):
+        """ Add an n-gram with a value, combining it with the n-gram's existing value as described in update(), walking the prefix tree only once. """
+        key = self._new_key(ngram)
+        nodes = list() if self.value_sums else None
+        node = self.root.make_node(key, self.vocab is not None, self.radix, nodes)
+        if not node.end_of_ngram:
+            self._record_ngram(key)
+            node.end_of_ngram = True
+        elif combine is not None:
+            value = combine(node.value, value)
+        if nodes is not None:
+            _add_value_sum(nodes, node.value, value)
+        node.value = value
+
+    def merge(self, other, combine=operator.add):
+        """ Merge another n-gram map into this n-gram map, where an n-gram found in both maps is given the value 'combine(this map's value, other map's value)' and any other n-gram keeps its value. If the other map is an NGramMap then its n-grams are moved rather than copied so it is left empty. The prefix trees are merged node by node, where the other map's subtrees which are missing from this map are taken over whole, unless this map keeps any optional indexes, element summary or query cache, or the nodes of the two maps keep different fields (such as value sums, a size index or an element summary), or either map is path compressed, in which case the n-grams are merged one by one. """
+        if not isinstance(other, NGramMap) or other is self:
+            for (ngram, value) in list(other.items()):
+                self.__merge_item(ngram, value, combine)
+            return
+        if self.radix or other.radix or self.ele_index is not None or self.position_index is not None or self.suffix_root is not None or self.ele_summary is not None or self.query_cache is not None or type(self.root) is not type(other.root):
+            for (ngram, value) in other.items():
+                self.__merge_item(ngram, value, combine)
+            other.clear()
+            return
+
+        #The other map's elements are translated into this map's keys if either map interns its elements, unless both maps happen to give the same IDs to the same elements.
+        if self.vocab is None:
+            ele_map = None if other.vocab is None else other.vocab.eles
+        elif other.vocab is None:
+            ele_map = { ele: self.vocab.encode_new((ele,))[0] for ele in other.ele_freqs }
+        else:
+            ele_map = [ ele_id for (ele_id,) in (self.vocab.encode_new((ele,)) for ele in other.vocab.eles) ]
+            if ele_map == list(range(len(ele_map))):
+                ele_map = None
+
+        #The other map's frequencies are added as a whole and then the n-grams found in both maps are dismissed once each as they are met.
+        for (size, freq) in other.size_freqs.items():
+            if size not in self.size_freqs:
+                self.size_freqs[size] = 0
+            self.size_freqs[size] += freq
+        for (ele, freq) in other.ele_freqs.items():
+            if ele_map is not None:
+                ele = ele_map[ele]
+            if ele not in self.ele_freqs:
+                self.ele_freqs[ele] = 0
+            self.ele_freqs[ele] += freq
+        self.__merge_nodes(self.root, other.root, list(), [ self.root ], combine, ele_map)
+        other.clear()
+
+    def __merge_nodes(self, node, other_node, path, nodes, combine, ele_map):
+        """ Merge a node of another map's prefix tree into the node with the same path in this map's prefix tree, as described in merge(), where 'path' is the list of keys leading to both nodes, 'nodes' is the list of this map's nodes along the path (ending with the node itself) and 'ele_map' translates the other map's keys into this map's keys (or is None if they are the same). """
+        #The other node's depth counts (and value sum) are added as a whole and then the n-grams found in both maps are discounted once each as they are met, as with the frequencies.
+        if self.size_index:
+            for (depth, count) in _depth_counts(other_node).items():
+                _add_depth(node, depth, count)
+        if self.value_sums:
+            node.value_sum += other_node.value_sum
+        if other_node.end_of_ngram:
+            if node.end_of_ngram:
+                value = combine(node.value, other_node.value)
+                if self.value_sums:
+                    _add_value_sum(nodes, _numeric(node.value) + _numeric(other_node.value), value)
+                node.value = value
+                self.size_freqs[len(path)] -= 1
+                for ele in path:
+                    self.ele_freqs[ele] -= 1
+                if self.size_index:
+                    depth = len(nodes)
+                    for path_node in nodes:
+                        depth -= 1
+                        _discard_depth(path_node, depth)
+            else:
+                node.end_of_ngram = True
+                node.value = other_node.value
+
+        for (ele, other_child) in other_node.children.items():
+            if ele_map is not None:
+                ele = ele_map[ele]
+            child = node.children.get(ele)
+            if child is None:
+                if ele_map is not None:
+                    self.__translate_keys(other_child, ele_map)
+                _add_child(node, ele, other_child, self.vocab is not None)
+            else:
+                path.append(ele)
+                nodes.append(child)
+                self.__merge_nodes(child, other_child, path, nodes, combine, ele_map)
+                nodes.pop()
+                path.pop()
+
+    def __translate_keys(self, node, ele_map):
+        """ Translate the keys of the children of every node in a subtree taken over from another map into this map's keys, as described in __merge_nodes(), keeping the nodes themselves. """
+        stack = [ node ]
+        compact = self.vocab is not None
+        while stack:
+            node = stack.pop()
+            children = node.children
+            if len(children) > 0:
+                node.children = _NO_CHILDREN
+                for (ele, child) in children.items():
+                    _add_child(node, ele_map[ele], child, compact)
+                    stack.append(child)
+
+    @staticmethod
+    def build_parallel(sequences, n_range, workers=None, combine=operator.add):
+        """ Create a new n-gram map which counts every n-gram of size n_range[0] to n_range[1] (inclusive) found in an iterable of token sequences, as in add_sequence(), using several processes. The sequences are shared out among 'workers' processes (or as many as there are CPUs if None), each of which counts its share into a separate map, and the maps are then merged node by node, where the values of n-grams found in more than one map are combined with 'combine'. Tokens must be picklable. """
+        (min_n, max_n) = n_range
+        if workers is None:
+            workers = os.cpu_count() or 1
+        sequences = list(sequences)
+        shards = [ (sequences[i::workers], min_n, max_n) for i in range(min(workers, len(sequences))) ]
+        ngram_map = NGramMap()
+        if len(shards) <= 1:
+            for tokens in sequences:
+                ngram_map.add_sequence(tokens, min_n, max_n)
+            return ngram_map
+
+        #Partial maps are sent back flattened and merged as soon as they arrive so that at most one partial map is held besides the merged one.
+        with multiprocessing.Pool(len(shards)) as pool:
+            for (flat_tree, size_freqs, ele_freqs) in pool.imap_unordered(_count_shard, shards):
+                partial_map = NGramMap()
+                partial_map.root = _NGramMapNode.unflatten(flat_tree)
+                partial_map.size_freqs = size_freqs
+                partial_map.ele_freqs = ele_freqs
+                ngram_map.merge(partial_map, combine)
+        return ngram_map
+
+    def freeze(self):
+        """ Get a read-only copy of this n-gram map as a FrozenNGramMap, which is compiled into flat arrays in order to take much less memory. """
+        return FrozenNGramMap(self)
+
+    def save(self, path):
+        """ Save a frozen copy of this n-gram map to a file which can be opened with NGramMap.open(), as described in FrozenNGramMap.save(). """
+        self.freeze().save(path)
+
+    @staticmethod
+    def open(path, mmap=True, allow_pickle=False):
+        """ Open an n-gram map saved to a file as a read-only FrozenNGramMap, as described in FrozenNGramMap.open(). A file with pickled elements or values is only opened if 'allow_pickle' is True, in which case it must come from a trusted source. """
+        return FrozenNGramMap.open(path, mmap, allow_pickle)
+
+    def publish(self, name=None):
+        """ Copy a frozen copy of this n-gram map into a new block of shared memory which other processes can attach to with NGramMap.attach(), as described in FrozenNGramMap.publish(). """
+        return self.freeze().publish(name)
+
+    @staticmethod
+    def attach(name, allow_pickle=False):
+        """ Attach to an n-gram map published in shared memory as a read-only FrozenNGramMap, as described in FrozenNGramMap.attach(). """
+        return FrozenNGramMap.attach(name, allow_pickle)
+
+    def clear(self):
+        """ Clear n-gram map of all n-grams. """
+        self.root = type(self.root)()
+        if self.vocab is not None:
+            self.vocab = _Vocabulary()
+        self.size_freqs = dict()
+        self.ele_freqs = dict()
+        if self.ele_index is not None:
+            self.ele_index = _EleIndex()
+        if self.position_index is not None:
+            self.position_index = _PositionIndex()
+        if self.suffix_root is not None:
+            self.suffix_root = type(self.suffix_root)()
+        if self.query_cache is not None:
+            self.query_cache.clear()
+
+    def __delitem__(self, ngram):
+        """ Remove an n-gram and associated value. 'ngram' must be an ordered container whose length is defined and whose elements are hashable. """
+        self.pop(ngram)
+
+    def __len__(self):
+        """ Get the number of n-grams in the mapping. """
+        return sum(self.size_freqs.values())
+
+    def num_of_size(self, size):
+        """ Get the number of n-grams of a given size in the mapping. """
+        return self.size_freqs[size]
+
+    def ngram_sizes(self):
+        """ Get the different sizes of n-grams contained in the mapping. """
+        return set(self.size_freqs)
+
+    def num_of_ele(self, ele):
+        """ Get the number of times a given element is found in the mapping. """
+        if self.vocab is None:
+            return self.ele_freqs[ele]
+        ele_id = self._ele_key(ele)
+        if ele_id not in self.ele_freqs:
+            raise KeyError(ele)
+        return self.ele_freqs[ele_id]
+
+    def ngram_eles(self):
+        """ Get the different elements of n-grams contained in the mapping. """
+        if self.vocab is None:
+            return set(self.ele_freqs)
+        return { self.vocab.eles[ele] for ele in self.ele_freqs }
+
+    def __eq__(self, other):
+        """ Check if this n-gram map has the same mappings as another n-gram map. """
+        for (ngram, value) in self.items():
+            if ngram not in other or other[ngram] != value:
+                return False
+        for (ngram, value) in other.items():
+            if ngram not in self or self[ngram] != value:
+                return False
+        return True
+
+    def len_of_size(self, size):
+        """ Get the number of n-grams of a given size in the mapping. """
+        return self.size_freqs[size]
+
+    def ngram_sizes(self):
+        """ Get the different sizes of n-grams contained in the mapping. """
+        return self.size_freqs.keys()
+
+    def __repr__(self):
+        """ Return a string representation of this n-gram map. """
+        return "NGramMap({" + (", ".join("%r: %r"%(ngram, value) for (ngram, value) in self.items())) + "})"
+
+    def __str__(self):
+        """ Return a string representation of this n-gram map. """
+        return "{" + (", ".join("%s: %s"%(ngram, value) for (ngram, value) in self.items())) + "}"
+
+def _count_shard(shard):
+    """ Count the n-grams of a share of token sequences in a worker process of NGramMap.build_parallel(), where 'shard' is a tuple of the sequences and the smallest and largest n-gram sizes, and return the flattened prefix tree (as described in _NGramMapNode.flatten()) and the size and element frequencies of the counted n-grams. For internal use only. """
+    (sequences, min_n, max_n) = shard
+    ngram_map = NGramMap()
+    for tokens in sequences:
+        ngram_map.add_sequence(tokens, min_n, max_n)
+    return (ngram_map.root.flatten(), ngram_map.size_freqs, ngram_map.ele_freqs)
+
+
+#############################################################################
+
+
+class FrozenNGramMap():
+    """ A read-only map of n-grams to values which is compiled from an NGramMap into flat arrays. N-grams are looked up in the same way as in an NGramMap, but the map takes much less memory at the cost of point-lookup speed, as looking up a single n-gram takes a binary search at every element below the first one. """
+
+    def __init__(self, ngram_map):
+        """ Create a frozen copy of an n-gram map. Later changes to the n-gram map do not affect the frozen copy. """
+        #The prefix tree is laid out in flat arrays with nodes numbered in breadth first order so that the children of every node are consecutive nodes.
+        #The children of node i are the nodes from first_child[i] to first_child[i+1]-1, sorted by the ID of the element which leads to them, which is found in node_ele.
+        #Elements are interned into integer IDs, reusing the n-gram map's vocabulary if it has one.
+        if ngram_map.vocab is not None:
+            self.eles = list(ngram_map.vocab.eles) #A list which maps each element ID to its element.
+            self.ids = dict(ngram_map.vocab.ids) #A dictionary which maps each element to its ID.
+        else:
+            self.eles = list()
+            self.ids = dict()
+        self.first_child = array.array('q') #An array which maps each node to its first child, with an extra entry at the end for the end of the last node's children.
+        self.node_ele = array.array('q', [ -1 ]) #An array which maps each node to the ID of the element which leads to it, where the root has none.
+        self.value_index = array.array('q') #An array which maps each node to the index of its value in 'ngram_values', or -1 if it is not the end of an n-gram.
+        self.size_freqs = dict(ngram_map.size_freqs) #A dictionary recording the frequencies of each n-gram size.
+
+        #Nodes of a radix tree are expanded back into chains of nodes, where a node is visited at every position of its run.
+        values = list()
+        pending = collections.deque([ (ngram_map.root, 0) ])
+        num_nodes = 1
+        while len(pending) > 0:
+            (node, run_index) = pending.popleft()
+            if run_index == len(node.run):
+                if node.end_of_ngram:
+                    self.value_index.append(len(values))
+                    values.append(node.value)
+                else:
+                    self.value_index.append(-1)
+                children = sorted(( (self.__ele_id(ele, ngram_map.vocab), child, 0) for (ele, child) in node.children.items() ), key=lambda child:child[0])
+            else:
+                self.value_index.append(-1)
+                children = [ (self.__ele_id(node.run[run_index], ngram_map.vocab), node, run_index+1) ]
+
+            self.first_child.append(num_nodes)
+            for (ele_id, child, child_run_index) in children:
+                self.node_ele.append(ele_id)
+                pending.append((child, child_run_index))
+            num_nodes += len(children)
+        self.first_child.append(num_nodes)
+
+        self.ngram_values = _typed_values(values) #The values of the n-grams, kept in an array if they are all integers or all floats.
+    def __ele_id(self, ele, vocab):
+        """ Helper method to __init__() which gets the ID of an element of the n-gram map, interning it if the n-gram map does not have a vocabulary. """
+        if vocab is not None:
+            return ele
+        ele_id = self.ids.get(ele)
+        if ele_id is None:
+            ele_id = len(self.eles)
+            self.ids[ele] = ele_id
+            self.eles.append(ele)
+        return ele_id
+
+    def save(self, path):
+        """ Save this map to a file at 'path' in a binary format which can be opened with FrozenNGramMap.open(). Elements are saved as they are if they are all strings or all integers, and values if they are all strings, all integers or all floats. Otherwise they are pickled, so they must be picklable. """
+        (header, sections, section_table) = self.__file_sections()
+        with open(path, 'wb') as f:
+            f.write(header)
+            for (i, section) in enumerate(sections):
+                f.write(bytes(section_table[2*i] - f.tell()))
+                f.write(section)
+    def __file_sections(self):
+        """ Helper method to save() and publish() which gets the header of the binary format, the list of its sections and the table of the offset and size of each section. """
+        #The file starts with a header giving the offset and size of each section, followed by the sections, each starting at a multiple of 8 bytes.
+        #Arrays are saved as raw bytes so that they can be used from the file as they are, while the elements and any values which are not numbers are saved as described in _objects_section().
+        if isinstance(self.ngram_values, (array.array, memoryview)):
+            values_typecode = ord(memoryview(self.ngram_values).format)
+            values_section = memoryview(self.ngram_values).tobytes()
+        else:
+            values_typecode = 0
+            values_section = _objects_section(self.ngram_values)
+        sections = [
+            memoryview(self.first_child).tobytes(),
+            memoryview(self.node_ele).tobytes(),
+            memoryview(self.value_index).tobytes(),
+            values_section,
+            _objects_section(self.eles),
+            _size_freqs_section(self.size_freqs),
+        ]
+        section_table = list()
+        offset = _FILE_HEADER.size
+        for section in sections:
+            offset += -offset % 8
+            section_table.extend([ offset, len(section) ])
+            offset += len(section)
+        header = _FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, _FILE_BYTE_ORDER_MARK, values_typecode, *section_table)
+        return (header, sections, section_table)
+
+    @classmethod
+    def open(cls, path, mmap=True, allow_pickle=False):
+        """ Open a map saved to a file at 'path' with save(). If 'mmap' is True then the file is memory mapped and its arrays are used directly from the mapped pages, so that opening takes the same time regardless of the size of the map and processes which open the same file share its pages. Otherwise the file is read into memory. Either way the vocabulary and values which are not numbers are only loaded when first needed. Elements and values which are not all strings or all numbers are pickled in the file, and unpickling data can run arbitrary code, so by default a file with pickled parts is rejected with a ValueError and files of strings and numbers can be opened safely whatever their source. If 'allow_pickle' is True then pickled parts are loaded as well, in which case the file must come from a trusted source. """
+        with open(path, 'rb') as f:
+            if mmap:
+                data = memoryview(mmap_module.mmap(f.fileno(), 0, access=mmap_module.ACCESS_READ))
+            else:
+                data = memoryview(f.read())
+        return cls.__from_data(data, allow_pickle)
+
+    def publish(self, name=None):
+        """ Copy this map into a new block of shared memory in the binary format of save(), so that other processes can attach to it with FrozenNGramMap.attach() and share its memory instead of each keeping a copy of the map. The block is named 'name', or given a unique name if None. Returns the multiprocessing.shared_memory.SharedMemory block, whose 'name' attribute is passed to attach(), and which must be closed and unlinked by the caller when the map is no longer needed. """
+        (header, sections, section_table) = self.__file_sections()
+        block = multiprocessing.shared_memory.SharedMemory(name=name, create=True, size=section_table[-2] + section_table[-1])
+        block.buf[:len(header)] = header
+        for (i, section) in enumerate(sections):
+            block.buf[section_table[2*i]:section_table[2*i]+len(section)] = section
+        return block
+
+    @classmethod
+    def attach(cls, name, allow_pickle=False):
+        """ Attach to a map published in shared memory by publish() under the given name, getting a read-only map whose arrays are used directly from the shared memory as with a memory mapped file in open(). The vocabulary and values which are not numbers are loaded into each process which uses them, where 'allow_pickle' is as described in open(). Processes should be started by the publishing process with multiprocessing (in a pool for example), so that the shared memory is left for the publishing process to unlink. """
+        try:
+            block = _AttachedBlock(name=name, track=False)
+        except TypeError:
+            #Before Python 3.13 attaching always registers the block with the resource tracker, which is shared with the publishing process if it started this one.
+            block = _AttachedBlock(name=name)
+        frozen = cls.__from_data(block.buf, allow_pickle)
+        frozen._shared_memory = block #The shared memory block, kept open for as long as the map is used.
+        return frozen
+
+    @classmethod
+    def __from_data(cls, data, allow_pickle):
+        """ Helper method to open() and attach() which puts a map together from the contents of a file in the binary format of save(), given as a memoryview. """
+        if len(data) < _FILE_HEADER.size:
+            raise ValueError("not an n-gram map file")
+        (magic, version, byte_order_mark, values_typecode, *section_table) = _FILE_HEADER.unpack_from(data)
+        if magic != _FILE_MAGIC:
+            raise ValueError("not an n-gram map file")
+        if version != _FILE_VERSION:
+            raise ValueError("unsupported n-gram map file version %d"%version)
+        if byte_order_mark != _FILE_BYTE_ORDER_MARK:
+            raise ValueError("n-gram map file was saved on a machine with a different byte order")
+        sections = [ data[section_table[2*i]:section_table[2*i]+section_table[2*i+1]] for i in range(len(section_table)//2) ]
+
+        #The frozen map is put together from the sections without being compiled from an n-gram map.
+        frozen = cls.__new__(cls)
+        frozen.first_child = sections[0].cast('q')
+        frozen.node_ele = sections[1].cast('q')
+        frozen.value_index = sections[2].cast('q')
+        frozen.size_freqs = _section_size_freqs(sections[5])
+        frozen._unloaded_sections = { 'eles': sections[4] } #The sections of the file of objects which have not been loaded yet.
+        if values_typecode != 0:
+            frozen.ngram_values = sections[3].cast(chr(values_typecode))
+        else:
+            frozen._unloaded_sections['ngram_values'] = sections[3]
+        if not allow_pickle:
+            for (name, section) in frozen._unloaded_sections.items():
+                if _SECTION_CODE.unpack_from(section)[0] == _PICKLED_SECTION:
+                    raise ValueError("n-gram map file has pickled %s, which can run arbitrary code when loaded; pass allow_pickle=True to open it if it comes from a trusted source"%('elements' if name == 'eles' else 'values'))
+        return frozen
+
+    def __getattr__(self, name):
+        """ Load the parts of a map opened from a file which are only loaded when first needed, namely its vocabulary and its values if they were pickled, and make the dictionary of the children of the root on the first point lookup. """
+        #This is only called for attributes which have not been set yet.
+        if name in ('eles', 'ngram_values') and '_unloaded_sections' in self.__dict__:
+            setattr(self, name, _section_objects(self._unloaded_sections.pop(name)))
+        elif name == 'ids' and '_unloaded_sections' in self.__dict__:
+            self.ids = { ele: ele_id for (ele_id, ele) in enumerate(self.eles) }
+        elif name == 'root_children':
+            self.root_children = { self.eles[self.node_ele[child]]: child for child in range(self.first_child[0], self.first_child[1]) } #A dictionary which maps the first element of every n-gram to the child of the root which it leads to.
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def _find_node(self, ngram):
+        """ Get the node at the end of the path of an n-gram, or -1 if there is no such path. """
+        #N-gram is consumed element by element from first to last, finding the child of the current node for each element by binary search.
+        #The root, which has the most children by far, is skipped with a dictionary lookup of the first element instead, and the only child of a node is compared directly without a binary search.
+        eles = iter(ngram)
+        for ele in eles:
+            node = self.root_children.get(ele, -1)
+            if node == -1:
+                return -1
+            break
+        else:
+            return 0
+        ids = self.ids
+        first_child = self.first_child
+        node_ele = self.node_ele
+        for ele in eles:
+            #An element without an ID is given the ID -1, which does not lead anywhere.
+            ele_id = ids.get(ele, -1)
+            start = first_child[node]
+            end = first_child[node+1]
+            if end - start == 1:
+                node = start
+            else:
+                node = bisect.bisect_left(node_ele, ele_id, start, end)
+                if node == end:
+                    return -1
+            if node_ele[node] != ele_id:
+                return -1
+        return node
+
+    def _find_nodes(self, rows, ids=False):
+        """ Get the nodes at the end of the paths of a batch of n-grams, given as a list of n-grams (or of ordered containers of element IDs if 'ids' is True), as a list in which n-grams without a path have -1. """
+        #The n-grams are followed together level by level, where each level moves every n-gram which is still being followed one node down.
+        #N-grams which share a prefix share the same transition at each level, which is found by binary search (after looking up the element's ID) only once per level.
+        first_child = self.first_child
+        node_ele = self.node_ele
+        bisect_left = bisect.bisect_left
+        get_id = None if ids else self.ids.get
+        nodes = [ 0 ]*len(rows)
+        following = range(len(rows))
+        level = 0
+        while len(following) > 0:
+            next_following = list()
+            transitions = dict()
+            for i in following:
+                row = rows[i]
+                if level == len(row):
+                    continue
+                transition = (nodes[i], row[level])
+                child = transitions.get(transition)
+                if child is None:
+                    (node, ele_id) = transition
+                    if get_id is not None:
+                        ele_id = get_id(ele_id, -1)
+                    end = first_child[node+1]
+                    child = bisect_left(node_ele, ele_id, first_child[node], end)
+                    if child == end or node_ele[child] != ele_id:
+                        child = -1
+                    transitions[transition] = child
+                nodes[i] = child
+                if child != -1:
+                    next_following.append(i)
+            following = next_following
+            level += 1
+        return nodes
+
+    def ngram_ids(self, ngram):
+        """ Get the tuple of the IDs of the elements of an n-gram, where elements which are not in the map are given the ID -1. """
+        ids = self.ids
+        return tuple([ ids.get(ele, -1) for ele in ngram ])
+
+    def get_many(self, ngrams, default=None, ids=False):
+        """ Get the values associated with a batch of n-grams as a list, with 'default' in place of the value of every n-gram which does not exist. 'ngrams' must be an iterable of n-grams. If 'ids' is True then each n-gram is given as an ordered container of the IDs of its elements instead (see ngram_ids()), such as a row of an array. """
+        value_index = self.value_index
+        ngram_values = self.ngram_values
+        return [ default if node == -1 or value_index[node] == -1 else ngram_values[value_index[node]] for node in self._find_nodes(list(ngrams), ids) ]
+
+    def contains_many(self, ngrams, ids=False):
+        """ Check if each n-gram in a batch of n-grams exists in the mapping, returning a list of booleans. 'ngrams' must be an iterable of n-grams. If 'ids' is True then each n-gram is given as an ordered container of the IDs of its elements instead (see ngram_ids()), such as a row of an array. """
+        value_index = self.value_index
+        return [ node != -1 and value_index[node] != -1 for node in self._find_nodes(list(ngrams), ids) ]
+
+    def __getitem__(self, ngram):
+        """ Get the value associated with an n-gram. 'ngram' must be an ordered container whose length is defined and whose elements are hashable. """
+        node = self._find_node(ngram)
+
+        #If n-gram does not exist then raise an error.
+        if node == -1 or self.value_index[node] == -1:
+            raise KeyError(ngram)
+        return self.ngram_values[self.value_index[node]]
+
+    def __contains__(self, ngram):
+        """ Check if an n-gram exists in the mapping. 'ngram' must be an ordered container whose length is defined and whose elements are hashable. """
+        node = self._find_node(ngram)
+        return node != -1 and self.value_index[node] != -1
+
+    def ngrams(self):
+        """ Get an iterator over all the n-grams in the mapping. Returned n-grams are tuples. """
+        return self.__ngrams(0, ())
+    def __ngrams(self, node, partial_ngram):
+        """ Helper method to ngrams(). """
+        #An n-gram is constructed element by element and passed on to each of the child nodes, as in an NGramMap.
+        if self.value_index[node] != -1:
+            yield partial_ngram
+        for child in range(self.first_child[node], self.first_child[node+1]):
+            for ngram in self.__ngrams(child, partial_ngram+(self.eles[self.node_ele[child]],)):
+                yield ngram
+
+    def sized_ngrams(self, size):
+        """ Get an iterator over all the n-grams of a particular size in the mapping. Returned n-grams are tuples. """
+        return self.__sized_ngrams(0, size, ())
+    def __sized_ngrams(self, node, size_left, partial_ngram):
+        """ Helper method to sized_ngrams(). """
+        #Stop recursion when the n-gram is of the requested size since any further recursion can only lead to longer n-grams than requested.
+        if size_left == 0:
+            if self.value_index[node] != -1:
+                yield partial_ngram
+        elif size_left > 0:
+            for child in range(self.first_child[node], self.first_child[node+1]):
+                for ngram in self.__sized_ngrams(child, size_left-1, partial_ngram+(self.eles[self.node_ele[child]],)):
+                    yield ngram
+
+    def ngrams_with_ele(self, target):
+        """ Get an iterator over all the n-grams which contain the given target element. 'target' must be an element. Returned n-grams are tuples. """
+        target_id = self.ids.get(target)
+        if target_id is None:
+            return iter(())
+        return self.__ngrams_with_ele(0, target_id, (), False)
+    def __ngrams_with_ele(self, node, target_id, partial_ngram, found):
+        """ Helper method to ngrams_with_ele(). """
+        #When the target element has been added to the constructed n-gram, every n-gram below is yielded, as in an NGramMap.
+        if found and self.value_index[node] != -1:
+            yield partial_ngram
+        for child in range(self.first_child[node], self.first_child[node+1]):
+            ele_id = self.node_ele[child]
+            for ngram in self.__ngrams_with_ele(child, target_id, partial_ngram+(self.eles[ele_id],), found or ele_id == target_id):
+                yield ngram
+
+    def ngrams_by_template(self, ngram_template, placeholder_indices):
+        """ Get an iterator over all the n-grams which match an n-gram template consisting of elements, some of which will be ignored as place holders. Place holders are elements which can be substituted by any element. The indices of the place holders must be specified. Returned n-grams are tuples. """
+        return self.__ngrams_by_template(0, ngram_template, placeholder_indices, 0, ())
+    def __ngrams_by_template(self, node, ngram_template, placeholder_indices, curr_index, partial_ngram):
+        """ Helper method to ngrams_by_template(). """
+        #If all the n-gram template was followed completely and this is a terminating node then yield the n-gram constructed so far.
+        if curr_index == len(ngram_template):
+            if self.value_index[node] != -1:
+                yield partial_ngram
+        #If the next element in the n-gram template is a place holder, go through every child of the current node as the next element in the n-gram.
+        elif curr_index in placeholder_indices:
+            for child in range(self.first_child[node], self.first_child[node+1]):
+                for ngram in self.__ngrams_by_template(child, ngram_template, placeholder_indices, curr_index+1, partial_ngram+(self.eles[self.node_ele[child]],)):
+                    yield ngram
+        #If the next element in the n-gram template is not a place holder, go through the child which is associated with that element.
+        else:
+            next_ele = ngram_template[curr_index]
+            child = self.__find_child(node, next_ele)
+            if child != -1:
+                for ngram in self.__ngrams_by_template(child, ngram_template, placeholder_indices, curr_index+1, partial_ngram+(next_ele,)):
+                    yield ngram
+    def __find_child(self, node, ele):
+        """ Helper method to __ngrams_by_template() which gets the child of a node which an element leads to, or -1 if there is no such child. """
+        ele_id = self.ids.get(ele, -1)
+        end = self.first_child[node+1]
+        child = bisect.bisect_left(self.node_ele, ele_id, self.first_child[node], end)
+        if child == end or self.node_ele[child] != ele_id:
+            return -1
+        return child
+
+    def values(self):
+        """ Get an iterator over all the values in the mapping, in the same order as the n-grams of ngrams() and items(). """
+        #Values are stored in breadth first order so the nodes are walked depth first, as in items(), but without making the n-grams.
+        value_index = self.value_index
+        first_child = self.first_child
+        ngram_values = self.ngram_values
+        stack = [ 0 ]
+        while stack:
+            node = stack.pop()
+            if value_index[node] != -1:
+                yield ngram_values[value_index[node]]
+            stack.extend(range(first_child[node+1]-1, first_child[node]-1, -1))
+
+    def items(self):
+        """ Get an iterator over all (n-gram, value) pairs in the mapping. """
+        #Values are stored in the same breadth first order as the n-grams' nodes so every n-gram's value is found through its node.
+        for (ngram, value_index) in self.__nodes(0, ()):
+            yield (ngram, self.ngram_values[value_index])
+    def __nodes(self, node, partial_ngram):
+        """ Helper method to items() which yields every n-gram together with the index of its value. """
+        if self.value_index[node] != -1:
+            yield (partial_ngram, self.value_index[node])
+        for child in range(self.first_child[node], self.first_child[node+1]):
+            for item in self.__nodes(child, partial_ngram+(self.eles[self.node_ele[child]],)):
+                yield item
+
+    def __iter__(self):
+        """ Iterate over all the n-grams in the mapping. Returned n-grams are tuples. """
+        return self.ngrams()
+
+    def __len__(self):
+        """ Get the number of n-grams in the mapping. """
+        return sum(self.size_freqs.values())
+
+    def num_of_size(self, size):
+        """ Get the number of n-grams of a given size in the mapping. """
+        return self.size_freqs[size]
+
+    def ngram_sizes(self):
+        """ Get the different sizes of n-grams contained in the mapping. """
+        return set(self.size_freqs)
+
+    def __eq__(self, other):
+        """ Check if this n-gram map has the same mappings as another n-gram map. """
+        for (ngram, value) in self.items():
+            if ngram not in other or other[ngram] != value:
+                return False
+        for (ngram, value) in other.items():
+            if ngram not in self or self[ngram] != value:
+                return False
+        return True
+
+    def __repr__(self):
+        """ Return a string representation of this n-gram map. """
+        return "FrozenNGramMap({" + (", ".join("%r: %r"%(ngram, value) for (ngram, value) in self.items())) + "})"
+
+    def __str__(self):
+        """ Return a string representation of this n-gram map. """
+        return "{" + (", ".join("%s: %s"%(ngram, value) for (ngram, value) in self.items())) + "}"
+
+
+#The layout of the header of a file of a saved FrozenNGramMap: magic bytes, version, byte order mark, type code of the values (0 if they are saved as objects) and then the offset and size of each of its 6 sections.
+_FILE_HEADER = struct.Struct('=8sQQQ12Q')
+_FILE_MAGIC = b'NGRAMMAP'
+_FILE_VERSION = 2
+_FILE_BYTE_ORDER_MARK = 0x0102030405060708
+
+#The code at the start of a section of objects in a file, which tells how the objects are saved, as described in _objects_section().
+_SECTION_CODE = struct.Struct('=q')
+_PICKLED_SECTION = 0
+_STR_SECTION = 1
+_INT_SECTION = 2
+
+
+class _AttachedBlock(multiprocessing.shared_memory.SharedMemory):
+    """ A block of shared memory attached to by FrozenNGramMap.attach(). The arrays of the map are views of the block's memory which may outlive the block itself, in which case the memory is unmapped when the last view is released rather than when the block is garbage collected. For internal use only. """
+
+    def __del__(self):
+        """ Close the block, leaving its memory mapped if views of it are still in use. """
+        try:
+            self.close()
+        except BufferError:
+            if getattr(self, '_fd', -1) >= 0:
+                os.close(self._fd)
+                self._fd = -1
+
+
+def _objects_section(objects):
+    """ Get a list of objects as a section of a file, which starts with a code telling how they are saved: as an array of 64-bit integers if they are all integers, as their number followed by an array of the lengths of their UTF-8 encodings and the encodings themselves if they are all strings, and otherwise pickled. For internal use only. """
+    if all(type(obj) is int for obj in objects):
+        try:
+            return _SECTION_CODE.pack(_INT_SECTION) + array.array('q', objects).tobytes()
+        except OverflowError:
+            pass
+    elif all(type(obj) is str for obj in objects):
+        try:
+            encoded = [ obj.encode('utf-8') for obj in objects ]
+        except UnicodeEncodeError:
+            encoded = None
+        if encoded is not None:
+            return _SECTION_CODE.pack(_STR_SECTION) + _SECTION_CODE.pack(len(encoded)) + array.array('q', map(len, encoded)).tobytes() + b''.join(encoded)
+    return _SECTION_CODE.pack(_PICKLED_SECTION) + pickle.dumps(list(objects), pickle.HIGHEST_PROTOCOL)
+
+
+def _section_objects(section):
+    """ Get the list of objects in a section of a file made by _objects_section(), given as a memoryview. For internal use only. """
+    (code,) = _SECTION_CODE.unpack_from(section)
+    if code == _INT_SECTION:
+        return section[8:].cast('q').tolist()
+    if code == _STR_SECTION:
+        (num_objects,) = _SECTION_CODE.unpack_from(section, 8)
+        lengths = section[16:16+8*num_objects].cast('q')
+        encoded = bytes(section[16+8*num_objects:])
+        objects = list()
+        offset = 0
+        for length in lengths:
+            objects.append(encoded[offset:offset+length].decode('utf-8'))
+            offset += length
+        return objects
+    if code == _PICKLED_SECTION:
+        return pickle.loads(section[8:])
+    raise ValueError("n-gram map file has a section of an unknown kind")
+
+
+def _size_freqs_section(size_freqs):
+    """ Get a dictionary of the frequencies of each n-gram size as a section of a file, which is an array of 64-bit integers of (size, frequency) pairs. For internal use only. """
+    return array.array('q', [ num for item in sorted(size_freqs.items()) for num in item ]).tobytes()
+
+
+def _section_size_freqs(section):
+    """ Get the dictionary of the frequencies of each n-gram size in a section of a file made by _size_freqs_section(), given as a memoryview. For internal use only. """
+    nums = section.cast('q')
+    return { nums[i]: nums[i+1] for i in range(0, len(nums), 2) }
+
+
+def _typed_values(values):
+    """ Get a list of values as an array of 64-bit integers if they are all integers, or of doubles if they are all floats, and otherwise as the list itself. For internal use only. """
+    if all(type(value) is int for value in values):
+        try:
+            return array.array('q', values)
+        except OverflowError:
+            return values
+    if all(type(value) is float for value in values):
+        return array.array('d', values)
+    return values
+
+
+#############################################################################
+
+
+class NGramMapBuilder():
+    """ Count n-grams which may be too many to count in memory, by counting them in batches of a bounded number of distinct n-grams which are spilled to temporary files as sorted runs and merged together at the end, either into an NGramMap or straight into a file which can be opened with NGramMap.open(). """
+
+    def __init__(self, max_ngrams=1000000, temp_dir=None):
+        """ Create a new builder which keeps at most 'max_ngrams' distinct n-grams in memory before spilling them to a temporary file in 'temp_dir' (or the default temporary directory if None). Only the distinct elements of the n-grams are kept in memory throughout. """
+        self.max_ngrams = max_ngrams
+        self.temp_dir = temp_dir
+        self.chunk_size = max(1, max_ngrams//_MAX_MERGED_RUNS) #The number of (n-gram, count) pairs in each pickled chunk of a run, such that merging the most runs which are merged at once takes about as much memory as counting.
+        self.vocab = _Vocabulary() #A vocabulary of interned elements, with n-grams being counted as tuples of element IDs.
+        self.counts = dict() #A dictionary which maps the n-grams counted since the last spill to their counts.
+        self.runs = list() #A list of temporary files, each of which has a sorted run of n-grams and their counts.
+
+    def count_ngrams(self, ngrams):
+        """ Count the n-grams in an iterable of n-grams, incrementing the count of each n-gram by 1 every time it is encountered. """
+        for ngram in ngrams:
+            key = self.vocab.encode_new(ngram)
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if len(self.counts) >= self.max_ngrams:
+                self.__spill()
+
+    def add_sequence(self, tokens, min_n, max_n):
+        """ Count every n-gram of size 'min_n' to 'max_n' (inclusive, with 1 <= min_n <= max_n) which is found in a sequence of tokens, as in NGramMap.add_sequence(). """
+        keys = self.vocab.encode_new(tokens)
+        num_tokens = len(keys)
+        for start in range(num_tokens - min_n + 1):
+            for end in range(start + min_n, min(start + max_n, num_tokens) + 1):
+                key = keys[start:end]
+                self.counts[key] = self.counts.get(key, 0) + 1
+                if len(self.counts) >= self.max_ngrams:
+                    self.__spill()
+
+    def __spill(self):
+        """ Write the n-grams counted since the last spill to a new temporary file as a sorted run. """
+        self.runs.append(self.__write_run(sorted(self.counts.items())))
+        self.counts = dict()
+    def __write_run(self, items):
+        """ Helper method to __spill() and __merged_items() which writes sorted (n-gram, count) pairs to a new temporary file in pickled chunks and returns the file. """
+        run = tempfile.TemporaryFile(dir=self.temp_dir)
+        chunk = list()
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == self.chunk_size:
+                pickle.dump(chunk, run, pickle.HIGHEST_PROTOCOL)
+                chunk = list()
+        if len(chunk) > 0:
+            pickle.dump(chunk, run, pickle.HIGHEST_PROTOCOL)
+        return run
+    def __run_items(self, run):
+        """ Helper method to __merged_items() which gets an iterator over the (n-gram, count) pairs of a run, loading one chunk at a time. """
+        run.seek(0)
+        while True:
+            try:
+                chunk = pickle.load(run)
+            except EOFError:
+                return
+            for item in chunk:
+                yield item
+    def __merged_items(self):
+        """ Get an iterator over all the counted (n-gram, count) pairs in sorted order of the n-grams' element IDs, merging the runs with the n-grams counted since the last spill and adding up the counts of the same n-gram in different runs. """
+        #In order to bound the memory taken by the chunks being merged, runs are first merged into fewer, longer runs until few enough are left.
+        while len(self.runs) >= _MAX_MERGED_RUNS:
+            runs = self.runs[:_MAX_MERGED_RUNS]
+            merged_run = self.__write_run(self.__combined_items([ self.__run_items(run) for run in runs ]))
+            for run in runs:
+                run.close()
+            self.runs = self.runs[_MAX_MERGED_RUNS:] + [ merged_run ]
+        return self.__combined_items([ self.__run_items(run) for run in self.runs ] + [ iter(sorted(self.counts.items())) ])
+    def __combined_items(self, runs):
+        """ Helper method to __merged_items() which merges sorted iterators of (n-gram, count) pairs, adding up the counts of the same n-gram. """
+        (last_key, last_count) = (None, 0)
+        for (key, count) in heapq.merge(*runs):
+            if key == last_key:
+                last_count += count
+            else:
+                if last_key is not None:
+                    yield (last_key, last_count)
+                (last_key, last_count) = (key, count)
+        if last_key is not None:
+            yield (last_key, last_count)
+
+    def build(self, **options):
+        """ Get an NGramMap of all the counted n-grams, mapped to their counts. 'options' are passed on to NGramMap(). """
+        ngram_map = NGramMap(**options)
+        decode = self.vocab.decode
+        for (key, count) in self.__merged_items():
+            ngram_map[decode(key)] = count
+        return ngram_map
+
+    def save(self, path):
+        """ Save all the counted n-grams, mapped to their counts, to a file at 'path' which can be opened with NGramMap.open(), without ever having all of them in memory. """
+        #Since the merged n-grams come in sorted order, every node is first reached in depth first order and the nodes of each depth are reached in the order of their paths, which is the breadth first order of the nodes of a FrozenNGramMap.
+        #The arrays of each depth are therefore appended to as the nodes are reached and kept in temporary files, then concatenated depth by depth into the file.
+        #A node's value is known when it is reached since an n-gram comes before every other n-gram which it is a prefix of.
+        levels = list() #A list of (element IDs, values, number of children) arrays for the nodes of each depth after the root, where nodes which do not end an n-gram have a value of -1.
+        num_children = [ 0 ] #The number of children found so far of each node along the path of the last n-gram.
+        root_value = -1
+        size_freqs = dict()
+        num_values = 0
+        last_key = ()
+        try:
+            for (key, count) in self.__merged_items():
+                size_freqs[len(key)] = size_freqs.get(len(key), 0) + 1
+                num_values += 1
+                if len(key) == 0:
+                    root_value = count
+                    continue
+
+                #The nodes of the last n-gram's path which are not shared with this n-gram have all their children now.
+                shared = 0
+                max_shared = min(len(key), len(last_key))
+                while shared < max_shared and key[shared] == last_key[shared]:
+                    shared += 1
+                for depth in range(len(last_key), shared, -1):
+                    levels[depth-1][2].append(num_children.pop())
+
+                for depth in range(shared+1, len(key)+1):
+                    if depth > len(levels):
+                        levels.append(( _TempInts(self.temp_dir), _TempInts(self.temp_dir), _TempInts(self.temp_dir) ))
+                    num_children[-1] += 1
+                    num_children.append(0)
+                    levels[depth-1][0].append(key[depth-1])
+                    levels[depth-1][1].append(count if depth == len(key) else -1)
+                last_key = key
+            for depth in range(len(last_key), 0, -1):
+                levels[depth-1][2].append(num_children.pop())
+
+            self.__save_levels(path, levels, num_children[0], root_value, num_values, size_freqs)
+        finally:
+            for level in levels:
+                for ints in level:
+                    ints.close()
+    def __save_levels(self, path, levels, root_num_children, root_value, num_values, size_freqs):
+        """ Helper method to save() which writes the file from the arrays of each depth, in the format described in FrozenNGramMap.save(). """
+        num_nodes = 1 + sum(len(level[0]) for level in levels)
+        sections = [
+            (num_nodes + 1)*8,
+            num_nodes*8,
+            num_nodes*8,
+            num_values*8,
+            _objects_section(self.vocab.eles),
+            _size_freqs_section(size_freqs),
+        ]
+        section_table = list()
+        offset = _FILE_HEADER.size
+        for section in sections:
+            offset += -offset % 8
+            section_size = section if isinstance(section, int) else len(section)
+            section_table.extend([ offset, section_size ])
+            offset += section_size
+
+        #Every section is streamed from the arrays of the root followed by those of each depth in turn.
+        def first_children():
+            next_child = 1
+            for chunk in [ array.array('q', [ root_num_children ]) ] + [ chunk for level in levels for chunk in level[2].chunks() ]:
+                firsts = array.array('q')
+                for num_children in chunk:
+                    firsts.append(next_child)
+                    next_child += num_children
+                yield firsts
+            yield array.array('q', [ next_child ])
+        def node_eles():
+            yield array.array('q', [ -1 ])
+            for level in levels:
+                for chunk in level[0].chunks():
+                    yield chunk
+        def node_values():
+            yield array.array('q', [ root_value ])
+            for level in levels:
+                for chunk in level[1].chunks():
+                    yield chunk
+        def value_indexes():
+            next_index = 0
+            for chunk in node_values():
+                indexes = array.array('q')
+                for value in chunk:
+                    if value == -1:
+                        indexes.append(-1)
+                    else:
+                        indexes.append(next_index)
+                        next_index += 1
+                yield indexes
+        def values():
+            for chunk in node_values():
+                yield array.array('q', [ value for value in chunk if value != -1 ])
+
+        with open(path, 'wb') as f:
+            f.write(_FILE_HEADER.pack(_FILE_MAGIC, _FILE_VERSION, _FILE_BYTE_ORDER_MARK, ord('q'), *section_table))
+            for (i, section) in enumerate([ first_children(), node_eles(), value_indexes(), values() ] + sections[4:]):
+                f.write(bytes(section_table[2*i] - f.tell()))
+                if isinstance(section, bytes):
+                    f.write(section)
+                else:
+                    for chunk in section:
+                        chunk.tofile(f)
+
+    def close(self):
+        """ Delete the temporary files of the runs and forget all the counted n-grams. """
+        for run in self.runs:
+            run.close()
+        self.runs = list()
+        self.counts = dict()
+
+    def __enter__(self):
+        """ Use the builder in a with statement which closes it at the end. """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Close the builder at the end of a with statement. """
+        self.close()
+
+
+#The most runs which an NGramMapBuilder merges at once.
+_MAX_MERGED_RUNS = 16
+
+
+#############################################################################
+
+
+class ShardedNGramMap():
+    """ Map n-grams to values like an NGramMap, where the n-grams are shared out by their first element among several worker processes, each of which keeps its share in an NGramMap of its own and answers requests sent through a pipe. Requests about a single n-gram or a non-empty prefix go to one shard whereas other queries go to every shard side by side and their results are merged. N-grams, elements, values and results must be picklable. A sharded map must not be used by several threads at once. """
+
+    def __init__(self, num_shards=None, **options):
+        """ Create a new empty sharded n-gram map with 'num_shards' worker processes (or as many as there are CPUs if None), where 'options' are passed on to the NGramMap of every shard, such as 'ele_index=True'. The workers are stopped by close(), which is called at the end of a with statement. """
+        if num_shards is None:
+            num_shards = os.cpu_count() or 1
+        self.num_shards = num_shards
+        self.conns = list() #A list of the connections to the shards' worker processes.
+        self.processes = list() #A list of the shards' worker processes.
+        for _ in range(num_shards):
+            (conn, worker_conn) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_serve_shard, args=(worker_conn, options), daemon=True)
+            process.start()
+            worker_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    def shard_of(self, ngram):
+        """ Get the index of the shard which keeps an n-gram (or all the n-grams with a given non-empty prefix), which is chosen by the n-gram's first element. The empty n-gram is kept in shard 0. """
+        for ele in ngram:
+            return hash(ele) % self.num_shards
+        return 0
+
+    def __send_all(self, requests):
+        """ Send a list of (shard, request) pairs to the shards and return the list of their (kind, result) replies, as described in _serve_shard(). The requests are all sent before any reply is received so that the shards handle them side by side. """
+        for (shard, request) in requests:
+            self.conns[shard].send(request)
+        return [ self.conns[shard].recv() for (shard, _) in requests ]
+    def __results(self, replies):
+        """ Helper method to __send_all() which gets the results of a list of replies, raising the error of the first reply which is an error (only after all the replies have been received so that no reply is left behind in a pipe). """
+        for (kind, result) in replies:
+            if kind == 'error':
+                raise result
+        return [ result for (_, result) in replies ]
+
+    def __call(self, shard, name, *args):
+        """ Call a method of the n-gram map of one shard and return its result, which must not be an iterator. """
+        return self.__results(self.__send_all([ (shard, ('call', name, args)) ]))[0]
+
+    def __call_all(self, name, *args):
+        """ Call a method of the n-gram maps of all the shards side by side and return the list of their results, which must not be iterators. """
+        return self.__results(self.__send_all([ (shard, ('call', name, args)) for shard in range(self.num_shards) ]))
+
+    def __stream(self, shards, name, *args):
+        """ Get an iterator over the merged results of a method which returns an iterator, called in the n-gram maps of several shards. Each shard is asked for its next batch of results side by side and the batches are then yielded one after the other, so that no request is pending while the caller has control and the caller may send other requests to the shards during the iteration. """
+        iterators = list() #A list of (shard, iterator ID) pairs of the shards' iterators which are not exhausted yet.
+        batches = list()
+        try:
+            replies = self.__send_all([ (shard, ('call', name, args)) for shard in shards ])
+            for (shard, (kind, result)) in zip(shards, replies):
+                if kind == 'iterator':
+                    iterators.append((shard, result))
+                elif kind == 'value':
+                    batches.append(result)
+            self.__results(replies)
+            while True:
+                for batch in batches:
+                    yield from batch
+                if len(iterators) == 0:
+                    break
+                replies = self.__send_all([ (shard, ('next', iterator_id)) for (shard, iterator_id) in iterators ])
+                batches = self.__results(replies)
+                iterators = [ iterator for (iterator, batch) in zip(iterators, batches) if len(batch) == _SHARD_BATCH_SIZE ]
+        finally:
+            #An iterator which is abandoned (or fails) half way closes the shards' iterators.
+            if len(iterators) > 0:
+                self.__send_all([ (shard, ('close', iterator_id)) for (shard, iterator_id) in iterators ])
+
+    def __setitem__(self, ngram, value):
+        """ Assign a value to an n-gram, as described in NGramMap.__setitem__(). """
+        self.__call(self.shard_of(ngram), '__setitem__', ngram, value)
+
+    def increment(self, ngram, by=1):
+        """ Add 'by' to the value of an n-gram and return the new value, as described in NGramMap.increment(). """
+        return self.__call(self.shard_of(ngram), 'increment', ngram, by)
+
+    def count_ngrams(self, ngrams):
+        """ Count the n-grams in an iterable of n-grams, as described in NGramMap.count_ngrams(). The n-grams are sent to their shards in batches. """
+        batches = [ list() for _ in range(self.num_shards) ]
+        num_batched = 0
+        for ngram in ngrams:
+            batches[self.shard_of(ngram)].append(tuple(ngram))
+            num_batched += 1
+            if num_batched == _SHARD_BATCH_SIZE*self.num_shards:
+                self.__results(self.__send_all([ (shard, ('call', 'count_ngrams', (batch,))) for (shard, batch) in enumerate(batches) if len(batch) > 0 ]))
+                batches = [ list() for _ in range(self.num_shards) ]
+                num_batched = 0
+        self.__results(self.__send_all([ (shard, ('call', 'count_ngrams', (batch,))) for (shard, batch) in enumerate(batches) if len(batch) > 0 ]))
+
+    def add_sequence(self, tokens, min_n, max_n, count=True, value_fn=None):
+        """ Add every n-gram of size 'min_n' to 'max_n' found in a sequence of tokens, as described in NGramMap.add_sequence(). Every shard is sent the tokens together with the positions of the n-grams which it keeps. 'value_fn' must be picklable if given. """
+        tokens = list(tokens)
+        starts = [ list() for _ in range(self.num_shards) ]
+        for start in range(len(tokens) - min_n + 1):
+            starts[hash(tokens[start]) % self.num_shards].append(start)
+        self.__results(self.__send_all([ (shard, ('call', '_add_sequence_at', (tokens, shard_starts, min_n, max_n, count, value_fn))) for (shard, shard_starts) in enumerate(starts) if len(shard_starts) > 0 ]))
+
+    def pop(self, ngram):
+        """ Remove an n-gram and associated value, returning the value. """
+        return self.__call(self.shard_of(ngram), 'pop', ngram)
+
+    def __delitem__(self, ngram):
+        """ Remove an n-gram and associated value. """
+        self.__call(self.shard_of(ngram), 'pop', ngram)
+
+    def __getitem__(self, ngram):
+        """ Get the value associated with an n-gram. """
+        return self.__call(self.shard_of(ngram), '__getitem__', ngram)
+
+    def __contains__(self, ngram):
+        """ Check if an n-gram exists in the mapping. """
+        return self.__call(self.shard_of(ngram), '__contains__', ngram)
+
+    def get_many(self, ngrams, default=None):
+        """ Get the values associated with a batch of n-grams as a list, with 'default' in place of the value of every n-gram which does not exist. Each shard looks up its own n-grams side by side. """
+        return self.__many(ngrams, 'get_many', default)
+
+    def contains_many(self, ngrams):
+        """ Check if each n-gram in a batch of n-grams exists in the mapping, returning a list of booleans. Each shard looks up its own n-grams side by side. """
+        return self.__many(ngrams, 'contains_many')
+    def __many(self, ngrams, name, *args):
+        """ Helper method to get_many() and contains_many() which splits a batch of n-grams among the shards and puts the shards' results back in order. """
+        positions = [ list() for _ in range(self.num_shards) ]
+        batches = [ list() for _ in range(self.num_shards) ]
+        for (i, ngram) in enumerate(ngrams):
+            shard = self.shard_of(ngram)
+            positions[shard].append(i)
+            batches[shard].append(tuple(ngram))
+        shards = [ shard for shard in range(self.num_shards) if len(batches[shard]) > 0 ]
+        results = [ None ]*sum(len(batch) for batch in batches)
+        for (shard, shard_results) in zip(shards, self.__results(self.__send_all([ (shard, ('call', name, (batches[shard],) + args)) for shard in shards ]))):
+            for (i, result) in zip(positions[shard], shard_results):
+                results[i] = result
+        return results
+
+    def ngrams(self):
+        """ Get an iterator over all the n-grams in the mapping. Returned n-grams are tuples. """
+        return self.__stream(range(self.num_shards), 'ngrams')
+
+    def sized_ngrams(self, size):
+        """ Get an iterator over all the n-grams of a particular size in the mapping. Returned n-grams are tuples. """
+        return self.__stream(range(self.num_shards), 'sized_ngrams', size)
+
+    def ngrams_with_prefix(self, prefix, size=None):
+        """ Get an iterator over all the n-grams which start with the given prefix, optionally only those of a particular size, as described in NGramMap.ngrams_with_prefix(). """
+        prefix = tuple(prefix)
+        return self.__stream(self.__prefix_shards(prefix), 'ngrams_with_prefix', prefix, size)
+    def __prefix_shards(self, prefix):
+        """ Get the shards which keep the n-grams with a given prefix, which is one shard unless the prefix is empty. """
+        if len(prefix) > 0:
+            return [ self.shard_of(prefix) ]
+        return range(self.num_shards)
+
+    def ngrams_with_suffix(self, suffix, size=None):
+        """ Get an iterator over all the n-grams which end with the given suffix, optionally only those of a particular size, as described in NGramMap.ngrams_with_suffix(). """
+        return self.__stream(range(self.num_shards), 'ngrams_with_suffix', tuple(suffix), size)
+
+    def ngrams_with_ele(self, target):
+        """ Get an iterator over all the n-grams which contain the given target element. Returned n-grams are tuples. """
+        return self.__stream(range(self.num_shards), 'ngrams_with_ele', target)
+
+    def sized_ngrams_with_ele(self, target, size):
+        """ Get an iterator over all the n-grams of a particular size which contain the given target element. Returned n-grams are tuples. """
+        return self.__stream(range(self.num_shards), 'sized_ngrams_with_ele', target, size)
+
+    def ngrams_with_all_eles(self, targets):
+        """ Get an iterator over all the n-grams which contain all the given target elements in any order. Returned n-grams are tuples. """
+        return self.__stream(range(self.num_shards), 'ngrams_with_all_eles', set(targets))
+
+    def sized_ngrams_with_all_eles(self, targets, size):
+        """ Get an iterator over all the n-grams of a particular size which contain all the given target elements in any order. Returned n-grams are tuples. """
+        return self.__stream(range(self.num_shards), 'sized_ngrams_with_all_eles', set(targets), size)
+
+    def ngrams_by_template(self, ngram_template, placeholder_indices):
+        """ Get an iterator over all the n-grams which match an n-gram template, as described in NGramMap.ngrams_by_template(). A template whose first element is not a place holder goes to one shard. """
+        ngram_template = tuple(ngram_template)
+        return self.__stream(self.__template_shards(ngram_template, placeholder_indices), 'ngrams_by_template', ngram_template, set(placeholder_indices))
+    def __template_shards(self, ngram_template, placeholder_indices):
+        """ Get the shards which keep the n-grams which match an n-gram template. """
+        if len(ngram_template) > 0 and 0 not in placeholder_indices:
+            return [ self.shard_of(ngram_template) ]
+        return range(self.num_shards)
+
+    def count_with_prefix(self, prefix, size=None):
+        """ Get the number of n-grams which start with the given prefix, optionally only those of a particular size. """
+        prefix = tuple(prefix)
+        return sum(self.__results(self.__send_all([ (shard, ('call', 'count_with_prefix', (prefix, size))) for shard in self.__prefix_shards(prefix) ])))
+
+    def count_by_template(self, ngram_template, placeholder_indices):
+        """ Get the number of n-grams which match an n-gram template, as described in NGramMap.ngrams_by_template(). """
+        ngram_template = tuple(ngram_template)
+        return sum(self.__results(self.__send_all([ (shard, ('call', 'count_by_template', (ngram_template, set(placeholder_indices)))) for shard in self.__template_shards(ngram_template, placeholder_indices) ])))
+
+    def value_sum_with_prefix(self, prefix):
+        """ Get the sum of the numeric values of the n-grams which start with the given prefix. Values which are not numbers are ignored. """
+        prefix = tuple(prefix)
+        return sum(self.__results(self.__send_all([ (shard, ('call', 'value_sum_with_prefix', (prefix,))) for shard in self.__prefix_shards(prefix) ])))
+
+    def context_neighbours(self, ele, size=None):
+        """ Get the elements which share a context with a given element, as described in NGramMap.context_neighbours(). """
+        return NGramMap.context_neighbours(self, ele, size)
+
+    def context_neighbour_table(self, size=None):
+        """ Get the elements which share a context with every element, as described in NGramMap.context_neighbour_table(). """
+        return NGramMap.context_neighbour_table(self, size)
+
+    def values(self):
+        """ Get an iterator over all the values in the mapping. """
+        return self.__stream(range(self.num_shards), 'values')
+
+    def items(self):
+        """ Get an iterator over all (n-gram, value) pairs in the mapping. """
+        return self.__stream(range(self.num_shards), 'items')
+
+    def __iter__(self):
+        """ Iterate over all the n-grams in the mapping. Returned n-grams are tuples. """
+        return self.ngrams()
+
+    def clear(self):
+        """ Clear the sharded n-gram map of all n-grams. """
+        self.__call_all('clear')
+
+    def __len__(self):
+        """ Get the number of n-grams in the mapping. """
+        return sum(self.__call_all('__len__'))
+
+    def num_of_size(self, size):
+        """ Get the number of n-grams of a given size in the mapping. """
+        num = sum(size_freqs.get(size, 0) for size_freqs in self.__call_all('size_freqs'))
+        if num == 0:
+            raise KeyError(size)
+        return num
+
+    def ngram_sizes(self):
+        """ Get the different sizes of n-grams contained in the mapping. """
+        return set().union(*self.__call_all('size_freqs'))
+
+    def num_of_ele(self, ele):
+        """ Get the number of times a given element is found in the mapping. """
+        #A shard without the element raises a KeyError, which only matters if every shard does, whereas any other error is raised as in __results().
+        nums = list()
+        for (kind, result) in self.__send_all([ (shard, ('call', 'num_of_ele', (ele,))) for shard in range(self.num_shards) ]):
+            if kind == 'error':
+                if not isinstance(result, KeyError):
+                    raise result
+            else:
+                nums.append(result)
+        if len(nums) == 0:
+            raise KeyError(ele)
+        return sum(nums)
+
+    def ngram_eles(self):
+        """ Get the different elements of n-grams contained in the mapping. """
+        return set().union(*self.__call_all('ngram_eles'))
+
+    def __eq__(self, other):
+        """ Check if this n-gram map has the same mappings as another n-gram map. """
+        for (ngram, value) in self.items():
+            if ngram not in other or other[ngram] != value:
+                return False
+        for (ngram, value) in other.items():
+            if ngram not in self or self[ngram] != value:
+                return False
+        return True
+
+    def __repr__(self):
+        """ Return a string representation of this n-gram map. """
+        return "ShardedNGramMap({" + (", ".join("%r: %r"%(ngram, value) for (ngram, value) in self.items())) + "})"
+
+    def __str__(self):
+        """ Return a string representation of this n-gram map. """
+        return "{" + (", ".join("%s: %s"%(ngram, value) for (ngram, value) in self.items())) + "}"
+
+    def close(self):
+        """ Stop the worker processes, losing all the n-grams. """
+        for conn in self.conns:
+            conn.send(None)
+        for (conn, process) in zip(self.conns, self.processes):
+            process.join()
+            conn.close()
+        self.conns = list()
+        self.processes = list()
+
+    def __enter__(self):
+        """ Use the sharded map in a with statement which closes it at the end. """
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Close the sharded map at the end of a with statement. """
+        self.close()
+
+def _serve_shard(conn, options):
+    """ Keep the n-grams of one shard of a ShardedNGramMap in an NGramMap created with 'options' and serve the requests received through a connection until None is received. A ('call', method name, arguments) request calls a method of the map (or gets an attribute) and is answered with ('value', result), or with ('iterator', iterator ID) if the result is an iterator. A ('next', iterator ID) request is answered with ('items', list of the iterator's next results), where a list which is shorter than _SHARD_BATCH_SIZE means that the iterator is exhausted and forgotten. A ('close', iterator ID) request forgets an iterator and is answered with ('value', None). A request which raises an exception is answered with ('error', exception). For internal use only. """
+    ngram_map = NGramMap(**options)
+    iterators = dict()
+    next_iterator_id = 0
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        try:
+            if request[0] == 'call':
+                (_, name, args) = request
+                attribute = getattr(ngram_map, name)
+                result = attribute(*args) if callable(attribute) else attribute
+                if hasattr(result, '__next__'):
+                    iterators[next_iterator_id] = result
+                    reply = ('iterator', next_iterator_id)
+                    next_iterator_id += 1
+                else:
+                    reply = ('value', result)
+            elif request[0] == 'next':
+                batch = list(itertools.islice(iterators[request[1]], _SHARD_BATCH_SIZE))
+                if len(batch) < _SHARD_BATCH_SIZE:
+                    del iterators[request[1]]
+                reply = ('items', batch)
+            else:
+                iterators.pop(request[1], None)
+                reply = ('value', None)
+        except Exception as e:
+            if request[0] == 'next':
+                iterators.pop(request[1], None)
+            reply = ('error', e)
+        try:
+            conn.send(reply)
+        except Exception as e:
+            conn.send(('error', e))
+    conn.close()
+
+
+#The number of results which a shard of a ShardedNGramMap sends at a time when iterating.
+_SHARD_BATCH_SIZE = 1024
+
+
+#############################################################################
+
+
+class ConcurrentNGramMap():
+    """ Map n-grams to values like an NGramMap, where any number of threads may read and change the map at the same time. Readers work on a snapshot of the map which no later change affects, so that iterators never see the map changing under them. Changes never alter nodes which a snapshot may be using but copy the nodes along the paths of the n-grams they change into a new version of the prefix tree, which shares all other nodes with the old version, where a copied node with many children also shares its children with the old node. The n-grams are shared out by their first element among stripes, each with its own prefix tree and lock, so that writers only wait for each other when they change n-grams in the same stripe. """
+
+    def __init__(self, init_mapping=dict(), num_stripes=64):
+        """ Create a new concurrent n-gram map with 'num_stripes' stripes. 'init_mapping' is a dictionary which maps n-grams to values as an initialization to this mapping. """
+        self.num_stripes = num_stripes
+        self.stripes = tuple((_NGramMapNode(), dict()) for _ in range(num_stripes)) #A tuple of the current version of each stripe as a (prefix tree root, dictionary of the frequencies of each n-gram size) pair, which is replaced as a whole whenever a stripe changes so that it can be read without a lock.
+        self.stripe_locks = [ threading.Lock() for _ in range(num_stripes) ] #A list of locks, one per stripe, held while a new version of the stripe is made.
+        self.publish_lock = threading.Lock() #A lock held while a new version of a stripe replaces the old one in 'stripes'.
+
+        for ngram in init_mapping:
+            self[ngram] = init_mapping[ngram]
+
+    def snapshot(self):
+        """ Get a read-only snapshot of the map as it is now, which is not affected by later changes to the map. This takes constant time. """
+        return NGramMapSnapshot(self.stripes)
+
+    def __change(self, stripes_ngrams, change):
+        """ Make new versions of the stripes of a batch of n-grams, where 'stripes_ngrams' is a list of (stripe, list of n-grams) pairs and 'change' is called with the path copier of the n-grams' stripe and each n-gram, returning the list of the results of every call. Each stripe's new version replaces the old one once all its n-grams are changed, so that readers see all the changes to a stripe at once. """
+        results = list()
+        for (stripe, ngrams) in stripes_ngrams:
+            with self.stripe_locks[stripe]:
+                copier = _PathCopier(*self.stripes[stripe])
+                for ngram in ngrams:
+                    results.append(change(copier, ngram))
+                with self.publish_lock:
+                    stripes = list(self.stripes)
+                    stripes[stripe] = (copier.root, copier.size_freqs)
+                    self.stripes = tuple(stripes)
+        return results
+
+    def __setitem__(self, ngram, value):
+        """ Assign a value to an n-gram, overwriting the existing value if the n-gram exists. """
+        self.__change([ (_stripe_of(ngram, self.num_stripes), [ ngram ]) ], lambda copier, ngram:copier.set(ngram, value))
+
+    def increment(self, ngram, by=1):
+        """ Add 'by' to the value of an n-gram, where an n-gram which does not exist is taken to map to 0, and return the new value. """
+        return self.__change([ (_stripe_of(ngram, self.num_stripes), [ ngram ]) ], lambda copier, ngram:copier.increment(ngram, by))[0]
+
+    def count_ngrams(self, ngrams):
+        """ Count the n-grams in an iterable of n-grams by incrementing the value of each n-gram by 1 every time it is encountered, where an n-gram which does not exist is taken to map to 0. The n-grams of each stripe are counted in a single new version of the stripe. """
+        self.__change(_by_stripe((tuple(ngram) for ngram in ngrams), self.num_stripes), lambda copier, ngram:copier.increment(ngram, 1))
+
+    def add_sequence(self, tokens, min_n, max_n):
+        """ Count every n-gram of size 'min_n' to 'max_n' (inclusive, with 1 <= min_n <= max_n) which is found in a sequence of tokens, as in NGramMap.add_sequence(). The n-grams of each stripe are counted in a single new version of the stripe. """
+        tokens = tuple(tokens)
+        self.count_ngrams(tokens[start:end] for start in range(len(tokens) - min_n + 1) for end in range(start + min_n, min(start + max_n, len(tokens)) + 1))
+
+    def pop(self, ngram):
+        """ Remove an n-gram and associated value, returning the value. """
+        return self.__change([ (_stripe_of(ngram, self.num_stripes), [ ngram ]) ], lambda copier, ngram:copier.pop(ngram))[0]
+
+    def __delitem__(self, ngram):
+        """ Remove an n-gram and associated value. """
+        self.pop(ngram)
+
+    def clear(self):
+        """ Clear the map of all n-grams. """
+        for stripe in range(self.num_stripes):
+            with self.stripe_locks[stripe]:
+                with self.publish_lock:
+                    stripes = list(self.stripes)
+                    stripes[stripe] = (_NGramMapNode(), dict())
+                    self.stripes = tuple(stripes)
+
+    def __getitem__(self, ngram):
+        """ Get the value associated with an n-gram. """
+        return self.snapshot()[ngram]
+
+    def __contains__(self, ngram):
+        """ Check if an n-gram exists in the mapping. """
+        return ngram in self.snapshot()
+
+    def get_many(self, ngrams, default=None):
+        """ Get the values associated with a batch of n-grams as a list, as described in NGramMapSnapshot.get_many(). """
+        return self.snapshot().get_many(ngrams, default)
+
+    def contains_many(self, ngrams):
+        """ Check if each n-gram in a batch of n-grams exists in the mapping, as described in NGramMapSnapshot.contains_many(). """
+        return self.snapshot().contains_many(ngrams)
+
+    def ngrams(self):
+        """ Get an iterator over all the n-grams in a snapshot of the mapping. Returned n-grams are tuples. """
+        return self.snapshot().ngrams()
+
+    def sized_ngrams(self, size):
+        """ Get an iterator over all the n-grams of a particular size in a snapshot of the mapping. Returned n-grams are tuples. """
+        return self.snapshot().sized_ngrams(size)
+
+    def ngrams_with_prefix(self, prefix, size=None):
+        """ Get an iterator over all the n-grams in a snapshot of the mapping which start with the given prefix, as described in NGramMap.ngrams_with_prefix(). """
+        return self.snapshot().ngrams_with_prefix(prefix, size)
+
+    def ngrams_with_suffix(self, suffix, size=None):
+        """ Get an iterator over all the n-grams in a snapshot of the mapping which end with the given suffix, as described in NGramMap.ngrams_with_suffix(). """
+        return self.snapshot().ngrams_with_suffix(suffix, size)
+
+    def ngrams_with_ele(self, target):
+        """ Get an iterator over all the n-grams in a snapshot of the mapping which contain the given target element. Returned n-grams are tuples. """
+        return self.snapshot().ngrams_with_ele(target)
+
+    def ngrams_with_all_eles(self, targets):
+        """ Get an iterator over all the n-grams in a snapshot of the mapping which contain all the given target elements in any order. Returned n-grams are tuples. """
+        return self.snapshot().ngrams_with_all_eles(targets)
+
+    def ngrams_by_template(self, ngram_template, placeholder_indices):
+        """ Get an iterator over all the n-grams in a snapshot of the mapping which match an n-gram template, as described in NGramMap.ngrams_by_template(). """
+        return self.snapshot().ngrams_by_template(ngram_template, placeholder_indices)
+
+    def values(self):
+        """ Get an iterator over all the values in a snapshot of the mapping. """
+        return self.snapshot().values()
+
+    def items(self):
+        """ Get an iterator over all (n-gram, value) pairs in a snapshot of the mapping. """
+        return self.snapshot().items()
+
+    def __iter__(self):
+        """ Iterate over all the n-grams in a snapshot of the mapping. Returned n-grams are tuples. """
+        return self.ngrams()
+
+    def __len__(self):
+        """ Get the number of n-grams in the mapping. """
+        return len(self.snapshot())
+
+    def num_of_size(self, size):
+        """ Get the number of n-grams of a given size in the mapping. """
+        return self.snapshot().num_of_size(size)
+
+    def ngram_sizes(self):
+        """ Get the different sizes of n-grams contained in the mapping. """
+        return self.snapshot().ngram_sizes()
+
+    def __eq__(self, other):
+        """ Check if a snapshot of this n-gram map has the same mappings as another n-gram map. """
+        return self.snapshot() == other
+
+    def __repr__(self):
+        """ Return a string representation of this n-gram map. """
+        return "ConcurrentNGramMap({" + (", ".join("%r: %r"%(ngram, value) for (ngram, value) in self.items())) + "})"
+
+    def __str__(self):
+        """ Return a string representation of this n-gram map. """
+        return str(self.snapshot())
+
+
+class NGramMapSnapshot():
+    """ A read-only snapshot of a ConcurrentNGramMap, which keeps the versions of the map's prefix trees at the time of the snapshot. N-grams are looked up in the same way as in an NGramMap. """
+
+    def __init__(self, stripes):
+        """ Create a snapshot of the stripes of a ConcurrentNGramMap, as described in ConcurrentNGramMap.__init__(). """
+        self.stripes = stripes #A tuple of the (prefix tree root, dictionary of the frequencies of each n-gram size) pair of each stripe, which must never be changed.
+
+    def __root(self, ngram):
+        """ Get the root of the prefix tree of the stripe of an n-gram (or of all the n-grams with a given non-empty prefix). """
+        return self.stripes[_stripe_of(ngram, len(self.stripes))][0]
+
+    def __getitem__(self, ngram):
+        """ Get the value associated with an n-gram. """
+        return self.__root(ngram)[ngram]
+
+    def __contains__(self, ngram):
+        """ Check if an n-gram exists in the mapping. """
+        return ngram in self.__root(ngram)
+
+    def get_many(self, ngrams, default=None):
+        """ Get the values associated with a batch of n-grams as a list, with 'default' in place of the value of every n-gram which does not exist. """
+        values = list()
+        for ngram in ngrams:
+            node = self.__root(ngram).find_node(ngram)
+            values.append(node.value if node is not None and node.end_of_ngram else default)
+        return values
+
+    def contains_many(self, ngrams):
+        """ Check if each n-gram in a batch of n-grams exists in the mapping, returning a list of booleans. """
+        return [ ngram in self.__root(ngram) for ngram in ngrams ]
+
+    def ngrams(self):
+        """ Get an iterator over all the n-grams in the mapping. Returned n-grams are tuples. """
+        return itertools.chain.from_iterable(root.ngrams() for (root, _) in self.stripes)
+
+    def sized_ngrams(self, size):
+        """ Get an iterator over all the n-grams of a particular size in the mapping. Returned n-grams are tuples. """
+        return itertools.chain.from_iterable(root.sized_ngrams(size) for (root, _) in self.stripes)
+
+    def ngrams_with_prefix(self, prefix, size=None):
+        """ Get an iterator over all the n-grams which start with the given prefix, as described in NGramMap.ngrams_with_prefix(). A non-empty prefix is only searched for in its own stripe. """
+        prefix = tuple(prefix)
+        if len(prefix) > 0:
+            return self.__root(prefix).ngrams_with_prefix(prefix, size)
+        return itertools.chain.from_iterable(root.ngrams_with_prefix(prefix, size) for (root, _) in self.stripes)
+
+    def ngrams_with_suffix(self, suffix, size=None):
+        """ Get an iterator over all the n-grams which end with the given suffix, as described in NGramMap.ngrams_with_suffix(). """
+        suffix = tuple(suffix)
+        return itertools.chain.from_iterable(root.ngrams_with_suffix(suffix, size) for (root, _) in self.stripes)
+
+    def ngrams_with_ele(self, target):
+        """ Get an iterator over all the n-grams which contain the given target element. Returned n-grams are tuples. """
+        return itertools.chain.from_iterable(root.ngrams_with_ele(target) for (root, _) in self.stripes)
+
+    def ngrams_with_all_eles(self, targets):
+        """ Get an iterator over all the n-grams which contain all the given target elements in any order. Returned n-grams are tuples. """
+        return itertools.chain.from_iterable(root.ngrams_with_all_eles(targets) for (root, _) in self.stripes)
+
+    def ngrams_by_template(self, ngram_template, placeholder_indices):
+        """ Get an iterator over all the n-grams which match an n-gram template, as described in NGramMap.ngrams_by_template(). A template whose first element is not a place holder is only searched for in its own stripe. """
+        if len(ngram_template) > 0 and 0 not in placeholder_indices:
+            return self.__root(ngram_template).ngrams_by_template(ngram_template, placeholder_indices)
+        return itertools.chain.from_iterable(root.ngrams_by_template(ngram_template, placeholder_indices) for (root, _) in self.stripes)
+
+    def values(self):
+        """ Get an iterator over all the values in the mapping. """
+        return itertools.chain.from_iterable(root.values() for (root, _) in self.stripes)
+
+    def items(self):
+        """ Get an iterator over all (n-gram, value) pairs in the mapping. """
+        return itertools.chain.from_iterable(root.items() for (root, _) in self.stripes)
+
+    def __iter__(self):
+        """ Iterate over all the n-grams in the mapping. Returned n-grams are tuples. """
+        return self.ngrams()
+
+    def __len__(self):
+        """ Get the number of n-grams in the mapping. """
+        return sum(sum(size_freqs.values()) for (_, size_freqs) in self.stripes)
+
+    def num_of_size(self, size):
+        """ Get the number of n-grams of a given size in the mapping. """
+        num = sum(size_freqs.get(size, 0) for (_, size_freqs) in self.stripes)
+        if num == 0:
+            raise KeyError(size)
+        return num
+
+    def ngram_sizes(self):
+        """ Get the different sizes of n-grams contained in the mapping. """
+        return set().union(*(size_freqs for (_, size_freqs) in self.stripes))
+
+    def __eq__(self, other):
+        """ Check if this snapshot has the same mappings as another n-gram map. """
+        for (ngram, value) in self.items():
+            if ngram not in other or other[ngram] != value:
+                return False
+        for (ngram, value) in other.items():
+            if ngram not in self or self[ngram] != value:
+                return False
+        return True
+
+    def __repr__(self):
+        """ Return a string representation of this snapshot. """
+        return "NGramMapSnapshot({" + (", ".join("%r: %r"%(ngram, value) for (ngram, value) in self.items())) + "})"
+
+    def __str__(self):
+        """ Return a string representation of this snapshot. """
+        return "{" + (", ".join("%s: %s"%(ngram, value) for (ngram, value) in self.items())) + "}"
+
+class PersistentNGramMap(NGramMapSnapshot):
+    """ An immutable map of n-grams to values, where changing the map gives a new version of it and leaves the old version as it was. A new version shares every node of the prefix tree which is not on the path of a changed n-gram with the old version, so it only takes as much extra memory as the nodes along the changed paths (see ConcurrentNGramMap), and versions which are no longer used are garbage collected as usual. N-grams are looked up in the same way as in an NGramMap. """
+
+    def __init__(self, init_mapping=dict(), num_stripes=64):
+        """ Create a new persistent n-gram map with 'num_stripes' stripes (as described in ConcurrentNGramMap). 'init_mapping' is a dictionary which maps n-grams to values as an initialization to this mapping. """
+        stripes = tuple((_NGramMapNode(), dict()) for _ in range(num_stripes))
+        if len(init_mapping) > 0:
+            stripes = self.__changed(stripes, _by_stripe(init_mapping, num_stripes), lambda copier, ngram:copier.set(ngram, init_mapping[ngram]))[0]
+        NGramMapSnapshot.__init__(self, stripes)
+
+    @staticmethod
+    def __changed(stripes, stripes_ngrams, change):
+        """ Make new versions of the stripes of a batch of n-grams, where 'stripes_ngrams' is a list of (stripe, list of n-grams) pairs and 'change' is called with the path copier of the n-grams' stripe and each n-gram. Returns the new tuple of stripes together with the list of the results of every call. """
+        stripes = list(stripes)
+        results = list()
+        for (stripe, ngrams) in stripes_ngrams:
+            copier = _PathCopier(*stripes[stripe])
+            for ngram in ngrams:
+                results.append(change(copier, ngram))
+            stripes[stripe] = (copier.root, copier.size_freqs)
+        return (tuple(stripes), results)
+
+    def __version(self, stripes_ngrams, change):
+        """ Get a new version of this map where a batch of n-grams are changed, as described in __changed(). """
+        version = PersistentNGramMap.__new__(PersistentNGramMap)
+        NGramMapSnapshot.__init__(version, self.__changed(self.stripes, stripes_ngrams, change)[0])
+        return version
+
+    def set(self, ngram, value):
+        """ Get a new version of this map where an n-gram is assigned a value, overwriting the existing value if the n-gram exists. """
+        return self.__version([ (_stripe_of(ngram, len(self.stripes)), [ ngram ]) ], lambda copier, ngram:copier.set(ngram, value))
+
+    def increment(self, ngram, by=1):
+        """ Get a new version of this map where 'by' is added to the value of an n-gram, where an n-gram which does not exist is taken to map to 0. """
+        return self.__version([ (_stripe_of(ngram, len(self.stripes)), [ ngram ]) ], lambda copier, ngram:copier.increment(ngram, by))
+
+    def count_ngrams(self, ngrams):
+        """ Get a new version of this map where the n-grams in an iterable of n-grams are counted, by incrementing the value of each n-gram by 1 every time it is encountered. The nodes along the paths of all the n-grams are copied at most once. """
+        return self.__version(_by_stripe((tuple(ngram) for ngram in ngrams), len(self.stripes)), lambda copier, ngram:copier.increment(ngram, 1))
+
+    def add_sequence(self, tokens, min_n, max_n):
+        """ Get a new version of this map where every n-gram of size 'min_n' to 'max_n' (inclusive, with 1 <= min_n <= max_n) which is found in a sequence of tokens is counted, as in NGramMap.add_sequence(). """
+        tokens = tuple(tokens)
+        return self.count_ngrams(tokens[start:end] for start in range(len(tokens) - min_n + 1) for end in range(start + min_n, min(start + max_n, len(tokens)) + 1))
+
+    def pop(self, ngram):
+        """ Get a new version of this map where an n-gram is removed. The n-gram's value can still be found in this version. """
+        return self.__version([ (_stripe_of(ngram, len(self.stripes)), [ ngram ]) ], lambda copier, ngram:copier.pop(ngram))
+
+    def snapshot(self):
+        """ Get a snapshot of this map, which is the map itself since it never changes. """
+        return self
+
+    def __repr__(self):
+        """ Return a string representation of this n-gram map. """
+        return "PersistentNGramMap({" + (", ".join("%r: %r"%(ngram, value) for (ngram, value) in self.items())) + "})"
+
+def _stripe_of(ngram, num_stripes):
+    """ Get the stripe of an n-gram out of 'num_stripes' stripes, which is chosen by the n-gram's first element, where the empty n-gram is in stripe 0. For internal use only. """
+    for ele in ngram:
+        return hash(ele) % num_stripes
+    return 0
+
+
+def _by_stripe(ngrams, num_stripes):
+    """ Group an iterable of n-grams by their stripe out of 'num_stripes' stripes, returning a list of (stripe, list of n-grams) pairs. For internal use only. """
+    stripes_ngrams = dict()
+    for ngram in ngrams:
+        stripe = _stripe_of(ngram, num_stripes)
+        if stripe not in stripes_ngrams:
+            stripes_ngrams[stripe] = list()
+        stripes_ngrams[stripe].append(ngram)
+    return list(stripes_ngrams.items())
+
+
+class _PathCopier():
+    """ Make a new version of a prefix tree which must not be changed since readers may be using it, by copying the nodes along the paths of the changed n-grams (path copying) so that the new version shares every other node with the old one. Nodes which were copied (or created) by the same path copier are changed in place, so that a batch of changes copies every node at most once. For internal use only. """
+
+    def __init__(self, root, size_freqs):
+        """ Start a new version of a prefix tree with a given root and dictionary of the frequencies of each n-gram size. """
+        self.copied = set() #A set of the IDs of the nodes which belong only to the new version, all of which are kept alive by the new version.
+        self.root = self.__copy(root) #The root of the new version of the prefix tree.
+        self.size_freqs = dict(size_freqs) #A dictionary recording the frequencies of each n-gram size in the new version.
+
+    def __copy(self, node):
+        """ Get a copy of a node with a copy of its children mapping, which belongs to the new version. A node with many children gets a _SharedChildren, which shares its contents with the old node's instead of copying them all. """
+        copy = _NGramMapNode()
+        copy.end_of_ngram = node.end_of_ngram
+        copy.value = node.value
+        if type(node.children) is _SharedChildren:
+            copy.children = node.children.copy()
+        elif len(node.children) >= _MIN_SHARED_CHILDREN:
+            copy.children = _SharedChildren(node.children.items())
+        elif len(node.children) > 0:
+            copy.children = dict(node.children)
+        self.copied.add(id(copy))
+        return copy
+
+    def __copy_path(self, ngram, make):
+        """ Copy the nodes along the path of an n-gram which do not belong to the new version yet, also creating any missing nodes if 'make' is True, so that they can be changed in place. """
+        node = self.root
+        for ele in ngram:
+            child = node.children.get(ele)
+            if child is None:
+                if not make:
+                    return
+                child = _add_child(node, ele, _NGramMapNode(), False)
+                self.copied.add(id(child))
+            elif id(child) not in self.copied:
+                child = self.__copy(child)
+                node.children[ele] = child
+            node = child
+
+    def set(self, ngram, value):
+        """ Assign a value to an n-gram in the new version. """
+        self.__copy_path(ngram, True)
+        node = self.root.make_node(ngram)
+        if not node.end_of_ngram:
+            self.__record(len(ngram), 1)
+            node.end_of_ngram = True
+        node.value = value
+
+    def increment(self, ngram, by):
+        """ Add 'by' to the value of an n-gram in the new version, where an n-gram which does not exist is taken to map to 0, and return the new value. """
+        self.__copy_path(ngram, True)
+        node = self.root.make_node(ngram)
+        if node.end_of_ngram:
+            node.value += by
+        else:
+            self.__record(len(ngram), 1)
+            node.end_of_ngram = True
+            node.value = by
+        return node.value
+
+    def pop(self, ngram):
+        """ Remove an n-gram from the new version, returning its value. """
+        self.__copy_path(ngram, False)
+        value = self.root.pop(ngram)
+        self.__record(len(ngram), -1)
+        return value
+
+    def __record(self, size, change):
+        """ Change the frequency of an n-gram size in the new version. """
+        freq = self.size_freqs.get(size, 0) + change
+        if freq == 0:
+            self.size_freqs.pop(size)
+        else:
+            self.size_freqs[size] = freq
+
+
+#The number of children from which a node copied by a path copier keeps them in a _SharedChildren rather than a dictionary, below which copying the dictionary is cheaper than using it.
+_MIN_SHARED_CHILDREN = 64
+
+#The number of bits of an element's hash which pick its slot in each level of a _SharedChildren, the mask of those bits, and the number of bits in a hash.
+_LEVEL_BITS = 5
+_LEVEL_MASK = (1 << _LEVEL_BITS) - 1
+_HASH_BITS = sys.hash_info.width
+
+#The number of children which share a slot of a _SharedChildren level before the slot is split into a new level.
+_BUCKET_SIZE = 16
+
+
+class _SharedChildren():
+    """ A mapping of elements to child nodes which takes the place of the children dictionary of a node copied by a path copier, and which is copied in constant time by sharing its contents with the copy. The children are kept in a hash array mapped trie of levels of slots picked by successive bits of each element's hash, where a slot holds either a level or a small read-only dictionary of children. Levels belong to the mapping which made them and are changed in place, while a level of another mapping is copied before it is changed, so changing a copy only copies the few levels on the way to the changed element rather than all the children. For internal use only. """
+
+    __slots__ = ('top', 'size', 'owner')
+
+    def __init__(self, items=()):
+        """ Create a new mapping from an iterable of (element, child node) pairs. """
+        self.owner = object() #A token marking the levels which belong to this mapping.
+        self.top = _HashLevel(self.owner) #The top level of the trie.
+        self.size = 0 #The number of children.
+        for (ele, child) in items:
+            self[ele] = child
+
+    def copy(self):
+        """ Get a copy of this mapping, which shares all its levels with this one. """
+        copy = _SharedChildren.__new__(_SharedChildren)
+        copy.owner = object()
+        copy.top = self.top
+        copy.size = self.size
+        return copy
+
+    def get(self, ele, default=None):
+        """ Get the child node of an element, or 'default' if there is no such child. """
+        ele_hash = hash(ele)
+        slot = self.top.slots[ele_hash & _LEVEL_MASK]
+        shift = _LEVEL_BITS
+        while type(slot) is _HashLevel:
+            slot = slot.slots[ele_hash >> shift & _LEVEL_MASK]
+            shift += _LEVEL_BITS
+        return slot.get(ele, default)
+
+    def __getitem__(self, ele):
+        """ Get the child node of an element. """
+        child = self.get(ele)
+        if child is None:
+            raise KeyError(ele)
+        return child
+
+    def __contains__(self, ele):
+        """ Check if an element leads to a child node. """
+        return self.get(ele) is not None
+
+    def __len__(self):
+        """ Get the number of child nodes. """
+        return self.size
+
+    def items(self):
+        """ Get an iterator over the (element, child node) pairs. """
+        stack = [ self.top ]
+        while stack:
+            for slot in stack.pop().slots:
+                if type(slot) is _HashLevel:
+                    stack.append(slot)
+                else:
+                    yield from slot.items()
+
+    def __iter__(self):
+        """ Iterate over the elements which lead to child nodes. """
+        return (ele for (ele, _) in self.items())
+
+    def keys(self):
+        """ Get an iterator over the elements which lead to child nodes. """
+        return iter(self)
+
+    def values(self):
+        """ Get an iterator over the child nodes. """
+        return (child for (_, child) in self.items())
+
+    def __own(self, level):
+        """ Get a level which belongs to this mapping in place of a given level, copying it if it belongs to another mapping. """
+        if level.owner is self.owner:
+            return level
+        return _HashLevel(self.owner, list(level.slots))
+
+    def __setitem__(self, ele, child):
+        """ Map an element to a child node, copying the levels on the way to the element which do not belong to this mapping. """
+        ele_hash = hash(ele)
+        self.top = level = self.__own(self.top)
+        shift = 0
+        while True:
+            index = ele_hash >> shift & _LEVEL_MASK
+            slot = level.slots[index]
+            shift += _LEVEL_BITS
+            if type(slot) is _HashLevel:
+                level.slots[index] = self.__own(slot)
+                level = level.slots[index]
+                continue
+
+            #The slot's dictionary may be shared with other mappings so it is copied with the change, unless it is full, in which case it is split into a new level (provided that the hash has bits left).
+            if ele in slot or len(slot) < _BUCKET_SIZE or shift >= _HASH_BITS:
+                if ele not in slot:
+                    self.size += 1
+                slot = dict(slot)
+                slot[ele] = child
+                level.slots[index] = slot
+                return
+            level.slots[index] = _HashLevel(self.owner)
+            level = level.slots[index]
+            for (other_ele, other_child) in slot.items():
+                other_index = hash(other_ele) >> shift & _LEVEL_MASK
+                if not level.slots[other_index]:
+                    level.slots[other_index] = dict()
+                level.slots[other_index][other_ele] = other_child
+
+    def __delitem__(self, ele):
+        """ Remove the child node of an element, copying the levels on the way to the element which do not belong to this mapping. """
+        ele_hash = hash(ele)
+        path = list() #A list of the (level, slot index) pairs on the way to the element.
+        slot = self.top
+        shift = 0
+        while type(slot) is _HashLevel:
+            index = ele_hash >> shift & _LEVEL_MASK
+            path.append((slot, index))
+            slot = slot.slots[index]
+            shift += _LEVEL_BITS
+        if ele not in slot:
+            raise KeyError(ele)
+
+        #The path is copied from the top down and then walked back up, where a level left empty is removed from the level above it.
+        slot = dict(slot)
+        del slot[ele]
+        slot = slot or _NO_CHILDREN
+        levels = list()
+        self.top = level = self.__own(self.top)
+        for (_, index) in path:
+            levels.append(level)
+            if len(levels) < len(path):
+                level.slots[index] = self.__own(level.slots[index])
+                level = level.slots[index]
+        for i in range(len(path) - 1, -1, -1):
+            levels[i].slots[path[i][1]] = slot
+            if slot or i == 0 or any(levels[i].slots):
+                break
+        self.size -= 1
+
+
+class _HashLevel():
+    """ A level of the hash array mapped trie of a _SharedChildren. For internal use only. """
+
+    __slots__ = ('owner', 'slots')
+
+    def __init__(self, owner, slots=None):
+        """ Create a new level belonging to the mapping with a given owner token, with a given list of slots or else empty slots. """
+        self.owner = owner #The owner token of the mapping which may change this level in place.
+        self.slots = [ _NO_CHILDREN ]*(_LEVEL_MASK + 1) if slots is None else slots #A list of slots, each being a level or a read-only dictionary of children.
+
+
+#############################################################################
+
+
+class AsyncNGramMap():
+    """ An asyncio interface to a ConcurrentNGramMap, whose bulk changes and searches are run in an executor so that they do not stall the event loop. Searches are async iterators over a snapshot of the map which pull their results from the executor a batch at a time, giving the event loop a turn between batches. Changes and lookups of single n-grams are quick and are run directly. """
+
+    def __init__(self, init_mapping=dict(), num_stripes=64, executor=None, batch_size=1024):
+        """ Create a new asynchronous n-gram map with 'num_stripes' stripes (as described in ConcurrentNGramMap), where 'init_mapping' is a dictionary which maps n-grams to values as an initialization to this mapping. Bulk work is run in 'executor', or in the event loop's default executor if it is None, and searches yield 'batch_size' results at a time. """
+        self.map = ConcurrentNGramMap(init_mapping, num_stripes) #The underlying concurrent map, which may also be used directly by other threads.
+        self.executor = executor
+        self.batch_size = batch_size
 
-        for ngram in init_mapping:
-            self[ngram] = init_mapping[ngram]
+    async def __run(self, function, *args):
+        """ Run a function in the executor and wait for its result. """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
 
-    def __setitem__(self, ngram, value):
-        """ Assign a value to an n-gram, overwriting the existing value if the n-gram exists. 'ngram' must be hashable and in an ordered container whose length is defined. """
-        ngram_size = len(ngram)
-        if ngram not in self:
-            #Record size of n-gram.
-            if ngram_size not in self.size_freqs:
-                self.size_freqs[ngram_size] = 0
-            self.size_freqs[ngram_size] += 1
+    async def __iterate(self, iterator):
+        """ Iterate asynchronously over an iterator over a snapshot of the map, which is advanced in the executor a batch of results at a time. """
+        while True:
+            batch = await self.__run(list, itertools.islice(iterator, self.batch_size))
+            for result in batch:
+                yield result
+            if len(batch) < self.batch_size:
+                return
 
-            #Record elements of n-gram.
-            for ele in ngram:
-                if ele not in self.ele_freqs:
-                    self.ele_freqs[ele] = 0
-                self.ele_freqs[ele] += 1
+    def snapshot(self):
+        """ Get a read-only snapshot of the map as it is now, as described in ConcurrentNGramMap.snapshot(). """
+        return self.map.snapshot()
 
-        self.root.__setitem__(ngram, value)
+    def __setitem__(self, ngram, value):
+        """ Assign a value to an n-gram, overwriting the existing value if the n-gram exists. """
+        self.map[ngram] = value
 
-    def pop(self, ngram):
-        """ Remove an n-gram and associated value, returning the value. 'ngram' must be hashable and in an ordered container whose length is defined. """
-        value = self.root.pop(ngram)
+    def increment(self, ngram, by=1):
+        """ Add 'by' to the value of an n-gram, where an n-gram which does not exist is taken to map to 0, and return the new value. """
+        return self.map.increment(ngram, by)
 
-        #Dismiss size of n-gram.
-        ngram_size = len(ngram)
-        self.size_freqs[ngram_size] -= 1
-        if self.size_freqs[ngram_size] == 0:
-            self.size_freqs.pop(ngram_size)
+    def pop(self, ngram):
+        """ Remove an n-gram and associated value, returning the value. """
+        return self.map.pop(ngram)
 
-        #Dismiss elements of n-gram.    
-        for ele in ngram:
-            self.ele_freqs[ele] -= 1
-            if self.ele_freqs[ele] == 0:
-                self.ele_freqs.pop(ele)
-        
-        return value
+    def __delitem__(self, ngram):
+        """ Remove an n-gram and associated value. """
+        self.map.pop(ngram)
 
     def __getitem__(self, ngram):
-        """ Get the value associated with an n-gram. 'ngram' must be an ordered container whose length is defined and whose elements are hashable. """
-        return self.root.__getitem__(ngram)
+        """ Get the value associated with an n-gram. """
+        return self.map[ngram]
 
     def __contains__(self, ngram):
-        """ Check if an n-gram exists in the mapping. 'ngram' must be an ordered container whose length is defined and whose elements are hashable. """
-        return ngram in self.root
+        """ Check if an n-gram exists in the mapping. """
+        return ngram in self.map
+
+    def __len__(self):
+        """ Get the number of n-grams in the mapping. """
+        return len(self.map)
+
+    async def count_ngrams(self, ngrams):
+        """ Count the n-grams in an iterable of n-grams in the executor, as described in ConcurrentNGramMap.count_ngrams(). """
+        await self.__run(self.map.count_ngrams, ngrams)
+
+    async def add_sequence(self, tokens, min_n, max_n):
+        """ Count every n-gram of size 'min_n' to 'max_n' (inclusive) which is found in a sequence of tokens in the executor, as described in NGramMap.add_sequence(). """
+        await self.__run(self.map.add_sequence, tokens, min_n, max_n)
+
+    async def add_batch(self, sequences, min_n, max_n):
+        """ Count every n-gram of size 'min_n' to 'max_n' (inclusive) which is found in each sequence of tokens in an iterable of sequences in the executor, as in add_sequence(). All the n-grams are counted in a single new version of each stripe. """
+        await self.__run(self.map.count_ngrams, (tokens[start:end] for tokens in map(tuple, sequences) for start in range(len(tokens) - min_n + 1) for end in range(start + min_n, min(start + max_n, len(tokens)) + 1)))
+
+    async def get_many(self, ngrams, default=None):
+        """ Get the values associated with a batch of n-grams as a list in the executor, as described in NGramMapSnapshot.get_many(). """
+        return await self.__run(self.map.get_many, ngrams, default)
+
+    async def contains_many(self, ngrams):
+        """ Check if each n-gram in a batch of n-grams exists in the mapping in the executor, as described in NGramMapSnapshot.contains_many(). """
+        return await self.__run(self.map.contains_many, ngrams)
 
     def ngrams(self):
-        """ Get an iterator over all the n-grams in the mapping. Returned n-grams are tuples. """
-        return self.root.ngrams()
+        """ Get an async iterator over all the n-grams in a snapshot of the mapping. Returned n-grams are tuples. """
+        return self.__iterate(self.map.ngrams())
 
     def sized_ngrams(self, size):
-        """ Get an iterator over all the n-grams of a particular size in the mapping. Returned n-grams are tuples. """
-        return self.root.sized_ngrams(size)
+        """ Get an async iterator over all the n-grams of a particular size in a snapshot of the mapping. Returned n-grams are tuples. """
+        return self.__iterate(self.map.sized_ngrams(size))
 
-    def ngrams_with_ele(self, target):
-        """ Get an iterator over all the n-grams which contain the given target element. 'target' must be an element. Returned n-grams are tuples. """
-        return self.root.ngrams_with_ele(target)
+    def ngrams_with_prefix(self, prefix, size=None):
+        """ Get an async iterator over all the n-grams in a snapshot of the mapping which start with the given prefix, as described in NGramMap.ngrams_with_prefix(). """
+        return self.__iterate(self.map.ngrams_with_prefix(prefix, size))
 
-    def sized_ngrams_with_ele(self, target, size):
-        """ Get an iterator over all the n-grams of a particular size which contain the given target element. 'target' must be an element. Returned n-grams are tuples. """
-        return self.root.sized_ngrams_with_ele(target, size)
+    def ngrams_with_suffix(self, suffix, size=None):
+        """ Get an async iterator over all the n-grams in a snapshot of the mapping which end with the given suffix, as described in NGramMap.ngrams_with_suffix(). """
+        return self.__iterate(self.map.ngrams_with_suffix(suffix, size))
 
-    def ngrams_with_all_eles(self, targets):
-        """ Get an iterator over all the n-grams which contain all the given target elements in any order. 'targets' must be a set of elements. Returned n-grams are tuples. """
-        return self.root.ngrams_with_all_eles(targets)
+    def ngrams_with_ele(self, target):
+        """ Get an async iterator over all the n-grams in a snapshot of the mapping which contain the given target element. Returned n-grams are tuples. """
+        return self.__iterate(self.map.ngrams_with_ele(target))
 
-    def sized_ngrams_with_all_eles(self, targets, size):
-        """ Get an iterator over all the n-grams of a particular size which contain all the given target elements in any order. 'targets' must be a set of elements. Returned n-grams are tuples. """
-        return self.root.sized_ngrams_with_all_eles(targets, size)
+    def ngrams_with_all_eles(self, targets):
+        """ Get an async iterator over all the n-grams in a snapshot of the mapping which contain all the given target elements in any order. Returned n-grams are tuples. """
+        return self.__iterate(self.map.ngrams_with_all_eles(targets))
 
     def ngrams_by_template(self, ngram_template, placeholder_indices):
-        """ Get an iterator over all the n-grams which match an n-gram template consisting of elements, some of which will be ignored as place holders. Place holders are elements that can be substituted by any element. The indices of the place holders must be specified. Returned n-grams are tuples. """
-        return self.root.ngrams_by_template(ngram_template, placeholder_indices)
+        """ Get an async iterator over all the n-grams in a snapshot of the mapping which match an n-gram template, as described in NGramMap.ngrams_by_template(). """
+        return self.__iterate(self.map.ngrams_by_template(ngram_template, placeholder_indices))
 
     def values(self):
-        """ Get an iterator over all the values in the mapping. """
-        return self.root.values()
+        """ Get an async iterator over all the values in a snapshot of the mapping. """
+        return self.__iterate(self.map.values())
 
     def items(self):
-        """ Get an iterator over all (n-gram, value) pairs in the mapping. """
-        return self.root.items()
+        """ Get an async iterator over all (n-gram, value) pairs in a snapshot of the mapping. """
+        return self.__iterate(self.map.items())
 
-    def __iter__(self):
-        """ Iterate over all the n-grams in the mapping. Returned n-grams are tuples. """
-        return self.root.ngrams()
+    def __aiter__(self):
+        """ Iterate asynchronously over all the n-grams in a snapshot of the mapping. Returned n-grams are tuples. """
+        return self.ngrams()
 
-    def update(self, other):
-        """ Add all n-grams from an n-gram map into this n-gram map. """
-        for (ngram, value) in other.items():
-            self[ngram] = value
+    def __repr__(self):
+        """ Return a string representation of this n-gram map. """
+        return "AsyncNGramMap({" + (", ".join("%r: %r"%(ngram, value) for (ngram, value) in self.map.items())) + "})"
 
-    def clear(self):
-        """ Clear n-gram map of all n-grams. """
-        self.root = _NGramMapNode()
-        self.size_freqs = dict()
-        self.ele_freqs = dict()
+    def __str__(self):
+        """ Return a string representation of this n-gram map. """
+        return str(self.map)
 
-    def __delitem__(self, ngram):
-        """ Remove an n-gram and associated value. 'ngram' must be an ordered container whose length is defined and whose elements are hashable. """
-        self.root.pop(ngram)
 
-    def __len__(self):
-        """ Get the number of n-grams in the mapping. """
-        return sum(self.size_freqs.values())
+#############################################################################
 
-    def num_of_size(self, size):
-        """ Get the number of n-grams of a given size in the mapping. """
-        return self.size_freqs[size]
 
-    def ngram_sizes(self):
-        """ Get the different sizes of n-grams contained in the mapping. """
-        return set(self.size_freqs)
+#A read-only empty dictionary shared by all childless nodes, which are the majority of nodes in a prefix tree, so that they do not each need an empty dictionary of their own.
+_NO_CHILDREN = types.MappingProxyType(dict())
 
-    def num_of_ele(self, ele):
-        """ Get the number of times a given element is found in the mapping. """
-        return self.ele_freqs[ele]
 
-    def ngram_eles(self):
-        """ Get the different elements of n-grams contained in the mapping. """
-        return set(self.ele_freqs)
+class _OneChild():
+    """ A read-only mapping with a single entry which takes the place of the children dictionary of a node with only one child in a compact prefix tree, being several times smaller than a dictionary. For internal use only. """
 
-    def __eq__(self, other):
-        """ Check if this n-gram map has the same mappings as another n-gram map. """
-        for (ngram, value) in self.items():
-            if ngram not in other or other[ngram] != value:
-                return False
-        for (ngram, value) in other.items():
-            if ngram not in self or self[ngram] != value:
-                return False
-        return True
+    __slots__ = ('ele', 'child')
 
-    def len_of_size(self, size):
-        """ Get the number of n-grams of a given size in the mapping. """
-        return self.size_freqs[size]
+    def __init__(self, ele, child):
+        """ Create a new mapping from an element to a child node. """
+        self.ele = ele
+        self.child = child
 
-    def ngram_sizes(self):
-        """ Get the different sizes of n-grams contained in the mapping. """
-        return self.size_freqs.keys()
+    def get(self, ele, default=None):
+        """ Get the child node of an element, or 'default' if there is no such child. """
+        return self.child if ele == self.ele else default
 
-    def __repr__(self):
-        """ Return a string representation of this n-gram map. """
-        return "NGramMap({" + (", ".join("%r: %r"%(ngram, value) for (ngram, value) in self.items())) + "})"
+    def __getitem__(self, ele):
+        """ Get the child node of an element. """
+        if ele == self.ele:
+            return self.child
+        raise KeyError(ele)
 
-    def __str__(self):
-        """ Return a string representation of this n-gram map. """
-        return "{" + (", ".join("%s: %s"%(ngram, value) for (ngram, value) in self.items())) + "}"
+    def __contains__(self, ele):
+        """ Check if an element leads to a child node. """
+        return ele == self.ele
+
+    def __iter__(self):
+        """ Iterate over the element which leads to the child node. """
+        return iter((self.ele,))
+
+    def __len__(self):
+        """ Get the number of child nodes, which is 1. """
+        return 1
 
+    def keys(self):
+        """ Get the element which leads to the child node. """
+        return (self.ele,)
 
-#############################################################################
+    def values(self):
+        """ Get the child node. """
+        return (self.child,)
+
+    def items(self):
+        """ Get the (element, child node) pair. """
+        return ((self.ele, self.child),)
+
+
+def _add_child(node, ele, child, compact):
+    """ Add a new child node under an element to a node's children and return the child. A node's first child is kept in a _OneChild if 'compact' is True or else in a new dictionary, replacing the shared empty dictionary. For internal use only. """
+    children = node.children
+    if children is _NO_CHILDREN:
+        node.children = _OneChild(ele, child) if compact else { ele: child }
+    elif type(children) is _OneChild:
+        node.children = { children.ele: children.child, ele: child }
+    else:
+        children[ele] = child
+    return child
+
+
+def _remove_child(node, ele):
+    """ Remove the child node under an element from a node's children. For internal use only. """
+    children = node.children
+    if len(children) == 1:
+        node.children = _NO_CHILDREN
+    else:
+        del children[ele]
+
+
+def _replace_child(node, ele, child):
+    """ Replace the child node under an element in a node's children with another node. For internal use only. """
+    if type(node.children) is _OneChild:
+        node.children = _OneChild(ele, child)
+    else:
+        node.children[ele] = child
+
+
+def _merge_only_child(parent, ele):
+    """ Merge the child node under an element of a node of a radix tree with its only child, provided that the child neither ends an n-gram nor branches, so that its only child takes its place with the child's run in front of its own. For internal use only. """
+    node = parent.children[ele]
+    if node.end_of_ngram or len(node.children) != 1:
+        return
+    ((child_ele, child),) = node.children.items()
+    child.run = node.run + (child_ele,) + child.run
+    _replace_child(parent, ele, child)
+
+
+def _depth_counts(node):
+    """ Get a dictionary of the number of n-grams ending at each depth below a node, as described in _NGramMapNode. For internal use only. """
+    if node.depth_counts is not None:
+        return node.depth_counts
+    depths = node.depths
+    return { depth: 1 for depth in range(depths.bit_length()) if depths >> depth & 1 }
+
+
+def _num_at_depth(node, depth):
+    """ Get the number of n-grams ending at a given depth below a node, which is 0 for a negative depth. For internal use only. """
+    if depth < 0:
+        return 0
+    if node.depth_counts is None:
+        return node.depths >> depth & 1
+    return node.depth_counts.get(depth, 0)
+
+
+def _add_depth(node, depth, count=1):
+    """ Count 'count' more n-grams ending at a given depth below a node, marking the depth in the node's depths. For internal use only. """
+    depth_bit = 1 << depth
+    if node.depths & depth_bit or count > 1:
+        if node.depth_counts is None:
+            node.depth_counts = _depth_counts(node)
+        node.depth_counts[depth] = node.depth_counts.get(depth, 0) + count
+    elif node.depth_counts is not None:
+        node.depth_counts[depth] = count
+    node.depths |= depth_bit
+
+
+def _discard_depth(node, depth):
+    """ Count one less n-gram ending at a given depth below a node, unmarking the depth in the node's depths when no n-gram ends there anymore. For internal use only. """
+    counts = node.depth_counts
+    if counts is not None:
+        counts[depth] -= 1
+        if counts[depth] > 0:
+            return
+        del counts[depth]
+        if len(counts) == 0:
+            node.depth_counts = None
+    node.depths &= ~(1 << depth)
+
+
+def _add_value_sum(nodes, old_value, new_value):
+    """ Record a change in the value of an n-gram from 'old_value' to 'new_value' in the value sums of the nodes along its path, where a value which is not a number counts as 0 (as does None, the value of a node which does not end an n-gram). For internal use only. """
+    difference = _numeric(new_value) - _numeric(old_value)
+    if difference != 0:
+        for node in nodes:
+            node.value_sum += difference
+
+
+#A marker for the end of an n-gram which has been consumed completely while following the run of a node.
+_NO_ELE = object()
 
 
 class _NGramMapNode():
-    """ A node in an n-gram prefix tree. For internal use only. """
-    
+    """ A node in an n-gram prefix tree, which only has the fields used by every prefix tree. The optional fields used by some prefix trees are kept by the subclasses given by _node_class(), where the nodes of a prefix tree are all of the same class. For internal use only. """
+
+    __slots__ = ('end_of_ngram', 'value', 'children')
+
+    #The optional fields as they are read in a node which does not have them.
+    run = () #A tuple of the elements which follow the element leading to this node in its path, used only in a radix tree where a chain of nodes which neither end an n-gram nor branch is compressed into its last node.
+    depths = -1 #A bit field marking the depths below this node at which n-grams end, where bit 0 stands for this node, bit 1 for its children, and so on, used only in a prefix tree with a size index. Every depth is marked in a node without a size index so that no subtree is ever skipped.
+    depth_counts = None #A dictionary of the number of n-grams ending at each marked depth below this node, so that a depth is unmarked as soon as its last n-gram is removed, or None if exactly one n-gram ends at each marked depth (which is the case for most nodes), used only in a prefix tree with a size index.
+    value_sum = 0 #The sum of the numeric values of the n-grams under this node (including itself), used only by a map which keeps value sums.
+    ele_summary = 0 #A bit field summarising the elements below this node, used only by an optional element summary, or None if it needs to be rebuilt.
+    optional_fields = () #A tuple of the names of the optional fields which the node has.
+    keeps_runs = False #Flag marking whether the node has a run.
+    keeps_depths = False #Flag marking whether the node has depths and depth counts.
+    keeps_value_sum = False #Flag marking whether the node has a value sum.
+    keeps_ele_summary = False #Flag marking whether the node has an element summary.
+
     def __init__(self):
         """ Create a new n-gram map node. """
         self.end_of_ngram = False #Flag marking whether this node is the end of an n-gram.
         self.value = None #Provided that the node marks the end of an n-gram, this refers to the value mapped by this n-gram.
-        self.children = dict() #A dictionary which maps the next elements in the current path of the prefix tree to the respective node of the tree.
+        self.children = _NO_CHILDREN #A dictionary which maps the next elements in the current path of the prefix tree to the respective node of the tree, shared and read-only until the node gets its first child.
+
+    def __getstate__(self):
+        """ Get the state of this node for pickling as a tuple of its fields followed by its optional fields, where the shared empty children mapping (which cannot be pickled) is replaced by None. """
+        return (self.end_of_ngram, self.value, None if self.children is _NO_CHILDREN else self.children) + tuple(getattr(self, field) for field in self.optional_fields)
+
+    def __setstate__(self, state):
+        """ Restore the state of this node after unpickling, as described in __getstate__(). """
+        (self.end_of_ngram, self.value, children) = state[:3]
+        self.children = _NO_CHILDREN if children is None else children
+        for (field, value) in zip(self.optional_fields, state[3:]):
+            setattr(self, field, value)
+
+    def flatten(self):
+        """ Get the subtree under this node of a prefix tree without any optional fields as a tuple of flat sequences, which is pickled much faster than the nodes themselves. The sequences hold the element leading to each node (None for this node), its number of children, whether it ends an n-gram and its value, with the nodes in depth first order. """
+        eles = list()
+        num_children = array.array('q')
+        ends = bytearray()
+        values = list()
+        stack = [ (None, self) ]
+        while stack:
+            (ele, node) = stack.pop()
+            eles.append(ele)
+            num_children.append(len(node.children))
+            ends.append(node.end_of_ngram)
+            values.append(node.value)
+            stack.extend(node.children.items())
+        return (eles, num_children, ends, values)
+
+    @staticmethod
+    def unflatten(flat_tree):
+        """ Rebuild a subtree flattened by flatten() and return its top node. """
+        #Garbage collection is paused while the nodes are made since they cannot form reference cycles and a large tree would otherwise set it off many times over.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return _NGramMapNode.__unflatten(flat_tree)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    @staticmethod
+    def __unflatten(flat_tree):
+        """ Rebuild a subtree flattened by flatten(), as described in unflatten(). """
+        (eles, num_children, ends, values) = flat_tree
+        top = None
+        parents = list() #A stack of [node, number of children left to rebuild] pairs.
+        for i in range(len(eles)):
+            node = _NGramMapNode()
+            if ends[i]:
+                node.end_of_ngram = True
+                node.value = values[i]
+            if parents:
+                parent = parents[-1]
+                _add_child(parent[0], eles[i], node, False)
+                parent[1] -= 1
+                if parent[1] == 0:
+                    parents.pop()
+            else:
+                top = node
+            if num_children[i] > 0:
+                parents.append([ node, num_children[i] ])
+        return top
         
+    def find_node(self, ngram):
+        """ Get the node at the end of the path of an n-gram starting from this node, or None if there is no such path. """
+        #N-gram is consumed element by element from first to last, moving one node down the tree for each element together with the run of elements of the node if it has one.
+        #No partial copies of the n-gram are made so any ordered container (such as a list or an array row) can be used.
+        node = self
+        if not self.keeps_runs:
+            for ele in ngram:
+                node = node.children.get(ele)
+                if node is None:
+                    return None
+            return node
+
+        eles = iter(ngram)
+        for ele in eles:
+            node = node.children.get(ele)
+            if node is None:
+                return None
+            if node.run:
+                for run_ele in node.run:
+                    if next(eles, _NO_ELE) != run_ele:
+                        return None
+        return node
+
+    def find_prefix_node(self, prefix):
+        """ Get the first node whose path starts with a prefix starting from this node together with its path as a tuple, which is longer than the prefix if the prefix ends in the middle of the node's run, or (None, None) if there is no such node. """
+        prefix = tuple(prefix)
+        prefix_size = len(prefix)
+        node = self
+        i = 0
+        while i < prefix_size:
+            node = node.children.get(prefix[i])
+            if node is None:
+                return (None, None)
+            i += 1
+            run = node.run
+            if run:
+                #The prefix may end before the run does, in which case the rest of the run is added to the path.
+                if prefix[i:i+len(run)] != run[:prefix_size-i]:
+                    return (None, None)
+                if i + len(run) > prefix_size:
+                    return (node, prefix + run[prefix_size-i:])
+                i += len(run)
+        return (node, prefix)
+
+    def make_node(self, ngram, compact=False, radix=False, nodes=None):
+        """ Get the node at the end of the path of an n-gram starting from this node in order to make it a terminating node, creating any missing nodes along the way (as described in _add_child()). If 'radix' is True then the prefix tree is kept path compressed. If 'nodes' is a list then the nodes along the path (from this node to the last) are appended to it. """
+        if radix:
+            return self.__make_radix_node(tuple(ngram), compact, nodes)
+
+        #N-gram is consumed element by element from first to last, creating a new child node whenever the next element does not lead anywhere.
+        #The path is only kept if it is needed afterwards.
+        node = self
+        #Outside a compact prefix tree the children of a node are either the shared empty mapping or a dictionary of its own, so a new child is added without the cost of a function call.
+        if nodes is None and not self.keeps_depths:
+            for ele in ngram:
+                children = node.children
+                child = children.get(ele)
+                if child is None:
+                    child = type(self)()
+                    if compact:
+                        _add_child(node, ele, child, compact)
+                    elif children is _NO_CHILDREN:
+                        node.children = { ele: child }
+                    else:
+                        children[ele] = child
+                node = child
+            return node
+
+        node_class = type(self)
+        #With a size index, if the n-gram is new then every node along the way counts an n-gram ending at the depth of the last node below it.
+        path = [ node ]
+        for ele in ngram:
+            child = node.children.get(ele)
+            if child is None:
+                child = _add_child(node, ele, node_class(), compact)
+            node = child
+            path.append(node)
+        #A depth which is not marked yet in a node without depth counts is simply marked, which is the most common case, without the cost of a function call.
+        if self.keeps_depths and not node.end_of_ngram:
+            depth = len(path)
+            for path_node in path:
+                depth -= 1
+                if path_node.depth_counts is None and not path_node.depths >> depth & 1:
+                    path_node.depths |= 1 << depth
+                else:
+                    _add_depth(path_node, depth)
+        if nodes is not None:
+            nodes.extend(path)
+        return node
+    def __make_radix_node(self, ngram, compact, nodes):
+        """ Helper method to make_node(). """
+        #N-gram is consumed run by run from first to last, creating a single new child node with the rest of the n-gram as its run whenever the next element does not lead anywhere.
+        #If the n-gram ends or diverges in the middle of a node's run then the node is split in two, where the first part takes the matching part of the run.
+        #With a size index, if the n-gram is new then every node along the way counts an n-gram ending at the depth of the last node below it, counted from the end of the node's run.
+        #The path (with the depth of the last node below each node) is only kept if it is needed afterwards.
+        ngram_size = len(ngram)
+        node_class = type(self)
+        node = self
+        path = [ (node, ngram_size) ] if self.keeps_depths or nodes is not None else None
+        i = 0
+        while i < ngram_size:
+            ele = ngram[i]
+            child = node.children.get(ele)
+            if child is None:
+                node = _add_child(node, ele, node_class(), compact)
+                node.run = ngram[i+1:]
+                if path is not None:
+                    path.append((node, 0))
+                break
+
+            run = child.run
+            run_size = len(run)
+            matched = 0
+            while matched < run_size and i + 1 + matched < ngram_size and ngram[i+1+matched] == run[matched]:
+                matched += 1
+            if matched < run_size:
+                middle = node_class()
+                middle.run = run[:matched]
+                if self.keeps_depths:
+                    middle.depths = child.depths << (run_size - matched)
+                    if child.depth_counts is not None:
+                        middle.depth_counts = { depth + run_size - matched: count for (depth, count) in child.depth_counts.items() }
+                if self.keeps_value_sum:
+                    middle.value_sum = child.value_sum
+                if self.keeps_ele_summary:
+                    middle.ele_summary = None
+                child.run = run[matched+1:]
+                _add_child(middle, run[matched], child, compact)
+                _replace_child(node, ele, middle)
+                child = middle
+
+            node = child
+            i += 1 + len(node.run)
+            if path is not None:
+                path.append((node, ngram_size - i))
+        if self.keeps_depths and not node.end_of_ngram:
+            for (path_node, depth) in path:
+                _add_depth(path_node, depth)
+        if nodes is not None:
+            nodes.extend(path_node for (path_node, _) in path)
+        return node
+
     def __setitem__(self, ngram, value):
         """ Assign a value to an n-gram, overwriting the existing value if the n-gram exists. """
-        #N-gram is consumed element by element from first to last and each time this function will pass the rest of the n-gram to the next node.
-        #When the n-gram is completely consumed, the current node will be marked a terminating node.
-        
-        #Base case: N-gram fully consumed and this node is at the end of the n-gram. Mark it as a terminating node.
-        if len(ngram) == 0:
-            self.end_of_ngram = True
-            self.value = value
-        #Recursive case: N-gram is still being consumed. Move on to next node.
-        else:
-            next_ele = ngram[0]
-            rest_ngram = ngram[1:]
-
-            #Create a new child node if the next element does not lead to anywhere and recurse on it.
-            if next_ele not in self.children:
-                self.children[next_ele] = _NGramMapNode()
-            self.children[next_ele].__setitem__(rest_ngram, value)
-
-    def pop(self, ngram):
-        """ Remove an n-gram and associated value, returning the value. """
-        #N-gram is consumed element by element from first to last and each time this function will pass the rest of the n-gram to the next node.
-        #When the n-gram is completely consumed, the current node is marked a non-terminating node and the ancestors of the node are notified of the removal of elements from their descendants.
-
-        #Base case: N-gram fully consumed and this node is at the end of the n-gram. Mark it as a non-terminating node.
-        if len(ngram) == 0:
+        #The node at the end of the n-gram is marked as a terminating node.
+        node = self.make_node(ngram)
+        node.end_of_ngram = True
+        node.value = value
+
+    def pop(self, ngram, radix=False, value_sums=False):
+        """ Remove an n-gram and associated value, returning the value. If 'radix' is True then the prefix tree is kept path compressed. If 'value_sums' is True then the value is also taken off the value sums of the nodes along the n-gram's path. """
+        if radix:
+            return self.__pop_radix(ngram, value_sums)
+
+        #N-gram is consumed element by element from first to last, remembering the path taken.
+        #When the n-gram is completely consumed, the current node is marked a non-terminating node and the path is walked back to remove nodes which do not lead to any n-gram anymore.
+        path = []
+        node = self
+        for ele in ngram:
+            path.append(node)
+            node = node.children.get(ele)
             #If n-gram does not exist then raise an error.
-            if self.end_of_ngram:
-                value = self.value
-                
-                self.end_of_ngram = False
-                self.value = None
-                
-                return value
-            else:
+            if node is None:
                 raise KeyError(ngram)
-        #Recursive case: N-gram is still being consumed. Move on to next node.
-        else:
-            next_ele = ngram[0]
-            rest_ngram = ngram[1:]
 
+        #If n-gram does not exist then raise an error.
+        if not node.end_of_ngram:
+            raise KeyError(ngram)
+        value = node.value
+        node.end_of_ngram = False
+        node.value = None
+        if value_sums:
+            _add_value_sum(path + [ node ], value, 0)
+
+        #Without a size index, walk the path back, from the deepest node upwards, removing nodes which neither end an n-gram nor have any children anymore.
+        if not self.keeps_depths:
+            i = len(path)
+            while i > 0 and not node.end_of_ngram and len(node.children) == 0:
+                i -= 1
+                _remove_child(path[i], ngram[i])
+                node = path[i]
+            return value
+
+        #With a size index, walk the path back, from the deepest node upwards, counting one less n-gram ending at the depth at which the n-gram ended in every node.
+        #Nodes which are left without any n-gram ending below them are removed.
+        _discard_depth(node, 0)
+        depth = 0
+        i = len(path)
+        while i > 0:
+            i -= 1
+            parent = path[i]
+            if node.depths == 0:
+                _remove_child(parent, ngram[i])
+            depth += 1
+            _discard_depth(parent, depth)
+            node = parent
+
+        return value
+    def __pop_radix(self, ngram, value_sums):
+        """ Helper method to pop() for a radix tree. """
+        #N-gram is consumed element by element from first to last, together with the run of elements of each node, remembering the path taken.
+        #When the n-gram is completely consumed, the current node is marked a non-terminating node and the path is walked back as in a prefix tree, where the depths below a node are counted from its run.
+        path = []
+        keys = []
+        eles = iter(ngram)
+        node = self
+        for ele in eles:
+            path.append(node)
+            keys.append(ele)
+            node = node.children.get(ele)
             #If n-gram does not exist then raise an error.
-            if next_ele in self.children:
-                value = None
-                try:
-                    #Recursive line
-                    value = self.children[next_ele].pop(rest_ngram)
-                except KeyError:
+            if node is None:
+                raise KeyError(ngram)
+            for run_ele in node.run:
+                if next(eles, _NO_ELE) != run_ele:
                     raise KeyError(ngram)
 
-                #The following code is for clean up after the terminating node of the n-gram in the descendants of this node was dealt with.
-
-                #Remove the child node leading to the terminating node if it has no children of its own and is not a terminating node.
-                if len(self.children[next_ele].children) == 0 and not self.end_of_ngram:
-                    self.children.pop(next_ele)
+        #If n-gram does not exist then raise an error.
+        if not node.end_of_ngram:
+            raise KeyError(ngram)
+        value = node.value
+        node.end_of_ngram = False
+        node.value = None
+        if value_sums:
+            _add_value_sum(path + [ node ], value, 0)
+
+        #Only the node at the end of the n-gram can be left without any n-gram ending below it, in which case it is removed, since every other node along the path either ends an n-gram or branches.
+        #With a size index, walk the path back, counting one less n-gram ending at the depth at which the n-gram ended in every node.
+        removed = len(path) > 0 and len(node.children) == 0
+        if removed:
+            _remove_child(path[-1], keys[-1])
+        if self.keeps_depths:
+            _discard_depth(node, 0)
+            depth = 0
+            i = len(path)
+            while i > 0:
+                i -= 1
+                depth += 1 + len(node.run)
+                node = path[i]
+                _discard_depth(node, depth)
+
+        #A node which neither ends an n-gram nor branches anymore is merged with its only child, which is either the node at the end of the n-gram or its parent if that node was removed.
+        if removed:
+            if len(path) > 1:
+                _merge_only_child(path[-2], keys[-2])
+        elif len(path) > 0:
+            _merge_only_child(path[-1], keys[-1])
 
-                return value
-            else:
-                raise KeyError(ngram)
+        return value
 
     def __getitem__(self, ngram):
         """ Get the value associated with an n-gram. """
-        #N-gram is consumed element by element from first to last and each time this function will pass the rest of the n-gram to the next node.
-        #When the n-gram is completely consumed, the value of the current node is returned.
-
-        #Base case: N-gram fully consumed and this node is at the end of the n-gram. Return its value.
-        if len(ngram) == 0:
-            #If n-gram does not exist then raise an error.
-            if self.end_of_ngram:
-                return self.value
-            else:
-                raise KeyError(ngram)
-        #Recursive case: N-gram is still being consumed. Move on to next node.
-        else:
-            next_ele = ngram[0]
-            rest_ngram = ngram[1:]
+        node = self.find_node(ngram)
 
-            #If n-gram does not exist then raise an error.
-            if next_ele in self.children:
-                try:
-                    return self.children[next_ele].__getitem__(rest_ngram)
-                except KeyError:
-                    raise KeyError(ngram)
-            else:
-                raise KeyError(ngram)
+        #If n-gram does not exist then raise an error.
+        if node is None or not node.end_of_ngram:
+            raise KeyError(ngram)
+        return node.value
 
     def __contains__(self, ngram):
         """ Check if an n-gram exists in the mapping. """
-        #N-gram is consumed element by element from first to last and each time this function will pass the rest of the n-gram to the next node.
-        #When the n-gram is completely consumed, whether or not the current node is a terminating node is returned.
-        
-        #Base case: N-gram fully consumed and this node is at the end of the n-gram. Return if its a terminating node.
-        if len(ngram) == 0:
-            if self.end_of_ngram:
-                return True
-            else:
-                return False
-        #Recursive case: N-gram is still being consumed. Move on to next node.
-        else:
-            next_ele = ngram[0]
-            rest_ngram = ngram[1:]
-
-            #If n-gram does not exist then return false.
-            if next_ele in self.children:
-                return self.children[next_ele].__contains__(rest_ngram)
-            else:
-                return False
+        node = self.find_node(ngram)
+        return node is not None and node.end_of_ngram
 
     def ngrams(self):
         """ Get an iterator over all the n-grams in the mapping. Returned n-grams are tuples. """
@@ -344,8 +3026,9 @@ class _NGramMapNode():
 
         #For each next element, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
         for ele in self.children:
-            new_ngram = partial_ngram+(ele,)
-            for ngram in self.children[ele].__ngrams(new_ngram):
+            child = self.children[ele]
+            new_ngram = partial_ngram+(ele,)+child.run
+            for ngram in child.__ngrams(new_ngram):
                 yield ngram
 
     def sized_ngrams(self, size):
@@ -361,17 +3044,21 @@ class _NGramMapNode():
         if size_left == 0:
             if self.end_of_ngram:
                 yield partial_ngram
-        else:
-            #For each next element, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
+        elif size_left > 0:
+            #For each next element whose child node has an n-gram ending at the required depth below it, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
+            #The depths of a child with a run are shifted by the size of the run so that they are counted from the child's first element.
             for ele in self.children:
-                new_ngram = partial_ngram+(ele,)
-                for ngram in self.children[ele].__sized_ngrams(size_left-1, new_ngram):
-                    yield ngram
+                child = self.children[ele]
+                if child.depths << len(child.run) >> (size_left-1) & 1:
+                    new_ngram = partial_ngram+(ele,)+child.run
+                    for ngram in child.__sized_ngrams(size_left-1-len(child.run), new_ngram):
+                        yield ngram
 
-    def ngrams_with_ele(self, target):
-        """ Get an iterator over all the n-grams which contain all the given target elements in any order. 'targets' must be a set of elements. Returned n-grams are tuples. """
-        return self.__ngrams_with_ele(target, (), False)
-    def __ngrams_with_ele(self, target, partial_ngram, found):
+    def ngrams_with_ele(self, target, ele_summary=None):
+        """ Get an iterator over all the n-grams which contain the given target element. 'target' must be an element. If an element summary is given then it is used to skip subtrees which cannot contain the target. Returned n-grams are tuples. """
+        target_mask = ele_summary.mask(target) if ele_summary is not None else 0
+        return self.__ngrams_with_ele(target, (), False, ele_summary, target_mask)
+    def __ngrams_with_ele(self, target, partial_ngram, found, ele_summary, target_mask):
         """ Helper method to ngrams_with_ele(). """
         #An n-gram is constructed element by element and passed on to each of the child nodes.
         #When the target element has been added to the constructed n-gram, it will yield the complete n-gram which was passed to it by its parents.
@@ -382,18 +3069,23 @@ class _NGramMapNode():
 
         #For each next element, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
         for ele in self.children:
-            new_ngram = partial_ngram+(ele,)
+            child = self.children[ele]
             new_found = found
-            if ele == target:
+            if ele == target or target in child.run:
                 new_found = True
+            #Skip the child if the target has not been found yet and the element summary shows that it is not below the child.
+            elif not found and ele_summary is not None and not ele_summary.get(child) & target_mask:
+                continue
             
-            for ngram in self.children[ele].__ngrams_with_ele(target, new_ngram, new_found):
+            new_ngram = partial_ngram+(ele,)+child.run
+            for ngram in child.__ngrams_with_ele(target, new_ngram, new_found, ele_summary, target_mask):
                 yield ngram
 
-    def ngrams_with_all_eles(self, targets):
-        """ Get an iterator over all the n-grams which contain all the given target elements in any order. 'targets' must be a set of elements. Returned n-grams are tuples. """
-        return self.__ngrams_with_all_eles(targets, ())
-    def __ngrams_with_all_eles(self, targets, partial_ngram):
+    def ngrams_with_all_eles(self, targets, ele_summary=None):
+        """ Get an iterator over all the n-grams which contain all the given target elements in any order. 'targets' must be a set of elements. If an element summary is given then it is used to skip subtrees which cannot contain the targets. Returned n-grams are tuples. """
+        targets_mask = ele_summary.masks(targets) if ele_summary is not None else 0
+        return self.__ngrams_with_all_eles(targets, (), ele_summary, targets_mask)
+    def __ngrams_with_all_eles(self, targets, partial_ngram, ele_summary, targets_mask):
         """ Helper method to ngrams_with_all_eles(). """
         #An n-gram is constructed element by element and passed on to each of the child nodes.
         #When every target element has been added to the constructed n-gram, it will yield the complete n-gram which was passed to it by its parents.
@@ -404,15 +3096,56 @@ class _NGramMapNode():
 
         #For each next element, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
         for ele in self.children:
-            new_targets = targets - { ele }
-            new_ngram = partial_ngram+(ele,)
-            for ngram in self.children[ele].__ngrams_with_all_eles(new_targets, new_ngram):
+            child = self.children[ele]
+            new_targets = targets
+            new_targets_mask = targets_mask
+            if ele in targets or child.run and not targets.isdisjoint(child.run):
+                new_targets = targets.difference((ele,), child.run)
+                if ele_summary is not None:
+                    new_targets_mask = ele_summary.masks(new_targets)
+            #Skip the child if the element summary shows that the remaining targets are not all below the child.
+            if ele_summary is not None and ele_summary.get(child) & new_targets_mask != new_targets_mask:
+                continue
+
+            new_ngram = partial_ngram+(ele,)+child.run
+            for ngram in child.__ngrams_with_all_eles(new_targets, new_ngram, ele_summary, new_targets_mask):
                 yield ngram
 
-    def sized_ngrams_with_ele(self, target, size):
-        """ Get an iterator over all the n-grams of a particular size which contain the given target element. 'target' must be an element. Returned n-grams are tuples. """
-        return self.__sized_ngrams_with_ele(target, size, (), False)
-    def __sized_ngrams_with_ele(self, target, size, partial_ngram, found):
+    def ngrams_with_prefix(self, prefix, size=None):
+        """ Get an iterator over all the n-grams which start with the given prefix, optionally only those of a particular size. Returned n-grams are tuples. """
+        #Only the subtree of the node at the end of the prefix needs to be searched, starting with the node's path as the partial n-gram.
+        (node, path) = self.find_prefix_node(prefix)
+        if node is not None:
+            if size is None:
+                return node.__ngrams(path)
+            elif size >= len(path):
+                return node.__sized_ngrams(size - len(path), path)
+        return iter(())
+
+    def count_with_prefix(self, prefix, size=None):
+        """ Get the number of n-grams which start with the given prefix, optionally only those of a particular size, from the number of n-grams ending at each depth below the node at the end of the prefix, which requires a size index. """
+        (node, path) = self.find_prefix_node(prefix)
+        if node is None:
+            return 0
+        if size is None:
+            return sum(_depth_counts(node).values())
+        return _num_at_depth(node, size - len(path))
+
+    def ngrams_with_suffix(self, suffix, size=None):
+        """ Get an iterator over all the n-grams which end with the given suffix, optionally only those of a particular size. Returned n-grams are tuples. """
+        #Without a suffix tree, every n-gram needs to be checked.
+        suffix = tuple(suffix)
+        suffix_size = len(suffix)
+        ngrams = self.ngrams() if size is None else self.sized_ngrams(size)
+        for ngram in ngrams:
+            if len(ngram) >= suffix_size and ngram[len(ngram)-suffix_size:] == suffix:
+                yield ngram
+
+    def sized_ngrams_with_ele(self, target, size, ele_summary=None):
+        """ Get an iterator over all the n-grams of a particular size which contain the given target element. 'target' must be an element. If an element summary is given then it is used to skip subtrees which cannot contain the target. Returned n-grams are tuples. """
+        target_mask = ele_summary.mask(target) if ele_summary is not None else 0
+        return self.__sized_ngrams_with_ele(target, size, (), False, ele_summary, target_mask)
+    def __sized_ngrams_with_ele(self, target, size, partial_ngram, found, ele_summary, target_mask):
         """ Helper method to sized_ngrams_with_ele(). """
         #An n-gram is constructed element by element and passed on to each of the child nodes.
         #When the target element has been added to the constructed n-gram, it will yield the complete n-gram which was passed to it by its parents.
@@ -422,21 +3155,27 @@ class _NGramMapNode():
         if size == 0:
             if found and self.end_of_ngram:
                 yield partial_ngram
-        else:
-            #For each next element, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
+        elif size > 0:
+            #For each next element whose child node has an n-gram ending at the required depth below it, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
             for ele in self.children:
-                new_ngram = partial_ngram+(ele,)
-                new_found = found
-                if ele == target:
-                    new_found = True
-                
-                for ngram in self.children[ele].__sized_ngrams_with_ele(target, size - 1, new_ngram, new_found):
-                    yield ngram
+                child = self.children[ele]
+                if child.depths << len(child.run) >> (size-1) & 1:
+                    new_found = found
+                    if ele == target or target in child.run:
+                        new_found = True
+                    #Skip the child if the target has not been found yet and the element summary shows that it is not below the child.
+                    elif not found and ele_summary is not None and not ele_summary.get(child) & target_mask:
+                        continue
+                    
+                    new_ngram = partial_ngram+(ele,)+child.run
+                    for ngram in child.__sized_ngrams_with_ele(target, size-1-len(child.run), new_ngram, new_found, ele_summary, target_mask):
+                        yield ngram
 
-    def sized_ngrams_with_all_eles(self, targets, size):
-        """ Get an iterator over all the n-grams of a particular size which contain all the given target elements in any order. 'targets' must be a set of elements. Returned n-grams are tuples. """
-        return self.__sized_ngrams_with_all_eles(targets, size, ())
-    def __sized_ngrams_with_all_eles(self, targets, size, partial_ngram):
+    def sized_ngrams_with_all_eles(self, targets, size, ele_summary=None):
+        """ Get an iterator over all the n-grams of a particular size which contain all the given target elements in any order. 'targets' must be a set of elements. If an element summary is given then it is used to skip subtrees which cannot contain the targets. Returned n-grams are tuples. """
+        targets_mask = ele_summary.masks(targets) if ele_summary is not None else 0
+        return self.__sized_ngrams_with_all_eles(targets, size, (), ele_summary, targets_mask)
+    def __sized_ngrams_with_all_eles(self, targets, size, partial_ngram, ele_summary, targets_mask):
         """ Helper method to sized_ngrams_with_all_eles(). """
         #An n-gram is constructed element by element and passed on to each of the child nodes.
         #When every target element has been added to the constructed n-gram, it will yield the complete n-gram which was passed to it by its parents.
@@ -446,13 +3185,25 @@ class _NGramMapNode():
         if size == 0:
             if len(targets) == 0 and self.end_of_ngram:
                 yield partial_ngram
-        else:
-            #For each next element, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
+        #Stop recursion if there are more targets left than elements to add to the n-gram.
+        elif size >= len(targets):
+            #For each next element whose child node has an n-gram ending at the required depth below it, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
             for ele in self.children:
-                new_targets = targets - { ele }
-                new_ngram = partial_ngram+(ele,)
-                for ngram in self.children[ele].__sized_ngrams_with_all_eles(new_targets, size - 1, new_ngram):
-                    yield ngram
+                child = self.children[ele]
+                if child.depths << len(child.run) >> (size-1) & 1:
+                    new_targets = targets
+                    new_targets_mask = targets_mask
+                    if ele in targets or child.run and not targets.isdisjoint(child.run):
+                        new_targets = targets.difference((ele,), child.run)
+                        if ele_summary is not None:
+                            new_targets_mask = ele_summary.masks(new_targets)
+                    #Skip the child if the element summary shows that the remaining targets are not all below the child.
+                    if ele_summary is not None and ele_summary.get(child) & new_targets_mask != new_targets_mask:
+                        continue
+
+                    new_ngram = partial_ngram+(ele,)+child.run
+                    for ngram in child.__sized_ngrams_with_all_eles(new_targets, size-1-len(child.run), new_ngram, ele_summary, new_targets_mask):
+                        yield ngram
 
     def ngrams_by_template(self, ngram_template, placeholder_indices):
         """ Get an iterator over all the n-grams which match an n-gram template consisting of elements, some of which will be ignored as place holders. Place holders are elements which can be substituted by any element. The indices of the place holders must be specified. Returned n-grams are tuples. """
@@ -469,20 +3220,54 @@ class _NGramMapNode():
                 yield partial_ngram
         else:
             next_ele = ngram_template[curr_index]
+            depth_left = len(ngram_template) - curr_index - 1
             
             #If the next element in the n-gram template is a place holder, go through every child of the current node as the next element in the n-gram.
             if curr_index in placeholder_indices:
-                #For each next element, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
+                #For each next element whose child node has an n-gram ending at the template's size below it (and whose run follows the template), construct the new partial n-gram and pass it to that element's child node, yielding every n-gram it yields.
                 for ele in self.children:
-                    new_ngram = partial_ngram+(ele,)
-                    for ngram in self.children[ele].__ngrams_by_template(ngram_template, placeholder_indices, curr_index+1, new_ngram):
-                        yield ngram
-            #If the next element in the n-gram template is not a place holder, go through the child which is associated with that element.
+                    child = self.children[ele]
+                    if child.depths << len(child.run) >> depth_left & 1:
+                        if child.run and not _run_follows_template(child.run, ngram_template, placeholder_indices, curr_index+1):
+                            continue
+                        new_ngram = partial_ngram+(ele,)+child.run
+                        for ngram in child.__ngrams_by_template(ngram_template, placeholder_indices, curr_index+1+len(child.run), new_ngram):
+                            yield ngram
+            #If the next element in the n-gram template is not a place holder, go through the child which is associated with that element (provided that its run follows the template).
             elif next_ele in self.children:
-                new_ngram = partial_ngram+(next_ele,)
-                for ngram in self.children[next_ele].__ngrams_by_template(ngram_template, placeholder_indices, curr_index+1, new_ngram):
+                child = self.children[next_ele]
+                if child.run and not _run_follows_template(child.run, ngram_template, placeholder_indices, curr_index+1):
+                    return
+                new_ngram = partial_ngram+(next_ele,)+child.run
+                for ngram in child.__ngrams_by_template(ngram_template, placeholder_indices, curr_index+1+len(child.run), new_ngram):
                     yield ngram
 
+    def count_by_template(self, ngram_template, placeholder_indices):
+        """ Get the number of n-grams which match an n-gram template, as described in ngrams_by_template(), which requires a size index. """
+        #The template only needs to be followed up to its last element which is not a place holder since all n-grams of the template's size under that node match the template, which are counted from the number of n-grams ending at each depth below it.
+        stop_index = 0
+        for i in range(len(ngram_template)):
+            if i not in placeholder_indices:
+                stop_index = i + 1
+        return self.__count_by_template(ngram_template, placeholder_indices, stop_index, 0)
+    def __count_by_template(self, ngram_template, placeholder_indices, stop_index, curr_index):
+        """ Helper method to count_by_template(). """
+        if curr_index >= stop_index:
+            return _num_at_depth(self, len(ngram_template) - curr_index)
+        if curr_index in placeholder_indices:
+            #Only children with an n-gram ending at the template's size below them are followed.
+            depth_left = len(ngram_template) - curr_index - 1
+            children = [ child for child in self.children.values() if child.depths << len(child.run) >> depth_left & 1 ]
+        else:
+            child = self.children.get(ngram_template[curr_index])
+            children = [ child ] if child is not None else []
+        count = 0
+        for child in children:
+            if child.run and not _run_follows_template(child.run, ngram_template, placeholder_indices, curr_index+1):
+                continue
+            count += child.__count_by_template(ngram_template, placeholder_indices, stop_index, curr_index+1+len(child.run))
+        return count
+
     def values(self):
         """ Get an iterator over all the values in the mapping. """
         #Recursively visit every node and yield the value of all terminating nodes.
@@ -509,7 +3294,8 @@ class _NGramMapNode():
             yield (partial_ngram, self.value)
         #For each next element, construct the new partial n-gram and pass it to that element's child node, yielding every n-gram/value pair it yields.
         for ele in self.children:
-            for item in self.children[ele].__items(partial_ngram+(ele,)):
+            child = self.children[ele]
+            for item in child.__items(partial_ngram+(ele,)+child.run):
                 yield item
 
     def __iter__(self):
@@ -519,3 +3305,441 @@ class _NGramMapNode():
     def __delitem__(self, ngram):
         """ Remove an n-gram and associated value. """
         self.pop(ngram)
+
+
+def _node_class(radix=False, size_index=False, value_sums=False, ele_summary=False):
+    """ Get the class of the nodes of a prefix tree, which is the subclass of _NGramMapNode with the run of a node if 'radix' is True, its depths and depth counts if 'size_index' is True, its value sum if 'value_sums' is True and its element summary if 'ele_summary' is True, or _NGramMapNode itself if none is. For internal use only. """
+    return _NODE_CLASSES[(radix, size_index, value_sums, ele_summary)]
+
+
+def _make_node_class(radix, size_index, value_sums, ele_summary):
+    """ Make the class of the nodes of a prefix tree with the given optional fields, as described in _node_class(). A subclass is added to the module under its own name so that its nodes can be pickled. For internal use only. """
+    fields = (('run',) if radix else ()) + (('depths', 'depth_counts') if size_index else ()) + (('value_sum',) if value_sums else ()) + (('ele_summary',) if ele_summary else ())
+    if len(fields) == 0:
+        return _NGramMapNode
+
+    #The fields of every node are set here as in _NGramMapNode.__init__() rather than by calling it, which would slow down making every node.
+    def __init__(self):
+        """ Create a new n-gram map node. """
+        self.end_of_ngram = False
+        self.value = None
+        self.children = _NO_CHILDREN
+        if radix:
+            self.run = ()
+        if size_index:
+            self.depths = 0
+            self.depth_counts = None
+        if value_sums:
+            self.value_sum = 0
+        if ele_summary:
+            self.ele_summary = 0
+
+    name = '_NGramMapNode' + ('Radix' if radix else '') + ('Sized' if size_index else '') + ('Summed' if value_sums else '') + ('Summarised' if ele_summary else '')
+    node_class = type(name, (_NGramMapNode,), { '__slots__': fields, '__init__': __init__, '__module__': __name__, '__qualname__': name, '__doc__': _NGramMapNode.__doc__, 'optional_fields': fields, 'keeps_runs': radix, 'keeps_depths': size_index, 'keeps_value_sum': value_sums, 'keeps_ele_summary': ele_summary })
+    globals()[name] = node_class
+    return node_class
+
+
+#The class of the nodes of a prefix tree for every combination of optional fields, as described in _node_class().
+_NODE_CLASSES = { options: _make_node_class(*options) for options in itertools.product((False, True), repeat=4) }
+
+
+def _run_follows_template(run, ngram_template, placeholder_indices, start_index):
+    """ Check if the run of a node in a radix tree matches an n-gram template from a given index without going beyond the end of the template. For internal use only. """
+    if start_index + len(run) > len(ngram_template):
+        return False
+    for (i, ele) in enumerate(run, start_index):
+        if i not in placeholder_indices and ngram_template[i] != ele:
+            return False
+    return True
+
+
+#############################################################################
+
+
+class _EleIndex():
+    """ An inverted index from elements to the n-grams which contain them, partitioned by n-gram size. For internal use only. """
+
+    def __init__(self):
+        """ Create a new empty element index. """
+        self.postings = dict() #A dictionary which maps each element to a dictionary mapping n-gram sizes to the set of n-grams of that size which contain the element.
+
+    def add(self, ngram):
+        """ Add an n-gram to the index. 'ngram' must be a tuple. """
+        ngram_size = len(ngram)
+        for ele in ngram:
+            if ele not in self.postings:
+                self.postings[ele] = dict()
+            sized_postings = self.postings[ele]
+            if ngram_size not in sized_postings:
+                sized_postings[ngram_size] = set()
+            sized_postings[ngram_size].add(ngram)
+
+    def discard(self, ngram):
+        """ Remove an n-gram from the index. 'ngram' must be a tuple. """
+        ngram_size = len(ngram)
+        for ele in ngram:
+            #An element which occurs more than once in the n-gram may have been cleaned up already.
+            sized_postings = self.postings.get(ele)
+            if sized_postings is None or ngram_size not in sized_postings:
+                continue
+            sized_postings[ngram_size].discard(ngram)
+            if len(sized_postings[ngram_size]) == 0:
+                sized_postings.pop(ngram_size)
+                if len(sized_postings) == 0:
+                    self.postings.pop(ele)
+
+    def ngrams_with_ele(self, target):
+        """ Get an iterator over all the n-grams which contain the given target element. Returned n-grams are tuples. """
+        for ngrams in self.postings.get(target, dict()).values():
+            for ngram in ngrams:
+                yield ngram
+
+    def sized_ngrams_with_ele(self, target, size):
+        """ Get an iterator over all the n-grams of a particular size which contain the given target element. Returned n-grams are tuples. """
+        for ngram in self.postings.get(target, dict()).get(size, set()):
+            yield ngram
+
+    def ngrams_with_all_eles(self, targets):
+        """ Get an iterator over all the n-grams which contain all the given target elements in any order. 'targets' must be a non-empty list of elements sorted from the least frequent to the most frequent. Returned n-grams are tuples. """
+        #Only the sizes of the n-grams containing the rarest target can be of n-grams containing all the targets.
+        for size in list(self.postings.get(targets[0], dict())):
+            for ngram in self.sized_ngrams_with_all_eles(targets, size):
+                yield ngram
+
+    def sized_ngrams_with_all_eles(self, targets, size):
+        """ Get an iterator over all the n-grams of a particular size which contain all the given target elements in any order. 'targets' must be a non-empty list of elements sorted from the least frequent to the most frequent. Returned n-grams are tuples. """
+        #Intersect the sets of n-grams of the requested size containing each target, starting from the smallest set so that every intersection is as small as possible.
+        postings = []
+        for target in targets:
+            ngrams = self.postings.get(target, dict()).get(size)
+            if ngrams is None:
+                return
+            postings.append(ngrams)
+        postings.sort(key=len)
+
+        for ngram in postings[0].intersection(*postings[1:]):
+            yield ngram
+
+
+#############################################################################
+
+
+class _PositionIndex():
+    """ An index from n-gram sizes, positions and elements to the n-grams which have the element at that position. For internal use only. """
+
+    def __init__(self):
+        """ Create a new empty position index. """
+        self.postings = dict() #A dictionary which maps each (n-gram size, position, element) triple to the set of n-grams of that size which have the element at that position.
+
+    def add(self, ngram):
+        """ Add an n-gram to the index. 'ngram' must be a tuple. """
+        ngram_size = len(ngram)
+        for (i, ele) in enumerate(ngram):
+            key = (ngram_size, i, ele)
+            if key not in self.postings:
+                self.postings[key] = set()
+            self.postings[key].add(ngram)
+
+    def discard(self, ngram):
+        """ Remove an n-gram from the index. 'ngram' must be a tuple. """
+        ngram_size = len(ngram)
+        for (i, ele) in enumerate(ngram):
+            key = (ngram_size, i, ele)
+            self.postings[key].discard(ngram)
+            if len(self.postings[key]) == 0:
+                self.postings.pop(key)
+
+    def ngrams_by_template(self, ngram_template, placeholder_indices):
+        """ Get an iterator over all the n-grams which match an n-gram template consisting of elements, some of which will be ignored as place holders. The template must have at least one element which is not a place holder. Returned n-grams are tuples. """
+        #Start from the smallest set of n-grams having one of the template's elements in place and keep those which have the rest of the template's elements in place too.
+        ngram_size = len(ngram_template)
+        fixed_indices = [ i for i in range(ngram_size) if i not in placeholder_indices ]
+        smallest = None
+        for i in fixed_indices:
+            ngrams = self.postings.get((ngram_size, i, ngram_template[i]))
+            if ngrams is None:
+                return
+            if smallest is None or len(ngrams) < len(smallest):
+                smallest = ngrams
+
+        for ngram in smallest:
+            if all(ngram[i] == ngram_template[i] for i in fixed_indices):
+                yield ngram
+
+
+#############################################################################
+
+
+def _numeric(value):
+    """ Get the contribution of a value to a sum of values, which is the value itself if it is a number and 0 otherwise. For internal use only. """
+    return value if isinstance(value, numbers.Number) else 0
+
+
+#############################################################################
+
+
+class _EleSummary():
+    """ A summary of the elements below every node of an n-gram prefix tree, kept in each node as a Bloom filter (with a single hash function) in the form of a bit field. For internal use only. """
+
+    def __init__(self, num_bits):
+        """ Create a new element summary which uses Bloom filters of 'num_bits' bits. """
+        self.num_bits = num_bits
+
+    def mask(self, ele):
+        """ Get the bit field with only the bit of an element set. """
+        return 1 << (hash(ele) % self.num_bits)
+
+    def masks(self, eles):
+        """ Get the bit field with the bits of all the given elements set. """
+        mask = 0
+        for ele in eles:
+            mask |= 1 << (hash(ele) % self.num_bits)
+        return mask
+
+    def get(self, node):
+        """ Get the bit field of the elements below a node, rebuilding it if it was invalidated by a removal. """
+        #A node which needs to be rebuilt may have children which need to be rebuilt too but all the nodes above it also need to be rebuilt.
+        summary = node.ele_summary
+        if summary is None:
+            summary = 0
+            for (ele, child) in node.children.items():
+                summary |= self.mask(ele) | self.masks(child.run) | self.get(child)
+            node.ele_summary = summary
+        return summary
+
+    def add(self, root, ngram):
+        """ Add the elements of an n-gram which has just been added to the prefix tree to the summaries of the nodes along its path. """
+        #Each node along the path has the rest of the n-gram's elements below it.
+        suffix_masks = [ 0 ]
+        for i in range(len(ngram)-1, -1, -1):
+            suffix_masks.append(suffix_masks[-1] | self.mask(ngram[i]))
+
+        #In a radix tree, the path skips over the runs of the nodes.
+        node = root
+        i = 0
+        while i < len(ngram):
+            if node.ele_summary is not None:
+                node.ele_summary |= suffix_masks[len(ngram)-i]
+            node = node.children[ngram[i]]
+            i += 1 + len(node.run)
+
+    def discard(self, root, ngram):
+        """ Invalidate the summaries of the nodes along the path of an n-gram which has just been removed from the prefix tree, leaving them to be rebuilt when needed. """
+        #In a radix tree, the path skips over the runs of the nodes, where nodes along the path may have been merged into nodes whose run goes past the end of the n-gram.
+        node = root
+        i = 0
+        while True:
+            node.ele_summary = None
+            if i >= len(ngram):
+                break
+            node = node.children.get(ngram[i])
+            if node is None:
+                break
+            i += 1 + len(node.run)
+
+
+#############################################################################
+
+
+class _QueryCache():
+    """ A least recently used cache of the results of searches of an n-gram map, where a cached result is discarded as soon as an n-gram which belongs in it is added to or removed from the map. A search is identified by a query of the form (kind, elements, extra), where 'kind' is one of 'ele', 'all_eles', 'template', 'prefix' and 'suffix', 'elements' is the tuple (or frozenset for 'all_eles') of the elements searched for and 'extra' is the n-gram size searched for (or None for any size), except for templates whose place holders are replaced by _PLACEHOLDER in 'elements'. For internal use only. """
+
+    def __init__(self, max_entries, max_bytes):
+        """ Create a new cache which keeps at most 'max_entries' results taking up at most 'max_bytes' bytes, where a limit of 0 means no limit. """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict() #An ordered dictionary of the (tuple of n-grams, size in bytes) pair of each cached query, from the least to the most recently used.
+        self.num_bytes = 0 #The estimated total size in bytes of the cached results, which counts the tuples holding them but not the elements, which are shared with the map.
+        self.ele_queries = dict() #A dictionary mapping elements to the set of cached queries whose n-grams must contain the element, where each query is listed under one element only.
+        self.size_queries = dict() #A dictionary mapping n-gram sizes (or None) to the set of cached queries which do not require any particular element and only match n-grams of that size (or of any size).
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0 #The number of results discarded to keep within the limits.
+        self.invalidations = 0 #The number of results discarded because of changes to the map.
+
+    def results(self, query, search):
+        """ Get the tuple of the n-grams found by a query, either from the cache or by calling 'search' to get an iterator over them and caching them. """
+        entry = self.entries.get(query)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(query)
+            return entry[0]
+        self.misses += 1
+
+        result = tuple(search())
+        num_bytes = sys.getsizeof(result) + sum(sys.getsizeof(ngram) for ngram in result)
+        if self.max_bytes > 0 and num_bytes > self.max_bytes:
+            return result
+        self.entries[query] = (result, num_bytes)
+        self.num_bytes += num_bytes
+        (queries, trigger) = self.__trigger(query)
+        if trigger not in queries:
+            queries[trigger] = set()
+        queries[trigger].add(query)
+
+        while (self.max_entries > 0 and len(self.entries) > self.max_entries) or (self.max_bytes > 0 and self.num_bytes > self.max_bytes):
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+        return result
+
+    def __trigger(self, query):
+        """ Get the dictionary under which a query is listed and its key in the dictionary, as described in __init__(). """
+        (kind, eles, extra) = query
+        if kind == 'template':
+            for ele in eles:
+                if ele is not _PLACEHOLDER:
+                    return (self.ele_queries, ele)
+            return (self.size_queries, len(eles))
+        if len(eles) == 0:
+            return (self.size_queries, extra)
+        if kind == 'suffix':
+            return (self.ele_queries, eles[-1])
+        return (self.ele_queries, next(iter(eles)))
+
+    def discard(self, query):
+        """ Discard the cached result of a query. """
+        (_, num_bytes) = self.entries.pop(query)
+        self.num_bytes -= num_bytes
+        (queries, trigger) = self.__trigger(query)
+        queries[trigger].discard(query)
+        if len(queries[trigger]) == 0:
+            queries.pop(trigger)
+
+    def changed(self, ngram):
+        """ Discard the cached results which an n-gram which has just been added to or removed from the map belongs in. """
+        if len(self.entries) == 0:
+            return
+        ngram = tuple(ngram)
+        candidates = list()
+        for ele in set(ngram):
+            candidates.extend(self.ele_queries.get(ele, ()))
+        candidates.extend(self.size_queries.get(len(ngram), ()))
+        candidates.extend(self.size_queries.get(None, ()))
+        for query in candidates:
+            if query in self.entries and _query_matches(query, ngram):
+                self.discard(query)
+                self.invalidations += 1
+
+    def clear(self):
+        """ Discard every cached result, after every n-gram is removed from the map. """
+        self.invalidations += len(self.entries)
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        self.ele_queries = dict()
+        self.size_queries = dict()
+
+def _query_matches(query, ngram):
+    """ Check if an n-gram (given as a tuple) belongs in the results of a query of a _QueryCache. For internal use only. """
+    (kind, eles, extra) = query
+    if kind == 'template':
+        return len(ngram) == len(eles) and all(ele is _PLACEHOLDER or ele == ngram_ele for (ele, ngram_ele) in zip(eles, ngram))
+    if extra is not None and len(ngram) != extra:
+        return False
+    if kind == 'ele':
+        return eles[0] in ngram
+    if kind == 'all_eles':
+        return eles.issubset(ngram)
+    if len(ngram) < len(eles):
+        return False
+    if kind == 'prefix':
+        return ngram[:len(eles)] == eles
+    return ngram[len(ngram)-len(eles):] == eles
+
+
+#A marker for the place holders of a template in a query of a _QueryCache.
+_PLACEHOLDER = object()
+
+
+#############################################################################
+
+
+class _Vocabulary():
+    """ A table of interned elements which maps each element to an integer ID and back, where IDs are given out in order starting from 0 and are never reused. For internal use only. """
+
+    def __init__(self):
+        """ Create a new empty vocabulary. """
+        self.ids = dict() #A dictionary which maps each interned element to its ID.
+        self.eles = list() #A list which maps each ID to its interned element.
+
+    def encode(self, ngram):
+        """ Get the tuple of IDs of the elements of an n-gram, where elements which were never interned are given the ID -1. """
+        ids = self.ids
+        return tuple([ ids.get(ele, -1) for ele in ngram ])
+
+    def encode_new(self, ngram):
+        """ Get the tuple of IDs of the elements of an n-gram, interning any new elements. """
+        ids = self.ids
+        key = list()
+        for ele in ngram:
+            ele_id = ids.get(ele)
+            if ele_id is None:
+                ele_id = len(self.eles)
+                ids[ele] = ele_id
+                self.eles.append(ele)
+            key.append(ele_id)
+        return tuple(key)
+
+    def decode(self, key):
+        """ Get the n-gram of a tuple of IDs. """
+        eles = self.eles
+        return tuple([ eles[ele_id] for ele_id in key ])
+
+    def decode_all(self, keys):
+        """ Get an iterator over the n-grams of an iterator over tuples of IDs. """
+        eles = self.eles
+        for key in keys:
+            yield tuple([ eles[ele_id] for ele_id in key ])
+
+    def decode_all_items(self, items):
+        """ Get an iterator over the (n-gram, value) pairs of an iterator over (tuple of IDs, value) pairs. """
+        eles = self.eles
+        for (key, value) in items:
+            yield (tuple([ eles[ele_id] for ele_id in key ]), value)
+
+
+#############################################################################
+
+
+class _TempInts():
+    """ An append-only sequence of 64-bit integers which is moved into a temporary file in chunks as it grows, in order to build large arrays with bounded memory. For internal use only. """
+
+    def __init__(self, temp_dir, chunk_size=65536):
+        """ Create a new empty sequence whose temporary file is created in 'temp_dir' (or the default temporary directory if None) when first needed. """
+        self.temp_dir = temp_dir
+        self.chunk_size = chunk_size
+        self.chunk = array.array('q') #The integers which have not been moved into the temporary file yet.
+        self.file = None #The temporary file, or None if it has not been created yet.
+        self.num_file_chunks = 0 #The number of chunks which have been moved into the temporary file.
+
+    def append(self, value):
+        """ Add an integer to the end of the sequence. """
+        chunk = self.chunk
+        chunk.append(value)
+        if len(chunk) == self.chunk_size:
+            if self.file is None:
+                self.file = tempfile.TemporaryFile(dir=self.temp_dir)
+            chunk.tofile(self.file)
+            self.chunk = array.array('q')
+            self.num_file_chunks += 1
+
+    def chunks(self):
+        """ Get an iterator over the integers in the sequence in order, as arrays of up to 'chunk_size' integers. """
+        if self.file is not None:
+            self.file.seek(0)
+            for _ in range(self.num_file_chunks):
+                chunk = array.array('q')
+                chunk.fromfile(self.file, self.chunk_size)
+                yield chunk
+            self.file.seek(0, 2)
+        yield self.chunk
+
+    def __len__(self):
+        """ Get the number of integers in the sequence. """
+        return self.num_file_chunks*self.chunk_size + len(self.chunk)
+
+    def close(self):
+        """ Delete the temporary file. """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
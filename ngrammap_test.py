@@ -1,5 +1,14 @@
-from ngrammap import NGramMap
+from ngrammap import NGramMap, FrozenNGramMap, NGramMapBuilder, ShardedNGramMap, ConcurrentNGramMap, PersistentNGramMap, AsyncNGramMap
 
+import array
+import asyncio
+import multiprocessing
+import os
+import pickle
+import random
+import sys
+import tempfile
+import threading
 import unittest
 
 class GeneralTests(unittest.TestCase):
@@ -552,66 +561,1652 @@ class GeneralTests(unittest.TestCase):
                     self.assertEqual(len(obj), n)
                     self.assertFalse((a,b,c) in obj)
 
+    def testPopPrunes(self):
+        obj = NGramMap()
 
-try:
-    unittest.main()
-except:
-    pass
+        obj[(1,)] = 0
+        obj[(1,2,3)] = 1
+        obj[(1,2,4)] = 2
 
-import time
-import random
+        obj.pop((1,2,3))
+        self.assertEqual(set(obj.root.children[1].children[2].children), { 4 })
+        obj.pop((1,2,4))
+        self.assertEqual(len(obj.root.children[1].children), 0)
+        obj.pop((1,))
+        self.assertEqual(len(obj.root.children), 0)
+
+    def testSequenceTypes(self):
+        obj = NGramMap()
+
+        obj[[1,2,3]] = 0
+        obj[range(2,5)] = 1
+
+        self.assertEqual(obj[(1,2,3)], 0)
+        self.assertEqual(obj[[2,3,4]], 1)
+        self.assertTrue([1,2,3] in obj)
+        self.assertFalse([1,2] in obj)
+        self.assertEqual(set(obj.ngrams()), { (1,2,3), (2,3,4) })
+        self.assertEqual(obj.pop([2,3,4]), 1)
+        self.assertRaises(KeyError, obj.pop, [2,3,4])
+        self.assertRaises(KeyError, obj.__getitem__, [1,2])
+
+    def testIncrement(self):
+        obj = NGramMap()
+
+        self.assertEqual(obj.increment((1,2)), 1)
+        self.assertEqual(obj.increment((1,2)), 2)
+        self.assertEqual(obj.increment((1,), 5), 5)
+        obj[(2,)] = 10
+        self.assertEqual(obj.increment((2,), -3), 7)
+
+        self.assertEqual(dict(obj.items()), { (1,2): 2, (1,): 5, (2,): 7 })
+        self.assertEqual(obj.size_freqs, { 1: 2, 2: 1 })
+        self.assertEqual(obj.ele_freqs, { 1: 2, 2: 2 })
+
+    def testCountNgrams(self):
+        obj = NGramMap()
+
+        ngrams = [ ('a','a','a'), ('a','a','b'), ('a','a','a'), ('a','b'), ('a','b'), ('a','b'), () ]
+        obj.count_ngrams(ngrams)
+
+        expected = NGramMap()
+        for ngram in ngrams:
+            if ngram not in expected:
+                expected[ngram] = 0
+            expected[ngram] += 1
+
+        self.assertEqual(obj, expected)
+        self.assertEqual(obj.size_freqs, expected.size_freqs)
+        self.assertEqual(obj.ele_freqs, expected.ele_freqs)
+
+    def testAddSequence(self):
+        tokens = [ 'a', 'b', 'a', 'b', 'c', 'a', 'b' ]
+
+        obj = NGramMap()
+        obj.add_sequence(tokens, 1, 3)
+
+        expected = NGramMap()
+        expected.count_ngrams(tuple(tokens[i:i+n]) for n in range(1, 4) for i in range(len(tokens) - n + 1))
+
+        self.assertEqual(obj, expected)
+        self.assertEqual(obj.size_freqs, expected.size_freqs)
+        self.assertEqual(obj.ele_freqs, expected.ele_freqs)
+
+        obj = NGramMap()
+        obj.add_sequence(tokens, 2, 2, count=False, value_fn=len)
+        self.assertEqual(dict(obj.items()), { ('a','b'): 2, ('b','a'): 2, ('b','c'): 2, ('c','a'): 2 })
+
+        obj = NGramMap()
+        obj.add_sequence(tokens, 3, 5, count=False)
+        self.assertEqual(set(obj.ngram_sizes()), { 3, 4, 5 })
+        self.assertEqual(set(obj.values()), { None })
+
+    def testDelItem(self):
+        obj = NGramMap()
+
+        obj[(1,2)] = True
+        obj[(2,3)] = True
+        del obj[(1,2)]
+
+        self.assertFalse((1,2) in obj)
+        self.assertEqual(len(obj), 1)
+        self.assertEqual(obj.ngram_eles(), { 2, 3 })
+
+    def testEleIndex(self):
+        obj = NGramMap(ele_index=True)
+        expected = NGramMap()
+
+        for a in range(4):
+            for b in range(4):
+                obj[(a,b)] = True
+                expected[(a,b)] = True
+                for c in range(4):
+                    obj[(a,b,c)] = True
+                    expected[(a,b,c)] = True
+        obj.add_sequence([ 1, 1, 2, 9 ], 1, 4)
+        expected.add_sequence([ 1, 1, 2, 9 ], 1, 4)
+        for ngram in [ (1,1), (1,1,1), (1,1,2,9), (2,9), (9,) ]:
+            obj.pop(ngram)
+            expected.pop(ngram)
+        del obj[(2,2,1)]
+        del expected[(2,2,1)]
+
+        for ele in range(10):
+            self.assertEqual(set(obj.ngrams_with_ele(ele)), set(expected.root.ngrams_with_ele(ele)))
+            for size in range(5):
+                self.assertEqual(set(obj.sized_ngrams_with_ele(ele, size)), set(expected.root.sized_ngrams_with_ele(ele, size)))
+
+        obj.clear()
+        self.assertEqual(set(obj.ngrams_with_ele(1)), set())
+        obj[(1,5)] = True
+        self.assertEqual(set(obj.ngrams_with_ele(5)), { (1,5) })
+
+    def testEleIndexAllEles(self):
+        obj = NGramMap(ele_index=True)
+        expected = NGramMap()
+
+        for a in range(5):
+            for b in range(5):
+                for c in range(5):
+                    obj[(a,b,c)] = True
+                    expected[(a,b,c)] = True
+                    obj[(a,b,c,a)] = True
+                    expected[(a,b,c,a)] = True
+        obj.pop((2,3,4))
+        expected.pop((2,3,4))
+
+        for targets in [ { 2 }, { 2, 3 }, { 2, 3, 4 }, { 1, 1 }, { 2, 7 }, { 7 } ]:
+            self.assertEqual(set(obj.ngrams_with_all_eles(targets)), set(expected.root.ngrams_with_all_eles(targets)))
+            for size in range(6):
+                self.assertEqual(set(obj.sized_ngrams_with_all_eles(targets, size)), set(expected.root.sized_ngrams_with_all_eles(targets, size)))
+        self.assertEqual(set(obj.ngrams_with_all_eles(set())), set(obj.ngrams()))
+
+    def testPositionIndex(self):
+        obj = NGramMap(position_index=True)
+        expected = NGramMap()
+
+        for a in range(4):
+            for b in range(4):
+                obj[(a,b)] = True
+                expected[(a,b)] = True
+                for c in range(4):
+                    obj[(a,b,c)] = True
+                    expected[(a,b,c)] = True
+        for ngram in [ (1,1), (1,1,1), (1,2,1), (2,1,1) ]:
+            del obj[ngram]
+            del expected[ngram]
+
+        templates = [ ((None, 1, 1), { 0 }), ((1, None, 1), { 1 }), ((None, None, 1), { 0, 1 }), ((1, 2, 1), set()), ((None, 7), { 0 }), ((None, None), { 0, 1 }) ]
+        for (ngram_template, placeholder_indices) in templates:
+            self.assertEqual(set(obj.ngrams_by_template(ngram_template, placeholder_indices)), set(expected.ngrams_by_template(ngram_template, placeholder_indices)))
+
+        obj.clear()
+        self.assertEqual(set(obj.ngrams_by_template((None, 1), { 0 })), set())
+
+    def testNgramsWithPrefixSuffix(self):
+        obj = NGramMap(suffix_tree=True)
+        expected = NGramMap()
+
+        for a in range(4):
+            for b in range(4):
+                obj[(a,b)] = True
+                expected[(a,b)] = True
+                for c in range(4):
+                    obj[(a,b,c)] = True
+                    expected[(a,b,c)] = True
+        obj[()] = True
+        expected[()] = True
+        for ngram in [ (1,2), (0,1,2), (3,3,3), () ]:
+            del obj[ngram]
+            del expected[ngram]
+
+        for affix in [ (), (2,), (1,2), (3,3), (0,1,2), (5,) ]:
+            for size in [ None, 0, 1, 2, 3, 4 ]:
+                prefixed = { ngram for ngram in expected.ngrams() if ngram[:len(affix)] == affix and (size is None or len(ngram) == size) }
+                suffixed = { ngram for ngram in expected.ngrams() if len(ngram) >= len(affix) and ngram[len(ngram)-len(affix):] == affix and (size is None or len(ngram) == size) }
+                self.assertEqual(set(obj.ngrams_with_prefix(affix, size)), prefixed)
+                self.assertEqual(set(obj.ngrams_with_suffix(affix, size)), suffixed)
+                self.assertEqual(set(expected.ngrams_with_suffix(affix, size)), suffixed)
+
+    def testContextNeighbours(self):
+        obj = NGramMap()
 
-num_ngrammaps = 500
-
-for max_ngram_size in [3, 10]:
-    for max_ele_value in [2, 100]:
-        print()
-        print("====================================")
-        print("max ngram size", max_ngram_size)
-        print("max ele value", max_ele_value)
-        print()
-
-        ngrams = [ [tuple( random.randint(1,max_ele_value) for _ in range(random.randint(1,max_ngram_size)) ) for _ in range(2000)] for _ in range(num_ngrammaps) ]
-        ngrammaps = [ None for _ in range(num_ngrammaps) ]
-
-        t = time.clock()
-        for i in range(num_ngrammaps):
-            ngrammaps[i] = NGramMap()
-            for ngram in ngrams[i]:
-                ngrammaps[i][ngram] = True
-        print("__setitem__ timing:", round(time.clock() - t, 2))
-
-        items = [ None for _ in range(num_ngrammaps) ]
-
-        t = time.clock()
-        for i in range(num_ngrammaps):
-            items[i] = list(ngrammaps[i].items())
-        print("items timing:", round(time.clock() - t, 2))
-
-        t = time.clock()
-        for i in range(num_ngrammaps):
-            for (ngram, value) in items[i]:
-                ngrammaps[i][ngram]
-        print("__getitem__ timing:", round(time.clock() - t, 2))
+        obj.count_ngrams([ ('a','x','y'), ('x','a','y'), ('a','x','y'), ('b','x','y'), ('c','x','z'), ('x','p','y'), ('x','q','y'), ('a','x'), ('b','x'), ('c','x'), ('a','x','a'), ('b','x','a') ])
+
+        self.assertEqual(obj.context_neighbours('a'), { 'b': 3, 'c': 1, 'p': 1, 'q': 1, 'y': 2 })
+        self.assertEqual(obj.context_neighbours('a', 3), { 'b': 2, 'p': 1, 'q': 1, 'y': 2 })
+        self.assertEqual(obj.context_neighbours('p'), { 'a': 1, 'q': 1 })
+        self.assertEqual(obj.context_neighbours('z'), { })
+        self.assertEqual(obj.context_neighbours('w'), { })
+
+        for size in [ None, 2, 3 ]:
+            table = obj.context_neighbour_table(size)
+            eles = obj.ngram_eles() if size is None else { ele for ngram in obj.sized_ngrams(size) for ele in ngram }
+            self.assertEqual(set(table), eles)
+            for ele in eles:
+                self.assertEqual(table[ele], obj.context_neighbours(ele, size))
+
+    def testSubtreeAggregates(self):
+        for options in [ dict(), dict(radix=True), dict(compact=True) ]:
+            obj = NGramMap(subtree_aggregates=True, **options)
+
+            for a in range(4):
+                for b in range(4):
+                    obj[(a,b)] = a
+                    for c in range(4):
+                        obj[(a,b,c)] = 'x' if c == 3 else c
+            obj.increment((1,2), 10)
+            obj.count_ngrams([ (1,), (1,), (1,2,9) ])
+            obj.add_sequence([ 1, 2, 1, 2 ], 2, 3)
+            obj[(2,2)] = 5
+            obj[(2,2,7,7,7)] = 1.5
+            for ngram in [ (1,1), (1,1,1), (2,0,0), (3,3,3), (1,2,9) ]:
+                del obj[ngram]
+
+            #Counts and sums are checked against every n-gram in the map.
+            items = list(obj.items())
+            for prefix in [ (), (1,), (1,2), (2,0), (2,2,7), (3,3,3), (7,) ]:
+                with_prefix = [ (ngram, value) for (ngram, value) in items if ngram[:len(prefix)] == prefix ]
+                for size in [ None, 1, 2, 3, 4, 5 ]:
+                    self.assertEqual(obj.count_with_prefix(prefix, size), sum(1 for (ngram, _) in with_prefix if size is None or len(ngram) == size))
+                self.assertEqual(obj.value_sum_with_prefix(prefix), sum(value for (_, value) in with_prefix if value != 'x'))
+            self.assertEqual(obj.count_with_prefix((1,2), 3), 4)
+
+            templates = [ ((None, 1, None), { 0, 2 }), ((1, None, 2), { 1 }), ((None, None), { 0, 1 }), ((1, 2), set()), ((7, None), { 1 }), ((2, None, 7, None, 7), { 1, 3 }), ((), set()) ]
+            for (ngram_template, placeholder_indices) in templates:
+                self.assertEqual(obj.count_by_template(ngram_template, placeholder_indices), sum(1 for _ in obj.ngrams_by_template(ngram_template, placeholder_indices)))
+
+            #Maps which both keep value sums are merged node by node, taking over the other map's missing subtrees whole.
+            other = NGramMap({ (1,2): 100, (1,2,3,4): 2, (5,6): 'y', (6,): 7 }, subtree_aggregates=True, **options)
+            subtree = other.root.children[other._key((6,))[0]]
+            expected = dict(items)
+            for (ngram, value) in other.items():
+                expected[ngram] = expected[ngram] + value if ngram in expected else value
+            obj.merge(other)
+            self.assertEqual(dict(obj.items()), expected)
+            if not options:
+                self.assertIs(obj.root.children[6], subtree)
+            for prefix in [ (), (1,), (1,2), (5,), (6,) ]:
+                self.assertEqual(obj.value_sum_with_prefix(prefix), sum(value for (ngram, value) in expected.items() if ngram[:len(prefix)] == prefix and value not in ('x', 'y')))
+            plain = NGramMap({ (1,): 1000 })
+            obj.merge(plain)
+            self.assertEqual(obj.value_sum_with_prefix((1,)), sum(value for (ngram, value) in expected.items() if ngram[:1] == (1,) and value != 'x') + 1000)
+
+            for ngram in list(obj.ngrams()):
+                obj.pop(ngram)
+            self.assertEqual(obj.root.value_sum, 0)
+            self.assertEqual(obj.root.depths, 0)
+            self.assertEqual(len(obj.root.children), 0)
+
+        #Nodes only have value sums in a map which keeps them.
+        self.assertLess(sys.getsizeof(NGramMap(size_index=True).root), sys.getsizeof(NGramMap(subtree_aggregates=True).root))
+
+    def testNodeDepths(self):
+        def check(node):
+            #The number of n-grams ending at each depth below a node, counted from the end of its run in a radix tree.
+            counts = { 0: 1 } if node.end_of_ngram else dict()
+            for child in node.children.values():
+                for (depth, count) in check(child).items():
+                    depth += 1 + len(child.run)
+                    counts[depth] = counts.get(depth, 0) + count
+            self.assertEqual(node.depths, sum(1 << depth for depth in counts))
+            self.assertEqual(node.depth_counts if node.depth_counts is not None else { depth: 1 for depth in counts }, counts)
+            return counts
+
+        random.seed(0)
+        for (radix, size_index) in [ (False, False), (True, False), (False, True), (True, True) ]:
+            obj = NGramMap(radix=radix, size_index=size_index)
+            ngrams = [ tuple( random.randint(1,4) for _ in range(random.randint(0,5)) ) for _ in range(300) ]
+            for ngram in ngrams:
+                obj[ngram] = True
+            obj.add_sequence([ random.randint(1,4) for _ in range(50) ], 2, 6)
+            for ngram in ngrams[:200]:
+                if ngram in obj:
+                    obj.pop(ngram)
+                    if size_index:
+                        check(obj.root)
+            if size_index:
+                self.assertNotEqual(check(obj.root), dict())
+
+            other = NGramMap(size_index=size_index)
+            other.add_sequence([ random.randint(1,5) for _ in range(50) ], 1, 4)
+            obj.merge(other)
+            if size_index:
+                check(obj.root)
+
+            for size in range(8):
+                self.assertEqual(set(obj.sized_ngrams(size)), { ngram for ngram in obj.ngrams() if len(ngram) == size })
+                self.assertEqual(obj.count_with_prefix((1,), size), sum(1 for ngram in obj.ngrams() if len(ngram) == size and ngram[:1] == (1,)))
+                template = ((1, 2, 3) + (None,)*size)[:size]
+                self.assertEqual(obj.count_by_template(template, set(range(3, size))), len(list(obj.ngrams_by_template(template, set(range(3, size))))))
+
+            for ngram in list(obj.ngrams()):
+                obj.pop(ngram)
+            self.assertEqual(len(obj.root.children), 0)
+            if size_index:
+                self.assertEqual((obj.root.depths, obj.root.depth_counts), (0, None))
+
+        #Nodes only have depths in a map with a size index.
+        self.assertLess(sys.getsizeof(NGramMap().root), sys.getsizeof(NGramMap(size_index=True).root))
+
+    def testEleSummary(self):
+        random.seed(0)
+        for num_bits in [ 4, 64 ]:
+            obj = NGramMap(ele_summary_bits=num_bits)
+            expected = NGramMap()
+
+            ngrams = [ tuple( random.randint(1,20) for _ in range(random.randint(0,5)) ) for _ in range(500) ]
+            for ngram in ngrams:
+                obj[ngram] = True
+                expected[ngram] = True
+            for ngram in ngrams[:300]:
+                if ngram in obj:
+                    obj.pop(ngram)
+                    expected.pop(ngram)
+            for ngram in ngrams[250:350]:
+                obj[ngram] = True
+                expected[ngram] = True
+
+            for targets in [ { 1 }, { 2, 3 }, { 4, 5, 6 }, { 21 }, set() ]:
+                self.assertEqual(set(obj.ngrams_with_all_eles(targets)), set(expected.ngrams_with_all_eles(targets)))
+                for size in range(6):
+                    self.assertEqual(set(obj.sized_ngrams_with_all_eles(targets, size)), set(expected.sized_ngrams_with_all_eles(targets, size)))
+            for target in [ 1, 7, 21 ]:
+                self.assertEqual(set(obj.ngrams_with_ele(target)), set(expected.ngrams_with_ele(target)))
+                for size in range(6):
+                    self.assertEqual(set(obj.sized_ngrams_with_ele(target, size)), set(expected.sized_ngrams_with_ele(target, size)))
+
+            #A map without an element summary takes the n-grams of a map with one one by one.
+            merged = NGramMap()
+            merged.merge(obj)
+            self.assertEqual(merged, expected)
+            self.assertTrue(all(type(child) is type(merged.root) for child in merged.root.children.values()))
+
+        #Nodes only have element summaries in a map which keeps them.
+        self.assertLess(sys.getsizeof(NGramMap().root), sys.getsizeof(NGramMap(ele_summary_bits=64).root))
+
+    def testCompact(self):
+        random.seed(0)
+        obj = NGramMap(compact=True, ele_index=True, position_index=True, suffix_tree=True, subtree_aggregates=True, ele_summary_bits=16)
+        expected = NGramMap()
+
+        ngrams = [ tuple( 'e%d'%random.randint(1,20) for _ in range(random.randint(0,5)) ) for _ in range(500) ]
+        for ngram in ngrams:
+            obj.increment(ngram)
+            expected.increment(ngram)
+        for ngram in ngrams[:300]:
+            if ngram in obj:
+                obj.pop(ngram)
+                expected.pop(ngram)
+        obj.add_sequence(['e1', 'e2', 'e1', 'e30'], 1, 3)
+        expected.add_sequence(['e1', 'e2', 'e1', 'e30'], 1, 3)
+
+        self.assertEqual(obj, expected)
+        self.assertEqual(set(obj.items()), set(expected.items()))
+        self.assertEqual(obj.ngram_eles(), expected.ngram_eles())
+        self.assertEqual(obj.num_of_ele('e1'), expected.num_of_ele('e1'))
+        self.assertEqual(set(obj.ngrams_with_ele('e1')), set(expected.ngrams_with_ele('e1')))
+        self.assertEqual(set(obj.sized_ngrams_with_all_eles({ 'e1', 'e2' }, 3)), set(expected.sized_ngrams_with_all_eles({ 'e1', 'e2' }, 3)))
+        self.assertEqual(set(obj.ngrams_by_template(('e1', None, 'e1'), [ 1 ])), set(expected.ngrams_by_template(('e1', None, 'e1'), [ 1 ])))
+        self.assertEqual(set(obj.ngrams_with_prefix(('e1',))), set(expected.ngrams_with_prefix(('e1',))))
+        self.assertEqual(set(obj.ngrams_with_suffix(('e1',), 2)), set(expected.ngrams_with_suffix(('e1',), 2)))
+        self.assertEqual(obj.count_with_prefix(('e2',)), expected.count_with_prefix(('e2',)))
+        self.assertEqual(obj.context_neighbours('e1'), expected.context_neighbours('e1'))
+
+        #Elements which were never added are simply not found.
+        self.assertFalse(('e99',) in obj)
+        self.assertRaises(KeyError, obj.__getitem__, ('e99',))
+        self.assertRaises(KeyError, obj.pop, ('e1', 'e99'))
+        self.assertRaises(KeyError, obj.num_of_ele, 'e99')
+        self.assertEqual(set(obj.ngrams_with_ele('e99')), set())
+        self.assertEqual(obj.count_with_prefix(('e99',)), 0)
+
+    def testRadix(self):
+        def check_compressed(node, is_root):
+            #Every node other than the root either ends an n-gram or branches.
+            if not is_root:
+                self.assertTrue(node.end_of_ngram or len(node.children) > 1)
+            for child in node.children.values():
+                check_compressed(child, False)
+
+        random.seed(0)
+        for options in [ dict(), dict(compact=True, suffix_tree=True, ele_summary_bits=16) ]:
+            obj = NGramMap(radix=True, **options)
+            expected = NGramMap()
+
+            ngrams = [ tuple( random.randint(1,4) for _ in range(random.randint(0,8)) ) for _ in range(300) ]
+            for ngram in ngrams:
+                obj.increment(ngram)
+                expected.increment(ngram)
+            for ngram in ngrams[:200]:
+                if ngram in obj:
+                    obj.pop(ngram)
+                    expected.pop(ngram)
+                    check_compressed(obj.root, True)
+            obj.add_sequence([ 1, 2, 3, 1, 2, 4 ], 2, 4)
+            expected.add_sequence([ 1, 2, 3, 1, 2, 4 ], 2, 4)
+            check_compressed(obj.root, True)
+
+            self.assertEqual(set(obj.items()), set(expected.items()))
+            self.assertEqual(sorted(obj.values()), sorted(expected.values()))
+            for ngram in ngrams:
+                self.assertEqual(ngram in obj, ngram in expected)
+                self.assertEqual(ngram[:3] in obj, ngram[:3] in expected)
+            for size in range(10):
+                self.assertEqual(set(obj.sized_ngrams(size)), set(expected.sized_ngrams(size)))
+                self.assertEqual(set(obj.sized_ngrams_with_ele(2, size)), set(expected.sized_ngrams_with_ele(2, size)))
+                self.assertEqual(set(obj.sized_ngrams_with_all_eles({ 1, 3 }, size)), set(expected.sized_ngrams_with_all_eles({ 1, 3 }, size)))
+            self.assertEqual(set(obj.ngrams_with_ele(3)), set(expected.ngrams_with_ele(3)))
+            self.assertEqual(set(obj.ngrams_with_all_eles({ 1, 4 })), set(expected.ngrams_with_all_eles({ 1, 4 })))
+            for prefix in [ (), (1,), (1, 2), (2, 3, 4), (4, 4, 4, 4, 4) ]:
+                self.assertEqual(set(obj.ngrams_with_prefix(prefix)), set(expected.ngrams_with_prefix(prefix)))
+                self.assertEqual(set(obj.ngrams_with_prefix(prefix, 6)), set(expected.ngrams_with_prefix(prefix, 6)))
+                self.assertEqual(set(obj.ngrams_with_suffix(prefix)), set(expected.ngrams_with_suffix(prefix)))
+                self.assertEqual(obj.value_sum_with_prefix(prefix), expected.value_sum_with_prefix(prefix))
+            for ngram in ngrams[:50]:
+                placeholder_indices = { i for i in range(len(ngram)) if random.random() > 0.5 }
+                self.assertEqual(set(obj.ngrams_by_template(ngram, placeholder_indices)), set(expected.ngrams_by_template(ngram, placeholder_indices)))
+
+            for ngram in list(expected.ngrams()):
+                self.assertEqual(obj.pop(ngram), expected.pop(ngram))
+            self.assertEqual(len(obj), 0)
+            self.assertEqual(len(obj.root.children), 0)
+
+    def testFreeze(self):
+        random.seed(0)
+        for options in [ dict(), dict(compact=True), dict(radix=True) ]:
+            obj = NGramMap(**options)
+            ngrams = [ tuple( random.randint(1,6) for _ in range(random.randint(0,5)) ) for _ in range(300) ]
+            obj.count_ngrams(ngrams)
+            frozen = obj.freeze()
+
+            self.assertEqual(frozen, obj)
+            self.assertEqual(len(frozen), len(obj))
+            self.assertEqual(sorted(frozen.values()), sorted(obj.values()))
+            self.assertEqual(set(frozen.items()), set(obj.items()))
+            self.assertEqual(list(frozen.values()), [ value for (_, value) in frozen.items() ])
+            self.assertEqual(list(zip(frozen.ngrams(), frozen.values())), list(frozen.items()))
+            for ngram in ngrams + [ (7,), (1, 7), (1, 2, 3, 4, 5, 6) ]:
+                self.assertEqual(ngram in frozen, ngram in obj)
+                if ngram in obj:
+                    self.assertEqual(frozen[ngram], obj[ngram])
+                else:
+                    self.assertRaises(KeyError, frozen.__getitem__, ngram)
+            for size in range(6):
+                self.assertEqual(set(frozen.sized_ngrams(size)), set(obj.sized_ngrams(size)))
+            for target in [ 1, 6, 7 ]:
+                self.assertEqual(set(frozen.ngrams_with_ele(target)), set(obj.ngrams_with_ele(target)))
+            for ngram in ngrams[:50]:
+                placeholder_indices = { i for i in range(len(ngram)) if random.random() > 0.5 }
+                self.assertEqual(set(frozen.ngrams_by_template(ngram, placeholder_indices)), set(obj.ngrams_by_template(ngram, placeholder_indices)))
+
+            #Later changes to the map do not affect the frozen copy.
+            obj[(9, 9)] = 1
+            self.assertFalse((9, 9) in frozen)
+
+        #Values are given in the same order as the n-grams even though they are stored breadth first.
+        frozen = NGramMap({ ('a', 'x'): 1, ('b',): 2, ('a',): 3, ('b', 'y'): 4 }).freeze()
+        self.assertEqual(list(frozen.values()), [ value for (_, value) in frozen.items() ])
+
+        #Values are kept in typed arrays where possible.
+        self.assertEqual(NGramMap({ (1,): 1.5, (2,): 2.5 }).freeze().ngram_values.typecode, 'd')
+        self.assertEqual(NGramMap({ (1,): 'x', (2,): 2 }).freeze()[(1,)], 'x')
+        self.assertEqual(NGramMap({ (1,): True }).freeze()[(1,)], True)
+
+    def testGetMany(self):
+        random.seed(0)
+        ngrams = [ tuple( random.randint(1,6) for _ in range(random.randint(0,4)) ) for _ in range(300) ]
+        queries = ngrams + [ (7,), (1, 7), (1, 2, 3, 4, 5) ]
+        for obj in [ NGramMap(), NGramMap(compact=True), NGramMap(radix=True) ]:
+            obj.count_ngrams(ngrams)
+            for batch_obj in [ obj, obj.freeze() ]:
+                self.assertEqual(batch_obj.get_many(queries, 0), [ obj[ngram] if ngram in obj else 0 for ngram in queries ])
+                self.assertEqual(batch_obj.contains_many(iter(queries)), [ ngram in obj for ngram in queries ])
+                if obj.vocab is not None or batch_obj is not obj:
+                    rows = [ array.array('q', batch_obj.ngram_ids(ngram)) for ngram in queries ]
+                    self.assertEqual(batch_obj.get_many(rows, ids=True), [ obj[ngram] if ngram in obj else None for ngram in queries ])
+                    self.assertEqual(batch_obj.contains_many(rows, ids=True), [ ngram in obj for ngram in queries ])
+                else:
+                    self.assertRaises(ValueError, batch_obj.get_many, [ (0,) ], ids=True)
+
+    def testSaveOpen(self):
+        random.seed(0)
+        ngrams = [ tuple( random.randint(1,6) for _ in range(random.randint(0,4)) ) for _ in range(300) ]
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join(dir_path, 'ngrams.bin')
+            for values in [ None, 'float', 'object' ]:
+                obj = NGramMap()
+                obj.count_ngrams(ngrams)
+                if values == 'float':
+                    for ngram in list(obj.ngrams()):
+                        obj[ngram] = obj[ngram]/2
+                elif values == 'object':
+                    obj[(1, 2)] = 'x'
+                obj.save(path)
+                for mmap in [ True, False ]:
+                    opened = NGramMap.open(path, mmap=mmap, allow_pickle=True)
+                    self.assertEqual(opened, obj)
+                    self.assertEqual(len(opened), len(obj))
+                    self.assertEqual(opened.get_many([ (1, 2), (7,) ]), [ obj[(1, 2)], None ])
+                    self.assertEqual(set(opened.ngrams_by_template((1, None), { 1 })), set(obj.ngrams_by_template((1, None), { 1 })))
+                    self.assertEqual(list(opened.values()), [ value for (_, value) in opened.items() ])
+                    del opened
+
+            with open(path, 'wb') as f:
+                f.write(b'not an n-gram map file')
+            self.assertRaises(ValueError, NGramMap.open, path)
+
+    def testOpenWithoutPickle(self):
+        with tempfile.TemporaryDirectory() as dir_path:
+            path = os.path.join(dir_path, 'ngrams.bin')
+
+            #Maps of strings and numbers are saved without pickling so they are opened by default.
+            for mapping in [ { ('a', 'b'): 1, ('caf\u00e9',): 2, ('\u65e5\u672c', 'a'): 3, (): 4 }, { (1, 2): 0.5, (-3,): 1.5 }, { ('a', 'b'): 'x', ('b',): '\u00e9' }, dict() ]:
+                obj = NGramMap(mapping)
+                obj.save(path)
+                for mmap in [ True, False ]:
+                    opened = NGramMap.open(path, mmap=mmap)
+                    self.assertEqual(opened, obj)
+                    self.assertEqual(opened.size_freqs, obj.size_freqs)
+                    self.assertEqual(list(opened.ngrams_with_ele('a')), list(obj.freeze().ngrams_with_ele('a')))
+                    del opened
+                block = obj.publish()
+                try:
+                    self.assertEqual(NGramMap.attach(block.name), obj)
+                finally:
+                    block.close()
+                    block.unlink()
+
+            with NGramMapBuilder(max_ngrams=10, temp_dir=dir_path) as builder:
+                builder.add_sequence('a b c a b d'.split(), 1, 3)
+                builder.save(path)
+                self.assertEqual(NGramMap.open(path), builder.build())
+
+            #Other elements and values, and strings which cannot be encoded, are pickled and are only opened if allowed.
+            for mapping in [ { (('a', 1),): 1 }, { ('a',): [ 1 ] }, { ('a', 1): 1 }, { ('\ud800',): 1 } ]:
+                obj = NGramMap(mapping)
+                obj.save(path)
+                self.assertRaises(ValueError, lambda:NGramMap.open(path))
+                self.assertRaises(ValueError, lambda:FrozenNGramMap.open(path, mmap=False))
+                self.assertRaises(ValueError, lambda:NGramMap.open(path, allow_pickle=False))
+                self.assertEqual(NGramMap.open(path, allow_pickle=True), obj)
+                block = obj.publish()
+                try:
+                    self.assertRaises(ValueError, lambda:NGramMap.attach(block.name))
+                    self.assertRaises(ValueError, lambda:FrozenNGramMap.attach(block.name))
+                    self.assertEqual(NGramMap.attach(block.name, allow_pickle=True), obj)
+                finally:
+                    block.close()
+                    block.unlink()
+
+    def testPublishAttach(self):
+        random.seed(0)
+        ngrammap = NGramMap()
+        for _ in range(20):
+            ngrammap.add_sequence([ random.choice('abcdefgh') for _ in range(50) ], 1, 4)
+        ngrams = list(ngrammap.ngrams()) + [ ('x',), ('a', 'x') ]
+
+        for values in [ None, 'str' ]:
+            if values == 'str':
+                ngrammap = NGramMap({ ngram: str(value) for (ngram, value) in ngrammap.items() })
+            block = ngrammap.publish()
+            try:
+                attached = NGramMap.attach(block.name)
+                self.assertEqual(attached, ngrammap)
+                self.assertEqual(len(attached), len(ngrammap))
+                self.assertEqual(set(attached.ngrams_with_ele('a')), set(ngrammap.ngrams_with_ele('a')))
+                self.assertEqual(attached.get_many(ngrams), ngrammap.get_many(ngrams))
+
+                #A worker process attaches by name and sends back its lookups.
+                (conn, worker_conn) = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=attached_lookup, args=(worker_conn, block.name, ngrams))
+                process.start()
+                self.assertTrue(conn.poll(60))
+                self.assertEqual(conn.recv(), ngrammap.get_many(ngrams))
+                process.join()
+                del attached
+            finally:
+                block.close()
+                block.unlink()
+
+    def testBuilder(self):
+        random.seed(0)
+        sequences = [ [ random.randint(1,8) for _ in range(50) ] for _ in range(30) ]
+        expected = NGramMap()
+        for sequence in sequences:
+            expected.add_sequence(sequence, 1, 4)
+        expected.count_ngrams([ (1, 2, 3, 4, 5, 6), (), (1, 2, 3, 4, 5, 6) ])
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            with NGramMapBuilder(max_ngrams=50, temp_dir=dir_path) as builder:
+                for sequence in sequences:
+                    builder.add_sequence(sequence, 1, 4)
+                builder.count_ngrams([ (1, 2, 3, 4, 5, 6), (), (1, 2, 3, 4, 5, 6) ])
+                self.assertTrue(len(builder.counts) < 50)
+
+                self.assertEqual(builder.build(), expected)
+                self.assertEqual(builder.build(compact=True, radix=True), expected)
+
+                path = os.path.join(dir_path, 'ngrams.bin')
+                builder.save(path)
+                opened = NGramMap.open(path)
+                self.assertEqual(opened, expected)
+                self.assertEqual(len(opened), len(expected))
+                self.assertEqual(opened.ngram_sizes(), expected.ngram_sizes())
+                del opened
+
+        with NGramMapBuilder() as builder:
+            self.assertEqual(len(builder.build()), 0)
+
+    def testMerge(self):
+        random.seed(0)
+        sequences = [ [ random.randint(1,8) for _ in range(30) ] for _ in range(20) ]
+        expected = NGramMap()
+        for sequence in sequences:
+            expected.add_sequence(sequence, 1, 4)
+        expected.add_sequence([ 9, 10 ], 1, 2)
+        expected.pop((9, 10))
+
+        options = [ dict(), dict(compact=True), dict(radix=True), dict(ele_index=True, subtree_aggregates=True) ]
+        for self_options in options:
+            for other_options in options:
+                ngrammap = NGramMap(**self_options)
+                other = NGramMap(**other_options)
+                for sequence in sequences[:12]:
+                    ngrammap.add_sequence(sequence, 1, 4)
+                for sequence in sequences[12:]:
+                    other.add_sequence(sequence, 1, 4)
+                other.add_sequence([ 9, 10 ], 1, 2)
+                other.pop((9, 10))
+                ngrammap.merge(other)
+                self.assertEqual(ngrammap, expected)
+                self.assertEqual(len(other), 0)
+                self.assertEqual(len(ngrammap), len(expected))
+                self.assertEqual(ngrammap.size_freqs, expected.size_freqs)
+                self.assertEqual(ngrammap.ngram_eles(), expected.ngram_eles())
+                self.assertEqual({ ele: ngrammap.num_of_ele(ele) for ele in expected.ngram_eles() }, { ele: expected.num_of_ele(ele) for ele in expected.ngram_eles() })
+                self.assertEqual(set(ngrammap.sized_ngrams(3)), set(expected.sized_ngrams(3)))
+                self.assertEqual(set(ngrammap.ngrams_with_ele(5)), set(expected.ngrams_with_ele(5)))
+
+                ngrammap[(1, 2, 3)] = 0
+                ngrammap.pop((1, 2, 3))
+                self.assertEqual(len(ngrammap), len(expected) - 1 if (1, 2, 3) in expected else len(expected))
+                self.assertEqual(len(other), 0)
+
+        ngrammap = NGramMap({ ('a',): 1, ('a', 'b'): 2 })
+        ngrammap.merge(NGramMap({ ('a', 'b'): 3, ('c',): 4 }), max)
+        self.assertEqual(ngrammap, NGramMap({ ('a',): 1, ('a', 'b'): 3, ('c',): 4 }))
+        ngrammap.merge(ngrammap)
+        self.assertEqual(ngrammap, NGramMap({ ('a',): 2, ('a', 'b'): 6, ('c',): 8 }))
+        frozen = NGramMap({ ('c',): 1 }).freeze()
+        ngrammap.merge(frozen)
+        self.assertEqual(ngrammap[('c',)], 9)
+        self.assertEqual(len(frozen), 1)
+
+        ngrammap = NGramMap({ ('a',): 1, ('a', 'b'): 2 })
+        other = NGramMap({ ('a', 'b'): 3, ('c',): 4 })
+        ngrammap.update(other)
+        self.assertEqual(ngrammap, NGramMap({ ('a',): 1, ('a', 'b'): 3, ('c',): 4 }))
+        ngrammap.update(other, lambda a, b: a + b)
+        self.assertEqual(ngrammap, NGramMap({ ('a',): 1, ('a', 'b'): 6, ('c',): 8 }))
+        self.assertEqual(other, NGramMap({ ('a', 'b'): 3, ('c',): 4 }))
+
+    def testSharded(self):
+        random.seed(0)
+        sequences = [ [ random.randint(1,8) for _ in range(200) ] for _ in range(20) ]
+        expected = NGramMap()
+        for sequence in sequences:
+            expected.add_sequence(sequence, 1, 4)
+        expected.count_ngrams([ (1, 2, 3, 4, 5, 6), (), (1, 2, 3, 4, 5, 6) ])
+
+        for options in [ dict(), dict(compact=True, ele_index=True, position_index=True, subtree_aggregates=True) ]:
+            with ShardedNGramMap(num_shards=3, **options) as sharded:
+                for sequence in sequences:
+                    sharded.add_sequence(sequence, 1, 4)
+                sharded.count_ngrams([ (1, 2, 3, 4, 5, 6), (), (1, 2, 3, 4, 5, 6) ])
+
+                self.assertEqual(sharded, expected)
+                self.assertEqual(len(sharded), len(expected))
+                self.assertEqual(set(sharded), set(expected))
+                self.assertEqual(sorted(sharded.values()), sorted(expected.values()))
+                self.assertEqual(sharded.ngram_sizes(), set(expected.ngram_sizes()))
+                self.assertEqual(sharded.num_of_size(3), expected.num_of_size(3))
+                self.assertEqual(sharded.ngram_eles(), expected.ngram_eles())
+                self.assertEqual(sharded.num_of_ele(5), expected.num_of_ele(5))
+                self.assertRaises(KeyError, lambda:sharded.num_of_ele(9))
+                self.assertRaises(TypeError, lambda:sharded.num_of_ele([ 5 ]))
+                self.assertRaises(KeyError, lambda:sharded.num_of_size(5))
+                self.assertEqual(sharded[(1, 2, 3, 4, 5, 6)], 2)
+                self.assertEqual(sharded[()], 1)
+                self.assertRaises(KeyError, lambda:sharded[(9,)])
+                self.assertFalse((9,) in sharded)
+
+                self.assertEqual(set(sharded.sized_ngrams(3)), set(expected.sized_ngrams(3)))
+                self.assertEqual(set(sharded.ngrams_with_ele(5)), set(expected.ngrams_with_ele(5)))
+                self.assertEqual(set(sharded.sized_ngrams_with_ele(5, 2)), set(expected.sized_ngrams_with_ele(5, 2)))
+                self.assertEqual(set(sharded.ngrams_with_all_eles({ 1, 5 })), set(expected.ngrams_with_all_eles({ 1, 5 })))
+                self.assertEqual(set(sharded.sized_ngrams_with_all_eles({ 1, 5 }, 3)), set(expected.sized_ngrams_with_all_eles({ 1, 5 }, 3)))
+                self.assertEqual(set(sharded.ngrams_with_prefix((1, 2))), set(expected.ngrams_with_prefix((1, 2))))
+                self.assertEqual(set(sharded.ngrams_with_prefix((), 1)), set(expected.ngrams_with_prefix((), 1)))
+                self.assertEqual(set(sharded.ngrams_with_suffix((1, 2))), set(expected.ngrams_with_suffix((1, 2))))
+                for placeholder_indices in [ { 0 }, { 1 }, { 0, 2 } ]:
+                    self.assertEqual(set(sharded.ngrams_by_template((1, 2, 3), placeholder_indices)), set(expected.ngrams_by_template((1, 2, 3), placeholder_indices)))
+                    self.assertEqual(sharded.count_by_template((1, 2, 3), placeholder_indices), expected.count_by_template((1, 2, 3), placeholder_indices))
+                self.assertEqual(sharded.count_with_prefix((1,), 3), expected.count_with_prefix((1,), 3))
+                self.assertEqual(sharded.count_with_prefix(()), expected.count_with_prefix(()))
+                self.assertEqual(sharded.value_sum_with_prefix((1,)), expected.value_sum_with_prefix((1,)))
+                self.assertEqual(sharded.context_neighbours(5, 2), expected.context_neighbours(5, 2))
+
+                ngrams = list(expected.ngrams())[:50] + [ (9,), (1, 9) ]
+                self.assertEqual(sharded.get_many(ngrams, default=0), expected.get_many(ngrams, default=0))
+                self.assertEqual(sharded.contains_many(ngrams), expected.contains_many(ngrams))
+
+                #Abandoned iterators and other requests during an iteration.
+                next(iter(sharded.ngrams()))
+                for (i, (ngram, value)) in enumerate(sharded.items()):
+                    if i % 100 == 0:
+                        self.assertEqual(sharded[ngram], value)
+
+                self.assertEqual(sharded.increment((1, 2)), expected[(1, 2)] + 1)
+                self.assertEqual(sharded.pop((1, 2)), expected[(1, 2)] + 1)
+                del sharded[(2, 1)]
+                sharded[(9, 9)] = 'x'
+                self.assertEqual(sharded[(9, 9)], 'x')
+                self.assertEqual(len(sharded), len(expected) - 1)
+                self.assertRaises(KeyError, lambda:sharded.pop((1, 2)))
+
+                sharded.clear()
+                self.assertEqual(len(sharded), 0)
+                self.assertEqual(list(sharded.items()), [])
+
+    def testConcurrent(self):
+        random.seed(0)
+        sequences = [ [ random.randint(1,8) for _ in range(50) ] for _ in range(20) ]
+        expected = NGramMap()
+        concurrent = ConcurrentNGramMap(num_stripes=4)
+        for sequence in sequences:
+            expected.add_sequence(sequence, 1, 4)
+            concurrent.add_sequence(sequence, 1, 4)
+        expected.count_ngrams([ (1, 2, 3, 4, 5, 6), (), (1, 2, 3, 4, 5, 6) ])
+        concurrent.count_ngrams([ (1, 2, 3, 4, 5, 6), (), (1, 2, 3, 4, 5, 6) ])
+
+        self.assertEqual(concurrent, expected)
+        self.assertEqual(len(concurrent), len(expected))
+        self.assertEqual(concurrent.ngram_sizes(), set(expected.ngram_sizes()))
+        self.assertEqual(concurrent.num_of_size(3), expected.num_of_size(3))
+        self.assertRaises(KeyError, lambda:concurrent.num_of_size(5))
+        self.assertEqual(concurrent[()], 1)
+        self.assertRaises(KeyError, lambda:concurrent[(9,)])
+        self.assertEqual(set(concurrent.sized_ngrams(3)), set(expected.sized_ngrams(3)))
+        self.assertEqual(set(concurrent.ngrams_with_ele(5)), set(expected.ngrams_with_ele(5)))
+        self.assertEqual(set(concurrent.ngrams_with_all_eles({ 1, 5 })), set(expected.ngrams_with_all_eles({ 1, 5 })))
+        self.assertEqual(set(concurrent.ngrams_with_prefix((1, 2))), set(expected.ngrams_with_prefix((1, 2))))
+        self.assertEqual(set(concurrent.ngrams_with_suffix((1, 2), 3)), set(expected.ngrams_with_suffix((1, 2), 3)))
+        for placeholder_indices in [ { 0 }, { 1 }, { 0, 2 } ]:
+            self.assertEqual(set(concurrent.ngrams_by_template((1, 2, 3), placeholder_indices)), set(expected.ngrams_by_template((1, 2, 3), placeholder_indices)))
+        ngrams = list(expected.ngrams())[:50] + [ (9,), (1, 9) ]
+        self.assertEqual(concurrent.get_many(ngrams, 0), expected.get_many(ngrams, 0))
+        self.assertEqual(concurrent.contains_many(ngrams), expected.contains_many(ngrams))
+
+        #A snapshot and an iterator which has already started are not affected by later changes.
+        snapshot = concurrent.snapshot()
+        items = concurrent.items()
+        first_item = next(items)
+        for ngram in list(expected.ngrams()):
+            if ngram[:1] != (1,):
+                concurrent.pop(ngram)
+        concurrent[(9, 9)] = 'x'
+        self.assertEqual(snapshot, expected)
+        self.assertEqual(len(snapshot), len(expected))
+        self.assertEqual(dict([ first_item ] + list(items)), dict(expected.items()))
+        self.assertEqual(set(concurrent), set(expected.ngrams_with_prefix((1,))) | { (9, 9) })
+        self.assertEqual(set(concurrent.sized_ngrams(2)), set(expected.ngrams_with_prefix((1,), 2)) | { (9, 9) })
+        self.assertEqual(len(concurrent), len(set(concurrent)))
+        self.assertRaises(KeyError, lambda:concurrent.pop((2,)))
+        self.assertEqual(concurrent.increment((9, 9, 9), 3), 3)
+
+        concurrent.clear()
+        self.assertEqual(len(concurrent), 0)
+        self.assertEqual(list(concurrent.items()), [])
+
+        #A node with many children shares them with the versions which snapshots are using, which are not affected by later changes.
+        concurrent = ConcurrentNGramMap({ (0, i): i for i in range(200) }, num_stripes=1)
+        snapshot = concurrent.snapshot()
+        for i in range(0, 200, 2):
+            concurrent.pop((0, i))
+        concurrent[(0, 'x')] = 'x'
+        self.assertEqual(dict(snapshot.items()), { (0, i): i for i in range(200) })
+        self.assertEqual(dict(concurrent.items()), dict([ ((0, i), i) for i in range(1, 200, 2) ] + [ ((0, 'x'), 'x') ]))
+        self.assertEqual(concurrent.get_many([ (0, 1), (0, 2), (0, 'x') ]), [ 1, None, 'x' ])
+
+    def testConcurrentStress(self):
+        #Writers count and remove n-grams while readers iterate over the map, where every snapshot must be internally consistent.
+        concurrent = ConcurrentNGramMap(num_stripes=8)
+        errors = list()
+        stop = threading.Event()
+
+        def write(seed):
+            try:
+                rng = random.Random(seed)
+                for i in range(300):
+                    tokens = [ rng.randint(1, 20) for _ in range(10) ]
+                    concurrent.add_sequence(tokens, 1, 3)
+                    ngram = tuple(tokens[:2])
+                    if ngram in concurrent and rng.random() < 0.5:
+                        try:
+                            concurrent.pop(ngram)
+                        except KeyError:
+                            pass
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                while not stop.is_set():
+                    snapshot = concurrent.snapshot()
+                    items = list(snapshot.items())
+                    self.assertEqual(len(items), len(snapshot))
+                    self.assertEqual(len(set(ngram for (ngram, _) in items)), len(items))
+                    self.assertTrue(all(value > 0 for (_, value) in items))
+                    for size in snapshot.ngram_sizes():
+                        self.assertEqual(sum(1 for _ in snapshot.sized_ngrams(size)), snapshot.num_of_size(size))
+                    list(concurrent.ngrams_by_template((None, 5), { 0 }))
+                    list(concurrent.ngrams_with_ele(7))
+            except Exception as e:
+                errors.append(e)
+
+        #Threads are switched far more often than usual so that they interleave inside the map's methods.
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            writers = [ threading.Thread(target=write, args=(seed,)) for seed in range(4) ]
+            readers = [ threading.Thread(target=read) for _ in range(3) ]
+            for thread in writers + readers:
+                thread.start()
+            for thread in writers:
+                thread.join()
+            stop.set()
+            for thread in readers:
+                thread.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+        self.assertEqual(errors, [])
+
+        self.assertEqual(len(concurrent), sum(1 for _ in concurrent.items()))
+        self.assertEqual(sum(concurrent.num_of_size(size) for size in concurrent.ngram_sizes()), len(concurrent))
+
+        concurrent = ConcurrentNGramMap(num_stripes=8)
+        expected = NGramMap()
+        rng = random.Random(0)
+        sequences = [ [ rng.randint(1, 20) for _ in range(10) ] for _ in range(400) ]
+        for sequence in sequences:
+            expected.add_sequence(sequence, 1, 3)
+        threads = [ threading.Thread(target=lambda part=part:[ concurrent.add_sequence(sequence, 1, 3) for sequence in part ]) for part in [ sequences[i::4] for i in range(4) ] ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(concurrent, expected)
+
+    def testPersistent(self):
+        random.seed(0)
+        sequences = [ [ random.randint(1,8) for _ in range(50) ] for _ in range(20) ]
+        expected = NGramMap()
+        version = PersistentNGramMap(num_stripes=4)
+        versions = [ version ]
+        for sequence in sequences:
+            expected.add_sequence(sequence, 1, 4)
+            version = version.add_sequence(sequence, 1, 4)
+            versions.append(version)
+        self.assertEqual(version, expected)
+        self.assertEqual(len(version), len(expected))
+        self.assertEqual(version.ngram_sizes(), set(expected.ngram_sizes()))
+        self.assertEqual(set(version.sized_ngrams(3)), set(expected.sized_ngrams(3)))
+        self.assertEqual(set(version.ngrams_by_template((1, 2, 3), { 1 })), set(expected.ngrams_by_template((1, 2, 3), { 1 })))
+        self.assertEqual(len(versions[0]), 0)
+        self.assertIs(version.snapshot(), version)
+
+        #Every change gives a new version and leaves the old one as it was, sharing the untouched nodes.
+        ngram = next(iter(expected.ngrams_with_prefix((1, 2), 3)))
+        popped = version.pop(ngram)
+        incremented = popped.increment((1, 2), 10)
+        assigned = incremented.set((9, 9), 'x')
+        self.assertEqual(version, expected)
+        self.assertFalse(ngram in popped)
+        self.assertEqual(len(popped), len(expected) - 1)
+        self.assertEqual(incremented[(1, 2)], expected[(1, 2)] + 10)
+        self.assertEqual(popped[(1, 2)], expected[(1, 2)])
+        self.assertEqual(assigned[(9, 9)], 'x')
+        self.assertFalse((9, 9) in incremented)
+        self.assertEqual(len(assigned), len(expected))
+        self.assertEqual(set(popped.sized_ngrams(3)), set(expected.sized_ngrams(3)) - { ngram })
+        self.assertRaises(KeyError, lambda:popped.pop(ngram))
+
+        stripe = popped.stripes.index(next(stripe for stripe in popped.stripes if stripe not in version.stripes))
+        self.assertEqual(sum(1 for i in range(4) if popped.stripes[i] is version.stripes[i]), 3)
+        (root, old_root) = (popped.stripes[stripe][0], version.stripes[stripe][0])
+        self.assertTrue(all(root.children[ele] is old_root.children[ele] for ele in old_root.children if ele != 1))
+        self.assertFalse(root.children[1] is old_root.children[1])
+
+        self.assertEqual(PersistentNGramMap(expected), expected)
+        self.assertEqual(PersistentNGramMap({ (1, 2): 3 }).count_ngrams([ (1, 2), (1, 2), () ]), NGramMap({ (1, 2): 5, (): 1 }))
+
+        #A node with many children shares them between versions, where every version keeps its own children (including elements with equal hashes).
+        rng = random.Random(0)
+        version = PersistentNGramMap({ (0, i): i for i in range(1000) }, num_stripes=1)
+        versions = [ (version, dict(version.items())) ]
+        for _ in range(300):
+            (version, expected_items) = rng.choice(versions)
+            expected_items = dict(expected_items)
+            ngram = (0, rng.choice([ rng.randrange(1100), -1, -2, 2**61 - 1, 'x' ]))
+            if ngram in expected_items and rng.random() < 0.4:
+                version = version.pop(ngram)
+                del expected_items[ngram]
+            else:
+                version = version.increment(ngram, 1)
+                expected_items[ngram] = expected_items.get(ngram, 0) + 1
+            versions.append((version, expected_items))
+        for (version, expected_items) in versions:
+            self.assertEqual(dict(version.items()), expected_items)
+            self.assertEqual(len(version), len(expected_items))
+            self.assertEqual(set(version.ngrams_with_prefix((0,), 2)), set(expected_items))
+            self.assertEqual(version.get_many(list(expected_items), 0), list(expected_items.values()))
+        for ngram in expected_items:
+            version = version.pop(ngram)
+        self.assertEqual(len(version), 0)
+        self.assertEqual(list(version.items()), [])
+        self.assertEqual(len(versions[0][0]), 1000)
+
+    def testAsync(self):
+        random.seed(0)
+        sequences = [ [ random.randint(1,8) for _ in range(50) ] for _ in range(20) ]
+        expected = NGramMap()
+        for sequence in sequences:
+            expected.add_sequence(sequence, 1, 3)
+
+        async def collect(iterator):
+            return [ result async for result in iterator ]
+
+        async def run():
+            asynchronous = AsyncNGramMap(num_stripes=4, batch_size=10)
+            await asynchronous.add_batch(sequences[:10], 1, 3)
+            for sequence in sequences[10:]:
+                await asynchronous.add_sequence(sequence, 1, 3)
+            self.assertEqual(asynchronous.snapshot(), expected)
+            self.assertEqual(len(asynchronous), len(expected))
+
+            self.assertEqual(set(await collect(asynchronous)), set(expected.ngrams()))
+            self.assertEqual(dict(await collect(asynchronous.items())), dict(expected.items()))
+            self.assertEqual(sorted(await collect(asynchronous.values())), sorted(expected.values()))
+            self.assertEqual(set(await collect(asynchronous.sized_ngrams(2))), set(expected.sized_ngrams(2)))
+            self.assertEqual(set(await collect(asynchronous.ngrams_with_ele(5))), set(expected.ngrams_with_ele(5)))
+            self.assertEqual(set(await collect(asynchronous.ngrams_with_all_eles({ 1, 5 }))), set(expected.ngrams_with_all_eles({ 1, 5 })))
+            self.assertEqual(set(await collect(asynchronous.ngrams_with_prefix((1,)))), set(expected.ngrams_with_prefix((1,))))
+            self.assertEqual(set(await collect(asynchronous.ngrams_with_suffix((1,), 2))), set(expected.ngrams_with_suffix((1,), 2)))
+            self.assertEqual(set(await collect(asynchronous.ngrams_by_template((1, 2, 3), { 0, 2 }))), set(expected.ngrams_by_template((1, 2, 3), { 0, 2 })))
+            self.assertEqual(await collect(asynchronous.ngrams_with_ele(9)), [])
+            ngrams = list(expected.ngrams())[:50] + [ (9,), (1, 9) ]
+            self.assertEqual(await asynchronous.get_many(ngrams, 0), expected.get_many(ngrams, 0))
+            self.assertEqual(await asynchronous.contains_many(ngrams), expected.contains_many(ngrams))
+
+            asynchronous[(9, 9)] = 'x'
+            self.assertEqual(asynchronous[(9, 9)], 'x')
+            self.assertEqual(asynchronous.increment((9,), 2), 2)
+            self.assertEqual(asynchronous.pop((9,)), 2)
+            del asynchronous[(9, 9)]
+            self.assertFalse((9, 9) in asynchronous)
+            await asynchronous.count_ngrams([ (1, 2), (1, 2) ])
+            self.assertEqual(asynchronous[(1, 2)], expected[(1, 2)] + 2)
+
+            #Other tasks get turns while a search is being iterated over, and changes made in the meantime do not affect it.
+            turns = list()
+            async def other_task():
+                for i in range(5):
+                    turns.append(i)
+                    await asyncio.sleep(0)
+            task = asyncio.ensure_future(other_task())
+            ngrams = list()
+            async for ngram in asynchronous.ngrams():
+                if len(ngrams) == 0:
+                    asynchronous[(9, 9, 9)] = 1
+                ngrams.append(ngram)
+            self.assertEqual(turns, [ 0, 1, 2, 3, 4 ])
+            await task
+            self.assertFalse((9, 9, 9) in ngrams)
+            self.assertEqual(len(ngrams), len(asynchronous) - 1)
+
+        asyncio.run(run())
+
+    def testQueryCache(self):
+        def queries(obj):
+            return [
+                    set(obj.ngrams_with_ele(1)),
+                    set(obj.ngrams_with_ele(9)),
+                    set(obj.sized_ngrams_with_ele(2, 3)),
+                    set(obj.ngrams_with_all_eles({ 1, 2 })),
+                    set(obj.sized_ngrams_with_all_eles({ 3, 4 }, 2)),
+                    set(obj.sized_ngrams_with_all_eles(set(), 1)),
+                    set(obj.ngrams_by_template((1, 2, 3), { 1 })),
+                    set(obj.ngrams_by_template((1, 2, 3), { 0 })),
+                    set(obj.ngrams_by_template((1, 2), { 0, 1 })),
+                    set(obj.ngrams_with_prefix((1,))),
+                    set(obj.ngrams_with_prefix((), 1)),
+                    set(obj.ngrams_with_suffix((2, 3))),
+                ]
+
+        #A cached map gives the same results as an uncached map however it is changed.
+        for options in [ dict(), dict(compact=True), dict(ele_index=True, position_index=True), dict(suffix_tree=True), dict(radix=True) ]:
+            random.seed(0)
+            cached = NGramMap(query_cache_entries=16, **options)
+            expected = NGramMap(**options)
+            for step in range(300):
+                for obj in [ cached, expected ]:
+                    random.seed(step)
+                    change = random.randint(0, 9)
+                    if change < 3:
+                        obj[tuple(random.randint(1, 9) for _ in range(random.randint(1, 3)))] = step
+                    elif change < 5:
+                        obj.increment(tuple(random.randint(1, 9) for _ in range(random.randint(1, 3))))
+                    elif change < 7:
+                        ngrams = list(obj.ngrams())
+                        if len(ngrams) > 0:
+                            obj.pop(random.choice(ngrams))
+                    elif change == 7:
+                        obj.add_sequence([ random.randint(1, 9) for _ in range(5) ], 1, 3)
+                    elif change == 8:
+                        obj.merge(NGramMap({ (random.randint(1, 9), random.randint(1, 9)): 1 }))
+                    elif change == 9:
+                        obj.update({ (random.randint(1, 9),): 1 })
+                    if step == 150:
+                        obj.clear()
+                self.assertEqual(queries(cached), queries(expected))
+            stats = cached.query_cache_stats()
+            self.assertTrue(stats['hits'] > 0)
+            self.assertTrue(stats['invalidations'] > 0)
+            self.assertEqual(stats['misses'], stats['entries'] + stats['evictions'] + stats['invalidations'])
+
+        #Only the results which a changed n-gram belongs in are discarded, and results are discarded from the least recently used when the cache is full.
+        cached = NGramMap({ (1, 2): 1, (2, 3): 1, (3, 4): 1 }, query_cache_entries=2)
+        self.assertEqual(set(cached.ngrams_with_ele(1)), { (1, 2) })
+        self.assertEqual(set(cached.ngrams_with_ele(3)), { (2, 3), (3, 4) })
+        cached[(2, 3)] = 5
+        cached[(1, 5)] = 1
+        self.assertEqual(set(cached.ngrams_with_ele(3)), { (2, 3), (3, 4) })
+        self.assertEqual(set(cached.ngrams_with_ele(1)), { (1, 2), (1, 5) })
+        self.assertEqual(set(cached.ngrams_with_ele(4)), { (3, 4) })
+        stats = cached.query_cache_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['invalidations'], stats['entries']), (1, 4, 1, 1, 2))
+        self.assertEqual(set(cached.ngrams_with_ele(4)), { (3, 4) })
+        self.assertEqual(set(cached.ngrams_with_ele(1)), { (1, 2), (1, 5) })
+        self.assertEqual(cached.query_cache_stats()['hits'], 3)
+        cached.clear()
+        self.assertEqual(cached.query_cache_stats()['entries'], 0)
+        self.assertEqual(cached.query_cache_stats()['bytes'], 0)
+
+        #Results are discarded to keep within a limit on bytes, and a result which is larger than the limit is not cached.
+        cached = NGramMap(query_cache_bytes=1000)
+        cached.add_sequence(list(range(100)), 1, 1)
+        self.assertEqual(len(list(cached.ngrams_with_prefix(()))), 100)
+        self.assertEqual(cached.query_cache_stats()['entries'], 0)
+        for ele in range(100):
+            list(cached.ngrams_with_ele(ele))
+        self.assertTrue(0 < cached.query_cache_stats()['bytes'] <= 1000)
+        self.assertTrue(cached.query_cache_stats()['evictions'] > 0)
+
+        self.assertRaises(ValueError, lambda:NGramMap().query_cache_stats())
+
+    def testBuildParallel(self):
+        random.seed(0)
+        sequences = [ [ random.randint(1,8) for _ in range(50) ] for _ in range(30) ]
+        expected = NGramMap()
+        for sequence in sequences:
+            expected.add_sequence(sequence, 1, 4)
+
+        for workers in [ 1, 2, 3 ]:
+            ngrammap = NGramMap.build_parallel(iter(sequences), (1, 4), workers=workers)
+            self.assertEqual(ngrammap, expected)
+            self.assertEqual(ngrammap.size_freqs, expected.size_freqs)
+            self.assertEqual(ngrammap.ele_freqs, expected.ele_freqs)
+            self.assertEqual(set(ngrammap.sized_ngrams(3)), set(expected.sized_ngrams(3)))
+
+        ngrammap = NGramMap.build_parallel(sequences, (2, 2), workers=2, combine=max)
+        self.assertTrue(all(value < expected[ngram] for (ngram, value) in ngrammap.items() if expected[ngram] > 20))
+        self.assertEqual(len(NGramMap.build_parallel([], (1, 4), workers=2)), 0)
+
+        for (compact, radix) in [ (False, False), (True, False), (False, True) ]:
+            ngrammap = NGramMap(expected, compact=compact, radix=radix, subtree_aggregates=True)
+            unpickled = pickle.loads(pickle.dumps(ngrammap))
+            self.assertEqual(unpickled, expected)
+            unpickled[(9, 9)] = 1
+            self.assertEqual(unpickled.count_with_prefix((9,)), 1)
+            self.assertEqual(unpickled.value_sum_with_prefix(()), sum(expected.values()) + 1)
+
+
+#Worker process functions are defined at module level so that they can be used with any start method, where the module is imported again in each worker.
+def attached_lookup(conn, name, ngrams):
+    conn.send(FrozenNGramMap.attach(name).get_many(ngrams))
+
+def private_memory_size():
+    size = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Private_'):
+                size += int(line.split()[1])*1024
+    return size
+
+def worker_private_memory(conn, method, pickled, name, ngrams):
+    if method == "no map":
+        worker_map = NGramMap()
+    elif method == "pickled copy":
+        worker_map = pickle.loads(pickled)
+    else:
+        worker_map = NGramMap.attach(name)
+    worker_map.get_many(ngrams)
+    list(worker_map.values())
+    conn.send(private_memory_size())
+    conn.recv()
+
+
+if __name__ == '__main__':
+    try:
+        unittest.main()
+    except:
+        pass
+
+    import time
+    import random
+
+    num_ngrammaps = 500
+
+    for max_ngram_size in [3, 10]:
+        for max_ele_value in [2, 100]:
+            print()
+            print("====================================")
+            print("max ngram size", max_ngram_size)
+            print("max ele value", max_ele_value)
+            print()
+
+            ngrams = [ [tuple( random.randint(1,max_ele_value) for _ in range(random.randint(1,max_ngram_size)) ) for _ in range(2000)] for _ in range(num_ngrammaps) ]
+            ngrammaps = [ None for _ in range(num_ngrammaps) ]
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                ngrammaps[i] = NGramMap()
+                for ngram in ngrams[i]:
+                    ngrammaps[i][ngram] = True
+            print("__setitem__ timing:", round(time.process_time() - t, 2))
+
+            items = [ None for _ in range(num_ngrammaps) ]
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                NGramMap().count_ngrams(ngrams[i])
+            print("count_ngrams timing:", round(time.process_time() - t, 2))
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                NGramMap().add_sequence([ ngram[0] for ngram in ngrams[i] ], 1, max_ngram_size)
+            print("add_sequence timing:", round(time.process_time() - t, 2))
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                items[i] = list(ngrammaps[i].items())
+            print("items timing:", round(time.process_time() - t, 2))
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                for (ngram, value) in items[i]:
+                    ngrammaps[i][ngram]
+            print("__getitem__ timing:", round(time.process_time() - t, 2))
     
-        t = time.clock()
-        for i in range(num_ngrammaps):
-            list(ngrammaps[i].ngrams_with_ele(random.randint(1,max_ele_value)))
-        print("ngrams_with_ele timing:", round(time.clock() - t, 2))
-
-        t = time.clock()
-        for i in range(num_ngrammaps):
-            list(ngrammaps[i].ngrams_with_all_eles({ random.randint(1,max_ele_value) for _ in range(random.randint(1,max_ngram_size)) }))
-        print("ngrams_with_all_eles timing:", round(time.clock() - t, 2))
-
-        t = time.clock()
-        for i in range(num_ngrammaps):
-            ngram = random.choice(ngrams[i])
-            list(ngrammaps[i].ngrams_by_template(ngram, { j for j in range(len(ngram)) if random.random() > 0.5 } ))
-        print("ngrams_by_template timing:", round(time.clock() - t, 2))
-
-        t = time.clock()
-        for i in range(num_ngrammaps):
-            for (ngram, value) in items[i]:
-                ngrammaps[i].pop(ngram)
-        print("pop timing:", round(time.clock() - t, 2))
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                list(ngrammaps[i].ngrams_with_ele(random.randint(1,max_ele_value)))
+            print("ngrams_with_ele timing:", round(time.process_time() - t, 2))
+
+            indexed_ngrammaps = [ NGramMap(ngrammaps[i], ele_index=True) for i in range(num_ngrammaps) ]
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                list(indexed_ngrammaps[i].ngrams_with_ele(random.randint(1,max_ele_value)))
+            print("ngrams_with_ele (ele_index) timing:", round(time.process_time() - t, 2))
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                list(ngrammaps[i].ngrams_with_all_eles({ random.randint(1,max_ele_value) for _ in range(random.randint(1,max_ngram_size)) }))
+            print("ngrams_with_all_eles timing:", round(time.process_time() - t, 2))
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                list(indexed_ngrammaps[i].ngrams_with_all_eles({ random.randint(1,max_ele_value) for _ in range(random.randint(1,max_ngram_size)) }))
+            print("ngrams_with_all_eles (ele_index) timing:", round(time.process_time() - t, 2))
+
+            summarised_ngrammaps = [ NGramMap(ngrammaps[i], ele_summary_bits=64) for i in range(num_ngrammaps) ]
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                list(summarised_ngrammaps[i].ngrams_with_all_eles({ random.randint(1,max_ele_value) for _ in range(random.randint(1,max_ngram_size)) }))
+            print("ngrams_with_all_eles (ele_summary_bits=64) timing:", round(time.process_time() - t, 2))
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                ngram = random.choice(ngrams[i])
+                list(ngrammaps[i].ngrams_by_template(ngram, { j for j in range(len(ngram)) if random.random() > 0.5 } ))
+            print("ngrams_by_template timing:", round(time.process_time() - t, 2))
+
+            positioned_ngrammaps = [ NGramMap(ngrammaps[i], position_index=True) for i in range(num_ngrammaps) ]
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                ngram = random.choice(ngrams[i])
+                list(positioned_ngrammaps[i].ngrams_by_template(ngram, { j for j in range(len(ngram)) if random.random() > 0.5 } ))
+            print("ngrams_by_template (position_index) timing:", round(time.process_time() - t, 2))
+
+            t = time.process_time()
+            for i in range(num_ngrammaps):
+                for (ngram, value) in items[i]:
+                    ngrammaps[i].pop(ngram)
+            print("pop timing:", round(time.process_time() - t, 2))
+
+    print()
+    print("====================================")
+    print("microseconds per operation by ngram size")
+    print()
+
+    for (ngram_size, radix) in [ (ngram_size, radix) for ngram_size in range(3, 11) for radix in [ False, True ] ]:
+        ngrams = list({ tuple( random.randint(1,100) for _ in range(ngram_size) ) for _ in range(20000) })
+        ngrammap = NGramMap(radix=radix)
+        timings = []
+
+        t = time.process_time()
+        for ngram in ngrams:
+            ngrammap[ngram] = True
+        timings.append(time.process_time() - t)
+
+        t = time.process_time()
+        for ngram in ngrams:
+            ngrammap[ngram]
+        timings.append(time.process_time() - t)
+
+        t = time.process_time()
+        for ngram in ngrams:
+            ngram in ngrammap
+        timings.append(time.process_time() - t)
+
+        t = time.process_time()
+        for ngram in ngrams:
+            ngrammap.pop(ngram)
+        timings.append(time.process_time() - t)
+
+        print("ngram size", ngram_size, "(radix)" if radix else "(plain)", "-", ", ".join("%s: %s"%(name, round(timing/len(ngrams)*1000000, 2)) for (name, timing) in zip(["__setitem__", "__getitem__", "__contains__", "pop"], timings)))
+
+    print()
+    print("====================================")
+    print("memory usage of counting all n-grams of size 1 to 5 in a text")
+    print()
+
+    import tracemalloc
+
+    words = [ "word%d"%i for i in range(5000) ]
+    lines = [ " ".join(random.choice(words) for _ in range(1000)) for _ in range(100) ]
+    for compact in [ False, True ]:
+        tracemalloc.start()
+        ngrammap = NGramMap(compact=compact)
+        for line in lines:
+            ngrammap.add_sequence(line.split(), 1, 5)
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("compact", compact, "-", len(ngrammap), "ngrams, peak MB:", round(peak/1000000, 1))
+        del ngrammap
+
+    print()
+    print("====================================")
+    print("frozen map")
+    print()
+
+    ngrammap = NGramMap()
+    for line in lines:
+        ngrammap.add_sequence(line.split(), 1, 5)
+    ngrams = list(ngrammap.ngrams())
+    random.shuffle(ngrams)
+    t = time.process_time()
+    frozen = ngrammap.freeze()
+    print("freeze timing:", round(time.process_time() - t, 2))
+    for (name, obj) in [ ("NGramMap", ngrammap), ("FrozenNGramMap", frozen) ]:
+        t = time.process_time()
+        for ngram in ngrams:
+            obj[ngram]
+        print(name, "__getitem__ microseconds per operation:", round((time.process_time() - t)/len(ngrams)*1000000, 2))
+        t = time.process_time()
+        obj.get_many(ngrams)
+        print(name, "get_many microseconds per ngram:", round((time.process_time() - t)/len(ngrams)*1000000, 2))
+    tokens = lines[0].split()
+    sentence_ngrams = [ tuple(tokens[start:end]) for start in range(len(tokens)) for end in range(start+1, min(start+6, len(tokens)+1)) ]
+    for (name, obj) in [ ("NGramMap", ngrammap), ("FrozenNGramMap", frozen) ]:
+        t = time.process_time()
+        for ngram in sentence_ngrams:
+            ngram in obj
+        print(name, "__contains__ microseconds per ngram of a line:", round((time.process_time() - t)/len(sentence_ngrams)*1000000, 2))
+        t = time.process_time()
+        obj.contains_many(sentence_ngrams)
+        print(name, "contains_many microseconds per ngram of a line:", round((time.process_time() - t)/len(sentence_ngrams)*1000000, 2))
+    frozen = None
+    tracemalloc.start()
+    frozen = ngrammap.freeze()
+    print("NGramMap", len(ngrammap), "ngrams, frozen MB:", round(tracemalloc.get_traced_memory()[0]/1000000, 1))
+    tracemalloc.stop()
+    del ngrammap
+
+    print()
+    print("====================================")
+    print("saved map")
+    print()
+
+    import os
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        path = os.path.join(dir_path, 'ngrams.bin')
+        t = time.process_time()
+        frozen.save(path)
+        print("save timing:", round(time.process_time() - t, 2), "file MB:", round(os.path.getsize(path)/1000000, 1))
+        for mmap in [ True, False ]:
+            t = time.perf_counter()
+            opened = FrozenNGramMap.open(path, mmap=mmap)
+            print("open timing (mmap", mmap, "):", round(time.perf_counter() - t, 4))
+            t = time.perf_counter()
+            opened[ngrams[0]]
+            print("first lookup timing (mmap", mmap, "):", round(time.perf_counter() - t, 4))
+            t = time.process_time()
+            for ngram in ngrams:
+                opened[ngram]
+            print("__getitem__ microseconds per operation (mmap", mmap, "):", round((time.process_time() - t)/len(ngrams)*1000000, 2))
+            del opened
+
+    print()
+    print("====================================")
+    print("out of core builder")
+    print()
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        path = os.path.join(dir_path, 'ngrams.bin')
+        for max_ngrams in [ 10000, 100000 ]:
+            for measure_memory in [ False, True ]:
+                if measure_memory:
+                    tracemalloc.start()
+                t = time.process_time()
+                with NGramMapBuilder(max_ngrams=max_ngrams) as builder:
+                    for line in lines:
+                        builder.add_sequence(line.split(), 1, 5)
+                    builder.save(path)
+                if measure_memory:
+                    print("max ngrams", max_ngrams, "- build and save peak MB:", round(tracemalloc.get_traced_memory()[1]/1000000, 1))
+                    tracemalloc.stop()
+                else:
+                    print("max ngrams", max_ngrams, "- build and save timing:", round(time.process_time() - t, 2))
+
+    print()
+    print("====================================")
+    print("parallel construction (wall clock)")
+    print()
+
+    sequences = [ line.split() for line in lines ]
+    t = time.perf_counter()
+    ngrammap = NGramMap()
+    for sequence in sequences:
+        ngrammap.add_sequence(sequence, 1, 5)
+    print("serial add_sequence timing:", round(time.perf_counter() - t, 2))
+    del ngrammap
+    for workers in [ 1, 2, 4 ]:
+        t = time.perf_counter()
+        NGramMap.build_parallel(sequences, (1, 5), workers=workers)
+        print("build_parallel workers", workers, "timing:", round(time.perf_counter() - t, 2))
+
+    print()
+    print("====================================")
+    print("merging maps counted from separate parts of a text")
+    print()
+
+    for method in [ "update", "merge" ]:
+        part_maps = list()
+        for i in range(10):
+            part_map = NGramMap()
+            for line in lines[i::10]:
+                part_map.add_sequence(line.split(), 1, 5)
+            part_maps.append(part_map)
+        t = time.process_time()
+        ngrammap = NGramMap()
+        for part_map in part_maps:
+            if method == "update":
+                ngrammap.update(part_map, lambda a, b: a + b)
+            else:
+                ngrammap.merge(part_map)
+        print(method, "timing:", round(time.process_time() - t, 2))
+        del part_maps
+        del ngrammap
+
+    print()
+    print("====================================")
+    print("sharded map (wall clock)")
+    print()
+
+    ngrammap = NGramMap()
+    for line in lines[:20]:
+        ngrammap.add_sequence(line.split(), 1, 3)
+    ngrams = list(ngrammap.ngrams())
+    t = time.perf_counter()
+    for ngram in ngrams[:10000]:
+        ngrammap[ngram]
+    print("NGramMap __getitem__ microseconds per operation:", round((time.perf_counter() - t)/10000*1000000, 2))
+    t = time.perf_counter()
+    ngrammap.get_many(ngrams)
+    print("NGramMap get_many microseconds per ngram:", round((time.perf_counter() - t)/len(ngrams)*1000000, 2))
+    t = time.perf_counter()
+    for ele in words[:100]:
+        list(ngrammap.ngrams_with_ele(ele))
+    print("NGramMap ngrams_with_ele milliseconds per operation:", round((time.perf_counter() - t)/100*1000, 2))
+    del ngrammap
+    for num_shards in [ 1, 2, 4 ]:
+        with ShardedNGramMap(num_shards=num_shards) as sharded:
+            for line in lines[:20]:
+                sharded.add_sequence(line.split(), 1, 3)
+            t = time.perf_counter()
+            for ngram in ngrams[:10000]:
+                sharded[ngram]
+            print("shards", num_shards, "__getitem__ microseconds per operation:", round((time.perf_counter() - t)/10000*1000000, 2))
+            t = time.perf_counter()
+            sharded.get_many(ngrams)
+            print("shards", num_shards, "get_many microseconds per ngram:", round((time.perf_counter() - t)/len(ngrams)*1000000, 2))
+            t = time.perf_counter()
+            for ele in words[:100]:
+                list(sharded.ngrams_with_ele(ele))
+            print("shards", num_shards, "ngrams_with_ele milliseconds per operation:", round((time.perf_counter() - t)/100*1000, 2))
+
+    print()
+    print("====================================")
+    print("map shared by worker processes (Linux only)")
+    print()
+
+    ngrammap = NGramMap()
+    for line in lines:
+        ngrammap.add_sequence(line.split(), 1, 5)
+    ngrams = list(ngrammap.ngrams())[::100]
+    pickled = pickle.dumps(ngrammap)
+    block = ngrammap.publish()
+    del ngrammap
+    if os.path.exists('/proc/self/smaps_rollup'):
+        for method in [ "no map", "pickled copy", "attached" ]:
+            for num_workers in [ 1, 2, 4 ]:
+                conns = list()
+                processes = list()
+                for _ in range(num_workers):
+                    (conn, worker_conn) = multiprocessing.Pipe()
+                    processes.append(multiprocessing.Process(target=worker_private_memory, args=(worker_conn, method, pickled, block.name, ngrams)))
+                    processes[-1].start()
+                    conns.append(conn)
+                total = sum(conn.recv() for conn in conns if conn.poll(600))
+                for conn in conns:
+                    conn.send(None)
+                for process in processes:
+                    process.join()
+                print(method, "-", num_workers, "workers, total private MB:", round(total/1000000, 1))
+    block.close()
+    block.unlink()
+
+    print()
+    print("====================================")
+    print("concurrent map (wall clock)")
+    print()
+
+    import threading
+
+    for map_type in [ NGramMap, ConcurrentNGramMap ]:
+        ngrammap = map_type()
+        t = time.perf_counter()
+        for line in lines[:20]:
+            ngrammap.add_sequence(line.split(), 1, 3)
+        print(map_type.__name__, "add_sequence timing:", round(time.perf_counter() - t, 2))
+        t = time.perf_counter()
+        for line in lines[20:30]:
+            tokens = line.split()
+            for i in range(len(tokens) - 2):
+                ngrammap.increment(tuple(tokens[i:i+3]))
+        print(map_type.__name__, "increment microseconds per operation:", round((time.perf_counter() - t)/(10*998)*1000000, 2))
+        ngrams = list(ngrammap.ngrams())[:10000]
+        t = time.perf_counter()
+        for ngram in ngrams:
+            ngrammap[ngram]
+        print(map_type.__name__, "__getitem__ microseconds per operation:", round((time.perf_counter() - t)/len(ngrams)*1000000, 2))
+
+    concurrent = ConcurrentNGramMap()
+    for line in lines[:20]:
+        concurrent.add_sequence(line.split(), 1, 3)
+    def write():
+        for line in lines[20:40]:
+            concurrent.add_sequence(line.split(), 1, 3)
+    writer = threading.Thread(target=write)
+    t = time.perf_counter()
+    writer.start()
+    num_items = 0
+    while writer.is_alive():
+        num_items += sum(1 for _ in concurrent.items())
+    writer.join()
+    print("ConcurrentNGramMap add_sequence with a reader iterating over items timing:", round(time.perf_counter() - t, 2), "items read:", num_items)
+
+    print()
+    print("====================================")
+    print("persistent map versions")
+    print()
+
+    version = PersistentNGramMap()
+    for line in lines[:20]:
+        version = version.add_sequence(line.split(), 1, 3)
+    tokens = lines[20].split()
+    t = time.perf_counter()
+    versions = [ version ]
+    for i in range(len(tokens) - 2):
+        versions.append(versions[-1].increment(tuple(tokens[i:i+3])))
+    print("PersistentNGramMap increment microseconds per new version:", round((time.perf_counter() - t)/(len(tokens) - 2)*1000000, 2))
+    tracemalloc.start()
+    versions = [ version ]
+    for i in range(len(tokens) - 2):
+        versions.append(versions[-1].increment(tuple(tokens[i:i+3])))
+    print("PersistentNGramMap", len(versions), "versions, extra KB per version:", round(tracemalloc.get_traced_memory()[0]/len(versions)/1000, 1))
+    tracemalloc.stop()
+    del versions
+    del version
+
+    print()
+    print("====================================")
+    print("writes under a high-fanout first element")
+    print()
+
+    fanout_ngrams = [ ("the", i) for i in range(20000) ]
+    concurrent = ConcurrentNGramMap()
+    concurrent.count_ngrams(fanout_ngrams)
+    concurrent.increment(fanout_ngrams[0])
+    t = time.perf_counter()
+    for ngram in fanout_ngrams[:2000]:
+        concurrent.increment(ngram)
+    print("ConcurrentNGramMap increment microseconds per operation with", len(fanout_ngrams), "siblings:", round((time.perf_counter() - t)/2000*1000000, 2))
+    del concurrent
+    version = PersistentNGramMap().count_ngrams(fanout_ngrams)
+    version = version.increment(fanout_ngrams[0])
+    t = time.perf_counter()
+    for ngram in fanout_ngrams[:2000]:
+        version = version.increment(ngram)
+    print("PersistentNGramMap increment microseconds per new version with", len(fanout_ngrams), "siblings:", round((time.perf_counter() - t)/2000*1000000, 2))
+    tracemalloc.start()
+    versions = [ version ]
+    for ngram in fanout_ngrams[:500]:
+        versions.append(versions[-1].increment(ngram))
+    print("PersistentNGramMap", len(versions), "versions with", len(fanout_ngrams), "siblings, extra KB per version:", round(tracemalloc.get_traced_memory()[0]/len(versions)/1000, 1))
+    tracemalloc.stop()
+    del versions
+    del version
+
+    print()
+    print("====================================")
+    print("asyncio map (wall clock)")
+    print()
+
+    import asyncio
+    import gc
+
+    async def request_latencies(ngrammap, done):
+        #Small requests arriving every millisecond while bulk work is going on, timed from when they were due to when they were answered.
+        latencies = list()
+        ngrams = list(ngrammap.snapshot().ngrams() if isinstance(ngrammap, AsyncNGramMap) else ngrammap.ngrams())[:1000]
+        due = time.perf_counter()
+        while not done.is_set():
+            due += 0.001
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            ngrammap[random.choice(ngrams)]
+            latencies.append(time.perf_counter() - due)
+        return latencies
+
+    async def bulk_work(ngrammap, done):
+        await asyncio.sleep(0.01)
+        if isinstance(ngrammap, AsyncNGramMap):
+            await ngrammap.add_batch([ line.split() for line in lines[20:40] ], 1, 3)
+            num_items = 0
+            async for _ in ngrammap.items():
+                num_items += 1
+        else:
+            for line in lines[20:40]:
+                ngrammap.add_sequence(line.split(), 1, 3)
+            num_items = sum(1 for _ in ngrammap.items())
+        done.set()
+
+    async def serve(ngrammap):
+        done = asyncio.Event()
+        t = time.perf_counter()
+        (latencies, _) = await asyncio.gather(request_latencies(ngrammap, done), bulk_work(ngrammap, done))
+        return (time.perf_counter() - t, latencies)
+
+    for ngrammap in [ NGramMap(), AsyncNGramMap() ]:
+        for line in lines[:20]:
+            (ngrammap.map if isinstance(ngrammap, AsyncNGramMap) else ngrammap).add_sequence(line.split(), 1, 3)
+        gc.freeze() #Keep the garbage collector from pausing the event loop to walk through the nodes which are already in the map.
+        (duration, latencies) = asyncio.run(serve(ngrammap))
+        latencies.sort()
+        print(type(ngrammap).__name__, "bulk work timing:", round(duration, 2), "requests answered:", len(latencies), "median request latency ms:", round(latencies[len(latencies)//2]*1000, 2), "max request latency ms:", round(latencies[-1]*1000, 2))
+        gc.unfreeze()
+
+    print()
+    print("====================================")
+    print("query cache")
+    print()
+
+    random.seed(0)
+    dashboard_eles = random.sample(words, 20)
+    for query_cache_entries in [ 0, 100 ]:
+        ngrammap = NGramMap(query_cache_entries=query_cache_entries)
+        for line in lines[:20]:
+            ngrammap.add_sequence(line.split(), 1, 3)
+        tokens = lines[20].split()
+        t = time.perf_counter()
+        #The same queries are repeated over and over while the map changes slowly, with each change touching one of the queried elements.
+        for i in range(10):
+            for ele in dashboard_eles:
+                sum(1 for _ in ngrammap.ngrams_with_ele(ele))
+                sum(1 for _ in ngrammap.sized_ngrams_with_all_eles({ ele, dashboard_eles[0] }, 3))
+                sum(1 for _ in ngrammap.ngrams_by_template((ele, None, None), { 1, 2 }))
+            ngrammap.add_sequence(tokens[i*3:i*3+4] + [ dashboard_eles[i] ], 1, 3)
+        print("NGramMap query_cache_entries="+str(query_cache_entries), "repeated queries timing:", round(time.perf_counter() - t, 2), "" if query_cache_entries == 0 else ngrammap.query_cache_stats())
+
+    print()
+    print("====================================")
+    print("popping siblings under a high-fanout node")
+    print()
+
+    for radix in [ False, True ]:
+        for fanout in [ 5000, 10000, 20000 ]:
+            ngrammap = NGramMap(radix=radix)
+            for ele in range(fanout):
+                ngrammap[(ele,)] = 1
+                ngrammap[(ele, 0)] = 1
+            t = time.perf_counter()
+            for ele in range(fanout):
+                ngrammap.pop((ele,))
+            print("NGramMap radix="+str(radix), "popping", fanout, "sibling unigrams timing:", round(time.perf_counter() - t, 3))